@@ -70,9 +70,15 @@ resource "azurerm_container_group" "aci" {
     }
 
     environment_variables = {
-      "REGISTRY_LOGIN_SERVER" = azurerm_container_registry.acr.login_server
-      "REGISTRY_USERNAME"     = azurerm_container_registry.acr.admin_username
-      "REGISTRY_PASSWORD"     = azurerm_container_registry.acr.admin_password
+      "REGISTRY_LOGIN_SERVER"      = azurerm_container_registry.acr.login_server
+      "REGISTRY_USERNAME"          = azurerm_container_registry.acr.admin_username
+      "REGISTRY_PASSWORD"          = azurerm_container_registry.acr.admin_password
+      "PIPELINE_STORAGE_CONTAINER" = azurerm_storage_container.sc.name
+    }
+
+    # Used by `src/main.py --storage-backend blob` to synchronize the data tree with the blob container
+    secure_environment_variables = {
+      "PIPELINE_STORAGE_CONNECTION_STRING" = azurerm_storage_account.sa.primary_connection_string
     }
   }
 
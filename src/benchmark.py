@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import tempfile
+import time
+
+import pandas as pd
+
+import main
+from main import (
+    apply_schema,
+    collect_metrics,
+    create_bronze_layer,
+    create_customer_table,
+    create_layers,
+    create_product_table,
+    create_silver_layer,
+    create_transaction_table,
+    create_update_golden_layer,
+    explode_transactions,
+    read_table_file,
+    rearrange_data,
+    rearrange_data_rowwise,
+)
+
+BENCHMARK_RESULTS_FILE = "benchmarks/results.jsonl"
+# Stages of the pipeline benchmark and the instrumented function timing each one
+BENCHMARK_STAGES = {
+    "bronze ingest": "create_bronze_layer",
+    "rearrange_data": "rearrange_data",
+    "sanity_check": "sanity_check",
+    "silver writes": "save_silver_data",
+    "gold append": "save_golden_data",
+}
+# A stage slower than its previous result by more than this ratio is reported as a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+# Build a bronze dataframe with the layout of data/bronze/<date>/data.csv, where every customer has
+# transactions_per_customer transactions stored in the stringified transactions column
+def generate_bronze_data(customers, transactions_per_customer):
+    rows = []
+    for c in range(customers):
+        transactions = [{
+            "transaction_id": f"T{c}_{t}",
+            "date": f"2023-{t % 12 + 1:02d}-{c % 28 + 1:02d}",
+            "amount": float(c % 100 + t),
+            "product_id": f"P{(c + t) % 10 + 1}",
+            "product_name": f"Product {(c + t) % 10 + 1}",
+        } for t in range(transactions_per_customer)]
+        rows.append({
+            "id": f"C{c:07d}",
+            "name": f"Customer {c}",
+            "email": f"customer{c}@example.com",
+            "signup_date": "2023-01-01",
+            "last_purchase": "2023-12-31",
+            "total_spent": sum(transaction["amount"] for transaction in transactions),
+            "transactions": str(transactions),
+        })
+    return pd.DataFrame(rows)
+
+
+# Write a customers.json file with the given number of customers, streamed so that it does not have to
+# fit in memory. The data only depends on the seed; every customer has between 1 and twice the mean
+# number of transactions, on a catalog of a product per 1000 customers
+def generate_customers_file(file_path, customers, transactions_per_customer, seed=0):
+    rng = random.Random(seed)
+    products = max(customers // 1000, 10)
+    transactions = 0
+    with open(file_path, "w") as f:
+        f.write('{"customers": [')
+        for c in range(customers):
+            customer_transactions = []
+            for t in range(rng.randint(1, 2 * transactions_per_customer - 1)):
+                product = rng.randrange(products) + 1
+                customer_transactions.append({
+                    "transaction_id": f"T{c}_{t}",
+                    "date": f"2023-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                    "amount": round(rng.uniform(1, 500), 2),
+                    "product_id": f"P{product}",
+                    "product_name": f"Product {product}",
+                })
+            transactions += len(customer_transactions)
+            customer = {
+                "id": f"C{c:08d}",
+                "name": f"Customer {c}",
+                "email": f"customer{c}@example.com",
+                "signup_date": f"2022-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+                "last_purchase": max(transaction["date"] for transaction in customer_transactions),
+                "total_spent": round(sum(transaction["amount"] for transaction in customer_transactions), 2),
+                "transactions": customer_transactions,
+            }
+            f.write(("," if c else "") + json.dumps(customer))
+        f.write("]}")
+    return transactions
+
+
+# Hash of the checked out commit, None outside of a git repository
+def get_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Run the function and return the result and the time it took, in seconds
+def time_function(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+# Compare the throughput of the row by row and the vectorized denormalization of the bronze data.
+# The vectorized version is measured on the stringified transactions column, which still has to be
+# parsed, and on the transactions table of the split bronze layout, which is pure columnar work
+def benchmark_rearrange(transactions, transactions_per_customer):
+    customers = max(transactions // transactions_per_customer, 1)
+    df = generate_bronze_data(customers, transactions_per_customer)
+    df_customers = df.drop(columns=["transactions"])
+    df_transactions = explode_transactions(df)
+    rows = customers * transactions_per_customer
+    print(f"rearrange_data: {customers} customers, {rows} transactions")
+
+    df_rowwise, rowwise_seconds = time_function(rearrange_data_rowwise, df)
+    df_vectorized, vectorized_seconds = time_function(rearrange_data, df)
+    df_split, split_seconds = time_function(rearrange_data, df_customers, df_transactions)
+    pd.testing.assert_frame_equal(df_vectorized, df_rowwise)
+    pd.testing.assert_frame_equal(df_split, df_rowwise)
+
+    print(f"{'implementation':<24}{'seconds':>10}{'rows/sec':>14}{'speedup':>10}")
+    for name, seconds in [("rowwise", rowwise_seconds),
+                          ("vectorized", vectorized_seconds),
+                          ("vectorized, split bronze", split_seconds)]:
+        print(f"{name:<24}{seconds:>10.2f}{rows / seconds:>14,.0f}{rowwise_seconds / seconds:>9.1f}x")
+
+
+# Compare the write time, read time, read time of a couple of columns and size on disk of the
+# denormalized silver table in every storage format
+def benchmark_storage(transactions, transactions_per_customer):
+    customers = max(transactions // transactions_per_customer, 1)
+    df = rearrange_data(generate_bronze_data(customers, transactions_per_customer))
+    columns = ["transaction_id", "amount"]
+    print(f"storage: denormalized table, {len(df)} rows, {len(df.columns)} columns")
+
+    print(f"{'format':<10}{'write s':>10}{'read s':>10}{'read 2 cols s':>16}{'MB on disk':>12}")
+    with tempfile.TemporaryDirectory() as directory_path:
+        for storage_format in main.STORAGE_FORMATS:
+            main.STORAGE_FORMAT = storage_format
+            path = f"{directory_path}/denormalized"
+            _, write_seconds = time_function(main.write_table, df, path)
+            _, read_seconds = time_function(main.read_table, path)
+            _, read_columns_seconds = time_function(main.read_table, path, columns)
+            size = os.path.getsize(f"{path}.{storage_format}") / 2**20
+            print(f"{storage_format:<10}{write_seconds:>10.2f}{read_seconds:>10.2f}"
+                  f"{read_columns_seconds:>16.2f}{size:>12.1f}")
+
+
+# Compare the memory footprint of the tables of the bronze and silver layers read from CSV files, with
+# the dtypes pandas infers and with the dtypes of their schema
+def benchmark_memory(transactions, transactions_per_customer):
+    customers = max(transactions // transactions_per_customer, 1)
+    df_bronze = generate_bronze_data(customers, transactions_per_customer)
+    df_denormalized = rearrange_data(df_bronze)
+    tables = [
+        ("bronze", "transactions", explode_transactions(df_bronze)),
+        ("silver", "denormalized", df_denormalized),
+        ("silver", "transactions", create_transaction_table(df_denormalized)),
+        ("silver", "customers", create_customer_table(df_denormalized)),
+        ("silver", "products", create_product_table(df_denormalized)),
+    ]
+    print(f"memory: {customers} customers, {len(df_denormalized)} transactions")
+
+    print(f"{'table':<22}{'inferred MB':>13}{'schema MB':>11}{'reduction':>11}")
+    with tempfile.TemporaryDirectory() as directory_path:
+        for layer, table_name, df in tables:
+            file_path = f"{directory_path}/{table_name}.csv"
+            df.to_csv(file_path, index=False)
+            df_inferred = read_table_file(file_path)
+            df_typed = apply_schema(df_inferred, layer, table_name)
+            inferred = df_inferred.memory_usage(deep=True).sum() / 2**20
+            typed = df_typed.memory_usage(deep=True).sum() / 2**20
+            print(f"{layer + '/' + table_name:<22}{inferred:>13.1f}{typed:>11.1f}{1 - typed / inferred:>10.0%}")
+
+
+# Previous result of a benchmark run with the same parameters, None when there is none
+def load_previous_result(results_file, parameters):
+    if not os.path.exists(results_file):
+        return None
+    with open(results_file) as f:
+        results = [json.loads(line) for line in f if line.strip()]
+    return next((result for result in reversed(results) if result["parameters"] == parameters), None)
+
+
+# Run the whole pipeline on synthetic customers in a temporary directory and time its stages with the
+# metrics of the instrumented functions. The result is appended to results_file with the commit it was
+# run on, and compared with the previous result of a run with the same parameters
+def benchmark_pipeline(customers, transactions_per_customer, seed=0, streaming=False, split_transactions=False,
+                       trace_memory=False, results_file=BENCHMARK_RESULTS_FILE):
+    results_file = os.path.abspath(results_file)
+    parameters = {"customers": customers, "transactions_per_customer": transactions_per_customer, "seed": seed,
+                  "streaming": streaming, "split_transactions": split_transactions, "trace_memory": trace_memory}
+    working_directory = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory_path:
+        os.chdir(directory_path)
+        try:
+            create_layers()
+            transactions = generate_customers_file("data/customers.json", customers, transactions_per_customer, seed)
+            print(f"pipeline: {customers} customers, {transactions} transactions")
+            with collect_metrics("metrics.json", trace_memory):
+                create_bronze_layer("data/customers.json", streaming, split_transactions=split_transactions)
+                create_silver_layer()
+                create_update_golden_layer()
+            with open("metrics.json") as f:
+                report = json.load(f)
+        finally:
+            os.chdir(working_directory)
+
+    stages = {}
+    for stage, function in BENCHMARK_STAGES.items():
+        metrics = report["functions"].get(function, {})
+        stages[stage] = {metric: metrics.get(metric) for metric in ["wall_s", "cpu_s", "max_rss_mb", "peak_traced_mb"]}
+    result = {"commit": get_commit(), "date": pd.Timestamp.now().isoformat(), "parameters": parameters,
+              "transactions": transactions, "wall_s": report["wall_s"], "stages": stages}
+    previous = load_previous_result(results_file, parameters)
+
+    previous_stages = previous["stages"] if previous else {}
+    previous_stages["total"] = {"wall_s": previous["wall_s"] if previous else None}
+    print(f"{'stage':<16}{'seconds':>10}{'rows/sec':>14}{'max RSS MB':>12}{'peak MB':>10}{'previous':>10}")
+    for stage, metrics in list(stages.items()) + [("total", {"wall_s": result["wall_s"]})]:
+        seconds = metrics["wall_s"] or 0
+        previous_seconds = previous_stages.get(stage, {}).get("wall_s")
+        change = f"{seconds / previous_seconds:>9.2f}x" if seconds and previous_seconds else f"{'-':>10}"
+        if seconds and previous_seconds and seconds / previous_seconds > REGRESSION_THRESHOLD:
+            change += " regression"
+        print(f"{stage:<16}{seconds:>10.2f}{transactions / seconds if seconds else 0:>14,.0f}"
+              f"{metrics.get('max_rss_mb') or 0:>12.1f}{metrics.get('peak_traced_mb') or 0:>10.1f}{change}")
+    if previous:
+        print(f"previous: commit {previous['commit']}, {previous['date']}")
+
+    os.makedirs(os.path.dirname(results_file), exist_ok=True)
+    with open(results_file, "a") as f:
+        f.write(json.dumps(result) + "\n")
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the medallion pipeline")
+    parser.add_argument("benchmark", choices=["rearrange", "storage", "memory", "pipeline"])
+    parser.add_argument("--transactions", type=int, default=1_000_000)
+    parser.add_argument("--transactions-per-customer", type=int, default=4)
+    parser.add_argument("--customers", type=int, default=10_000, help="number of customers of the pipeline benchmark")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic customers")
+    parser.add_argument("--streaming", action="store_true", help="ingest the customers file incrementally")
+    parser.add_argument("--split-transactions", action="store_true", help="store transactions as a bronze table")
+    parser.add_argument("--trace-memory", action="store_true", help="record the memory peak of every stage")
+    parser.add_argument("--results-file", default=BENCHMARK_RESULTS_FILE, help="JSON lines file of the results")
+    args = parser.parse_args()
+
+    if args.benchmark == "rearrange":
+        benchmark_rearrange(args.transactions, args.transactions_per_customer)
+    elif args.benchmark == "storage":
+        benchmark_storage(args.transactions, args.transactions_per_customer)
+    elif args.benchmark == "memory":
+        benchmark_memory(args.transactions, args.transactions_per_customer)
+    elif args.benchmark == "pipeline":
+        benchmark_pipeline(args.customers, args.transactions_per_customer, args.seed, args.streaming,
+                           args.split_transactions, args.trace_memory, args.results_file)
@@ -1,7 +1,214 @@
+import argparse
+import ast
+import atexit
+import base64
+import cProfile
+import hashlib
+import hmac
+import http.client
 import json
+import math
 import os
-
+import queue
+import resource
+import shutil
+import sqlite3
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from email.utils import formatdate
+from functools import partial, wraps
+from types import SimpleNamespace
+from xml.etree import ElementTree
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Number of customers converted and written at once when the bronze layer is created in streaming mode
+BRONZE_CHUNK_SIZE = 10_000
+# Number of workers running the independent tasks of the silver and gold layers, 1 runs them one after the other
+PIPELINE_WORKERS = 1
+# Kind of workers: "process" runs CSV serialization, which holds the GIL, truly in parallel at the cost of
+# pickling the dataframes to the workers, "thread" shares them and suits parquet, which releases the GIL
+PIPELINE_EXECUTOR = "process"
+
+
+# ----------------- Instrumentation -----------------
+# The functions of the pipeline are instrumented: when metrics are collected every call records its
+# wall time, CPU time, memory, rows in and out and bytes read and written. Calls are appended as JSON
+# lines to the file named by an environment variable, so calls run by worker processes are recorded
+# too, and collect_metrics gathers them in a JSON report per run
+
+METRICS_FILE_VARIABLE = "PIPELINE_METRICS_FILE"
+TRACE_MEMORY_VARIABLE = "PIPELINE_TRACE_MEMORY"
+# Instrumented calls running in the current thread, to attribute the memory peaks of nested calls
+instrumented_calls = threading.local()
+
+
+# Bytes read and written by the process so far, None where /proc is not available
+def read_io_counters():
+    try:
+        with open("/proc/self/io") as f:
+            counters = dict(line.split(": ") for line in f.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except (OSError, KeyError):
+        return None, None
+
+
+# Number of rows of the dataframes among values, None when there is none
+def count_rows(values):
+    frames = [value for value in values if isinstance(value, pd.DataFrame)]
+    return sum(len(frame) for frame in frames) if frames else None
+
+
+# Record the metrics of every call of the function when metrics are collected. CPU time, memory and
+# bytes are counters of the process, so they include the work of other threads running meanwhile.
+# With memory tracing the peak of the memory allocated during the call is recorded as well
+def instrument(function):
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        metrics_file = os.environ.get(METRICS_FILE_VARIABLE)
+        if not metrics_file:
+            return function(*args, **kwargs)
+
+        trace_memory = os.environ.get(TRACE_MEMORY_VARIABLE) == "1"
+        stack = instrumented_calls.__dict__.setdefault("stack", [])
+        if trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # The peak is reset for this call, keep the peak reached so far by the calling one
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        call = {"peak": 0}
+        stack.append(call)
+
+        bytes_read, bytes_written = read_io_counters()
+        started = time.time()
+        wall_time = time.perf_counter()
+        cpu_time = time.process_time()
+        try:
+            result = function(*args, **kwargs)
+        finally:
+            stack.pop()
+
+        record = {
+            "function": function.__name__,
+            "pid": os.getpid(),
+            "depth": len(stack),
+            "started": started,
+            "wall_s": time.perf_counter() - wall_time,
+            "cpu_s": time.process_time() - cpu_time,
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "rows_in": count_rows(list(args) + list(kwargs.values())),
+            "rows_out": count_rows(result if isinstance(result, (tuple, list)) else [result]),
+        }
+        bytes_read_after, bytes_written_after = read_io_counters()
+        if bytes_read is not None:
+            record["bytes_read"] = bytes_read_after - bytes_read
+            record["bytes_written"] = bytes_written_after - bytes_written
+        if trace_memory:
+            peak = max(call["peak"], tracemalloc.get_traced_memory()[1])
+            record["peak_traced_mb"] = peak / 2**20
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+
+        with open(metrics_file, "a") as f:
+            f.write(json.dumps(record) + "\n")
+        return result
+    return wrapper
+
+
+# Sum the calls of every function. Times, rows and bytes are added, memory is the maximum
+def summarize_calls(calls):
+    functions = {}
+    for call in calls:
+        summary = functions.setdefault(call["function"], {"calls": 0})
+        summary["calls"] += 1
+        for metric, value in call.items():
+            if metric in ("function", "pid", "depth", "started") or value is None:
+                continue
+            if metric in ("max_rss_mb", "peak_traced_mb"):
+                summary[metric] = max(summary.get(metric, 0), value)
+            else:
+                summary[metric] = summary.get(metric, 0) + value
+    return functions
+
+
+# Collect the metrics of the instrumented calls run within the block, and write them as a JSON report
+# in report_file: the calls, in the order they ended, and their sum per function. With trace_memory
+# the memory allocated by every call is traced, which slows the calls down. With profile_file the
+# block runs under cProfile and the statistics are written there, for pstats or snakeviz
+@contextmanager
+def collect_metrics(report_file=None, trace_memory=False, profile_file=None):
+    calls_file = f"{report_file}.calls"
+    if report_file:
+        os.makedirs(os.path.dirname(report_file) or ".", exist_ok=True)
+        if os.path.exists(calls_file):
+            os.remove(calls_file)
+        os.environ[METRICS_FILE_VARIABLE] = calls_file
+        if trace_memory:
+            os.environ[TRACE_MEMORY_VARIABLE] = "1"
+    profiler = cProfile.Profile() if profile_file else None
+    if profiler:
+        profiler.enable()
+
+    started = time.time()
+    wall_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if report_file:
+            os.environ.pop(METRICS_FILE_VARIABLE, None)
+            os.environ.pop(TRACE_MEMORY_VARIABLE, None)
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            calls = []
+            if os.path.exists(calls_file):
+                with open(calls_file) as f:
+                    calls = [json.loads(line) for line in f]
+                os.remove(calls_file)
+            with open(report_file, "w") as f:
+                json.dump({"started": started, "wall_s": time.perf_counter() - wall_time,
+                           "functions": summarize_calls(calls), "calls": calls}, f, indent=2)
+
+
+# Every layer reads and writes the partition of the day. A backfill processes other dates: the date
+# is set per thread, so the workers of a pool can process different dates
+processed_partition = threading.local()
+
+
+# Date of the partitions processed, as YYYY-MM-DD: today, unless another date is being processed
+def get_partition_date():
+    date = getattr(processed_partition, "date", None)
+    return date or pd.Timestamp("today").strftime("%Y-%m-%d")
+
+
+# Process the partitions of the given date instead of today's within the block
+@contextmanager
+def partition_date(date):
+    previous_date = getattr(processed_partition, "date", None)
+    processed_partition.date = pd.Timestamp(date).strftime("%Y-%m-%d")
+    try:
+        yield
+    finally:
+        processed_partition.date = previous_date
+
+
+# Run the task on the partitions of the given date, in a worker of a pool
+def run_on_partition_date(date, task):
+    with partition_date(date):
+        return task()
 
 
 # Creates three directories for the medallion architecture, gold, silver, and bronze, within the data directory
@@ -15,16 +222,937 @@ def create_layers():
             os.makedirs(directory_path)
 
 
+# Run the tasks, functions without arguments, on a pool of workers and return their results in order.
+# With a single worker the tasks run one after the other in the calling thread
+def run_parallel(tasks, workers=None, executor=None):
+    workers = workers or PIPELINE_WORKERS
+    executor = executor or PIPELINE_EXECUTOR
+    if workers <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+
+    # The workers process the partitions of the same date as the caller
+    date = getattr(processed_partition, "date", None)
+    if date is not None:
+        tasks = [partial(run_on_partition_date, date, task) for task in tasks]
+
+    pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    with pool_class(max_workers=min(workers, len(tasks))) as pool:
+        futures = [pool.submit(task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+# ----------------- Storage -----------------
+# Tables are stored as CSV files, readable by any tool, as Parquet files, which are compressed,
+# keep the dtypes of the columns and can be read column by column, or as Arrow IPC files. Arrow files
+# are not compressed and are read through a memory map: the columns and rows selected are views on the
+# mapped pages, which processes reading the same file share through the page cache, and numeric
+# columns without missing values reach pandas without being copied
+
+# Format of the tables written by every layer, "csv", "parquet" or "arrow"
+STORAGE_FORMAT = "csv"
+STORAGE_FORMATS = ["csv", "parquet", "arrow"]
+# Formats written through arrow, whose tables may be directories of part files
+ARROW_FORMATS = ["parquet", "arrow"]
+PARQUET_COMPRESSION = "zstd"
+
+
+# Find the file of the table stored at path, given without extension. The configured format is
+# preferred, but tables written before a format change are still found
+def find_table_file(path):
+    for storage_format in [STORAGE_FORMAT] + [f for f in STORAGE_FORMATS if f != STORAGE_FORMAT]:
+        file_path = f"{path}.{storage_format}"
+        if os.path.exists(file_path):
+            return file_path
+    return None
+
+
+# Write the dataframe as a table at path, given without extension, in the configured format
+def write_table(df, path, storage_format=None):
+    storage_format = storage_format or STORAGE_FORMAT
+    if storage_format == "parquet":
+        df.to_parquet(f"{path}.parquet", index=False, compression=PARQUET_COMPRESSION)
+    elif storage_format == "arrow":
+        write_arrow_file(to_arrow_table(df), f"{path}.arrow")
+    else:
+        df.to_csv(f"{path}.csv", index=False)
+
+
+# Read a table file, only the given columns when columns is set and only the rows of the rows slice
+# when it is set. A table may also be a directory of part files, see the commit log, read from the
+# given part_paths when they are already listed. Arrow files are mapped, so only the pages of the
+# selected columns and rows are read, and the numeric columns of rows within a single part are views
+# of the mapped file. Rows spanning several parts are copied once, when their parts are joined
+def read_table_file(file_path, columns=None, dtype=None, rows=None, part_paths=None):
+    part_paths = list_part_files(file_path) if part_paths is None else part_paths
+    fetch_remote_files(part_paths)
+    if file_path.endswith(".arrow"):
+        table = map_arrow_file(file_path, columns, part_paths)
+        if rows is not None:
+            start, stop, _ = rows.indices(table.num_rows)
+            table = table.slice(start, max(stop - start, 0))
+        df = table.to_pandas(split_blocks=True)
+    elif file_path.endswith(".parquet"):
+        tables = [pq.read_table(part_path, columns=columns) for part_path in part_paths]
+        df = (pa.concat_tables(tables, promote_options="permissive") if len(tables) > 1 else tables[0]).to_pandas()
+        df = df.iloc[rows].reset_index(drop=True) if rows is not None else df
+    else:
+        if len(part_paths) > 1:
+            df = pd.concat([pd.read_csv(part_path, usecols=columns, dtype=dtype) for part_path in part_paths],
+                           ignore_index=True)
+            df = df.iloc[rows].reset_index(drop=True) if rows is not None else df
+        else:
+            # Only the lines up to the end of the range are parsed
+            skiprows = range(1, rows.start + 1) if rows is not None and rows.start else None
+            nrows = rows.stop - (rows.start or 0) if rows is not None and rows.stop is not None else None
+            df = pd.read_csv(part_paths[0], usecols=columns, dtype=dtype, skiprows=skiprows, nrows=nrows)
+        return df[columns] if columns is not None else df
+    return df.astype(dtype) if dtype is not None else df
+
+
+# List the files of a table, its part files when it is a directory: the parts of its last committed
+# version when it has a commit log, all of them otherwise. The parts of a partition are listed by the
+# log of its partitioned table
+def list_part_files(file_path):
+    table_path = get_partition_table_path(file_path)
+    if table_path is not None and os.path.isdir(get_log_path(table_path)):
+        prefix = f"{os.path.relpath(file_path, table_path)}/"
+        return [f"{table_path}/{part}" for part in read_table_log(table_path)[1] if part.startswith(prefix)]
+    if not os.path.isdir(file_path):
+        return [file_path]
+    if os.path.isdir(get_log_path(file_path)):
+        return [f"{file_path}/{part}" for part in read_table_log(file_path)[1]]
+    return [f"{file_path}/{part}" for part in sorted(os.listdir(file_path))]
+
+
+# Map an arrow table file as an arrow table, only the given columns when columns is set. Nothing is
+# read until the data is used, and the parts of a directory, or the given part_paths, are chained
+# without being copied
+def map_arrow_file(file_path, columns=None, part_paths=None):
+    part_paths = list_part_files(file_path) if part_paths is None else part_paths
+    fetch_remote_files(part_paths)
+    tables = [pa.ipc.open_file(pa.memory_map(part_path)).read_all() for part_path in part_paths]
+    table = pa.concat_tables(tables) if len(tables) > 1 else tables[0]
+    return table.select(columns) if columns is not None else table
+
+
+# Write an arrow table as an arrow file, or as a parquet file when the path ends with .parquet
+def write_arrow_file(table, file_path):
+    if file_path.endswith(".parquet"):
+        pq.write_table(table, file_path, compression=PARQUET_COMPRESSION)
+        return
+    with open_arrow_writer(file_path, "arrow", table.schema) as writer:
+        writer.write_table(table.cast(writer.schema))
+
+
+# Open a writer of record batches with the given schema, for a parquet or arrow file. An arrow file
+# holds a single dictionary per column, which batches written from different dataframes do not share,
+# so categorical columns are stored as their values there
+def open_arrow_writer(file_path, storage_format, schema):
+    if storage_format == "parquet":
+        return pq.ParquetWriter(file_path, schema, compression=PARQUET_COMPRESSION)
+    schema = pa.schema([pa.field(field.name, field.type.value_type) if pa.types.is_dictionary(field.type)
+                        else field for field in schema], metadata=schema.metadata)
+    writer = pa.ipc.new_file(file_path, schema)
+    # Unlike parquet writers, arrow file writers do not expose the schema of their file
+    writer.schema = schema
+    return writer
+
+
+# Read the arrow schema of a parquet or arrow file, of its first part when it is a directory
+def read_arrow_schema(file_path):
+    file_path = list_part_files(file_path)[0]
+    fetch_remote_files([file_path])
+    if file_path.endswith(".arrow"):
+        return pa.ipc.open_file(pa.memory_map(file_path)).schema
+    return pq.read_schema(file_path)
+
+
+# Read a table file in chunks of at most chunk_size rows, without loading the whole file
+def iter_table_file_chunks(file_path, chunk_size):
+    if file_path.endswith(".arrow"):
+        table = map_arrow_file(file_path)
+        for start in range(0, table.num_rows, chunk_size):
+            yield table.slice(start, chunk_size).to_pandas(split_blocks=True)
+    elif file_path.endswith(".parquet"):
+        part_paths = list_part_files(file_path)
+        fetch_remote_files(part_paths)
+        for part_path in part_paths:
+            for batch in pq.ParquetFile(part_path).iter_batches(batch_size=chunk_size):
+                yield batch.to_pandas()
+    elif os.path.isdir(file_path):
+        for part_path in list_part_files(file_path):
+            yield from iter_table_file_chunks(part_path, chunk_size)
+    else:
+        fetch_remote_files([file_path])
+        try:
+            yield from pd.read_csv(file_path, chunksize=chunk_size)
+        except pd.errors.EmptyDataError:
+            return
+
+
+# Concatenate table files with the same columns into a single file, one file at a time
+def concat_table_files(file_paths, file_path):
+    storage_format = os.path.splitext(file_path)[1][1:]
+    if storage_format in ARROW_FORMATS:
+        if not file_paths:
+            return
+        # A column missing in every row of a part has no type there and dates may be stored with different
+        # units, the parts are cast to the widest types
+        schema = pa.unify_schemas([normalize_arrow_schema(read_arrow_schema(part_path)) for part_path in file_paths],
+                                  promote_options="permissive")
+        with open_arrow_writer(file_path, storage_format, schema) as writer:
+            for part_path in file_paths:
+                table = map_arrow_file(part_path) if storage_format == "arrow" else pq.read_table(part_path)
+                writer.write_table(table.select(schema.names).cast(schema))
+        return
+
+    with open(file_path, "w", newline="") as f:
+        for number, part_path in enumerate(file_paths):
+            with open(part_path, newline="") as part:
+                header = part.readline()
+                if number == 0:
+                    f.write(header)
+                shutil.copyfileobj(part, f)
+
+
+# Convert a dataframe to an arrow table, cast to schema when given. Categorical columns get int32
+# dictionary indices whatever their number of categories, so parts of a table written from different
+# dataframes share the same schema
+def to_arrow_table(df, schema=None):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    schema = schema or normalize_arrow_schema(table.schema)
+    return table.select(schema.names).cast(schema)
+
+
+def normalize_arrow_schema(schema):
+    fields = [pa.field(field.name, pa.dictionary(pa.int32(), field.type.value_type))
+              if pa.types.is_dictionary(field.type) else field for field in schema]
+    return pa.schema(fields, metadata=schema.metadata)
+
+
+# Read the column names of a table file without reading its rows
+def read_table_columns(file_path):
+    if file_path.endswith(tuple(f".{f}" for f in ARROW_FORMATS)):
+        return read_arrow_schema(file_path).names
+    part_path = list_part_files(file_path)[0]
+    fetch_remote_files([part_path])
+    return list(pd.read_csv(part_path, nrows=0).columns)
+
+
+# Read the table stored at path, given without extension, in whatever format it was written
+def read_table(path, columns=None, rows=None):
+    file_path = find_table_file(path)
+    if file_path is None:
+        raise FileNotFoundError(f"No table found at {path}")
+    return read_table_file(file_path, columns, rows=rows)
+
+
+# Append rows to a table, with a commit adding a part file with the rows and the given metadata.
+# Returns the version committed
+def append_table_rows(df, file_path, metadata=None):
+    return commit_table(file_path, [write_appended_part(df, file_path)], metadata=metadata)
+
+
+# Write rows to append to a table as a new part, with the columns, and for parquet and arrow the schema,
+# of the parts already there. Returns the name of the part, which a commit still has to add
+def write_appended_part(df, file_path):
+    if os.path.isfile(file_path):
+        migrate_table_file(file_path)
+    os.makedirs(file_path, exist_ok=True)
+    if list_part_files(file_path):
+        df = df[read_table_columns(file_path)]
+    return write_table_part(df, file_path, keep_schema=True)
+
+
+# Open a writer for a table written in chunks at file_path. The first chunk defines the layout of the table
+def open_chunk_writer(file_path, storage_format, df_chunk):
+    if storage_format in ARROW_FORMATS:
+        return open_arrow_writer(file_path, storage_format, to_arrow_table(df_chunk).schema)
+    f = open(file_path, "w", newline="")
+    df_chunk.iloc[:0].to_csv(f, index=False)
+    return f
+
+
+# Write a chunk of rows with a writer opened by open_chunk_writer
+def write_chunk(writer, df_chunk):
+    if isinstance(writer, (pq.ParquetWriter, pa.ipc.RecordBatchFileWriter)):
+        writer.write_table(to_arrow_table(df_chunk.reindex(columns=writer.schema.names), writer.schema))
+    else:
+        df_chunk.to_csv(writer, index=False, header=False)
+
+
+# Schema of a parquet or arrow table written in chunks, widened to hold a later chunk: its new columns
+# are appended, and the types of its values wider than the rows written so far are promoted, like float
+# amounts of nested transactions after integer ones, or values of a column only missing so far. None when
+# the chunk fits the table as written, and for CSV tables, which have no types
+def get_widened_schema(writer, df_chunk):
+    if not isinstance(writer, (pq.ParquetWriter, pa.ipc.RecordBatchFileWriter)):
+        return None
+    schema = pa.unify_schemas([writer.schema, to_arrow_table(df_chunk).schema], promote_options="permissive")
+    return None if schema.equals(writer.schema) else schema
+
+
+# Widen a table written in chunks to the new columns of a later chunk, and for parquet and arrow to the
+# widened schema. The rows written so far are copied to a new file, with the new columns appended and
+# missing in these rows, and the writer of the new file is returned. Rows are copied as written: arrow
+# batches get null columns and are cast to the schema, and CSV rows are read back as text
+def widen_chunk_writer(writer, file_path, storage_format, new_columns, schema=None):
+    writer.close()
+    narrow_file_path = f"{file_path}.narrow.{storage_format}"
+    os.replace(file_path, narrow_file_path)
+    if storage_format in ARROW_FORMATS:
+        widened = open_arrow_writer(file_path, storage_format, schema)
+        with pa.memory_map(narrow_file_path) as source:
+            if storage_format == "parquet":
+                batches = pq.ParquetFile(source).iter_batches(BRONZE_CHUNK_SIZE)
+            else:
+                reader = pa.ipc.open_file(source)
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            for batch in batches:
+                table = pa.Table.from_batches([batch])
+                for field in schema:
+                    if field.name not in table.schema.names:
+                        table = table.append_column(field, pa.nulls(table.num_rows, field.type))
+                widened.write_table(table.cast(schema))
+    else:
+        columns = list(pd.read_csv(narrow_file_path, nrows=0).columns) + new_columns
+        widened = open(file_path, "w", newline="")
+        pd.DataFrame(columns=columns).to_csv(widened, index=False)
+        for df_written in pd.read_csv(narrow_file_path, dtype=str, keep_default_na=False, chunksize=BRONZE_CHUNK_SIZE):
+            df_written.reindex(columns=columns).to_csv(widened, index=False, header=False)
+    os.remove(narrow_file_path)
+    return widened
+
+
+# ---------------------- Commit log ----------------------
+# Tables written a load at a time, the gold tables, are directories of immutable part files and a log
+# of commits. Every commit is a numbered JSON file of the log, listing the parts it adds and the parts
+# it removes, and is published in a single step, so the table is the replay of its log: a crash while a
+# part is written leaves a file no commit lists, and readers see the parts of a committed version,
+# without locks. Removed parts stay on disk for the readers of earlier versions, until compaction
+# deletes them. Tables written before the log are read from all their files, and get a log on the
+# first commit
+
+TABLE_LOG_DIRECTORY = "_log"
+# Parts smaller than this are merged by compaction
+COMPACTION_TARGET_SIZE = 64 * 2**20
+# Seconds a removed part, or a part no commit lists, is kept before compaction deletes it
+COMPACTION_RETENTION = 3600
+
+
+# Path of the commit log of a table
+def get_log_path(file_path):
+    return f"{file_path}/{TABLE_LOG_DIRECTORY}"
+
+
+# Replay the commit log of a table. Returns its last version, -1 without commits, the parts of that
+# version in the order of their rows, and the parts removed by then with the time of their removal.
+# The parts added by a commit take the place of the first part it removes, or go last
+def read_table_log(file_path):
+    version, parts, removed = -1, [], {}
+    for version, commit in read_table_commits(file_path):
+        positions = [parts.index(part) for part in commit["remove"] if part in parts]
+        position = min(positions) if positions else len(parts)
+        kept = [part for part in parts[:position] if part not in commit["remove"]]
+        parts = kept + commit["add"] + [part for part in parts[position:] if part not in commit["remove"]]
+        removed.update((part, commit["timestamp"]) for part in commit["remove"])
+    return version, parts, removed
+
+
+# Versions of the commits of the log of a table, in order
+def list_table_versions(file_path):
+    log_path = get_log_path(file_path)
+    if not os.path.isdir(log_path):
+        return []
+    return sorted(int(os.path.splitext(name)[0]) for name in os.listdir(log_path) if name.endswith(".json"))
+
+
+# Last committed version of a table, -1 without commits
+def get_table_version(file_path):
+    versions = list_table_versions(file_path)
+    return versions[-1] if versions else -1
+
+
+# Read the commits of a table after the given version, in order, with their version. The commits up to
+# the version are not read
+def read_table_commits(file_path, after=-1):
+    commits = []
+    for version in list_table_versions(file_path):
+        if version > after:
+            with open(f"{get_log_path(file_path)}/{version:020d}.json") as f:
+                commits.append((version, json.load(f)))
+    return commits
+
+
+# Metadata given to the last commit of a table that has some, None when no commit has any. Commits are
+# read from the last one
+def read_table_metadata(file_path):
+    for version in reversed(list_table_versions(file_path)):
+        with open(f"{get_log_path(file_path)}/{version:020d}.json") as f:
+            commit = json.load(f)
+        if commit.get("metadata") is not None:
+            return commit["metadata"]
+    return None
+
+
+# Write the rows as a new part file of a table directory, with the schema of the parts already there
+# when keep_schema is set. Returns the name of the part, which a commit still has to add
+def write_table_part(df, file_path, keep_schema=False):
+    storage_format = os.path.splitext(file_path)[1][1:]
+    part = f"part-{uuid.uuid4().hex}.{storage_format}"
+    if storage_format not in ARROW_FORMATS:
+        df.to_csv(f"{file_path}/{part}", index=False)
+    elif keep_schema and list_part_files(file_path):
+        write_arrow_file(to_arrow_table(df, normalize_arrow_schema(read_arrow_schema(file_path))),
+                         f"{file_path}/{part}")
+    else:
+        write_arrow_file(to_arrow_table(df), f"{file_path}/{part}")
+    return part
+
+
+# Commit parts added to and removed from a table. The commit is written aside and linked as the next
+# version of the log, which fails when another writer committed that version first: the commit is then
+# retried on top of the new version, unless one of the parts it removes is gone. Returns the version
+# committed. The first commit of a table written before the log adds the files already there. Metadata
+# is stored with the commit, so it is published in the same step as the parts. The parts of a partition
+# are committed to the log of its partitioned table, by their path from the table
+def commit_table(file_path, add, remove=(), operation="append", metadata=None):
+    table_path = get_partition_table_path(file_path)
+    if table_path is not None:
+        prefix = os.path.relpath(file_path, table_path)
+        return commit_table(table_path, [f"{prefix}/{part}" for part in add],
+                            [f"{prefix}/{part}" for part in remove], operation, metadata)
+
+    log_path = get_log_path(file_path)
+    version, parts, _ = read_table_log(file_path)
+    if version < 0 and operation != "migrate":
+        if is_partitioned_table(file_path):
+            migrate_partitioned_table(file_path)
+            version, parts, _ = read_table_log(file_path)
+        else:
+            add = [name for name in sorted(os.listdir(file_path))
+                   if name != TABLE_LOG_DIRECTORY and name not in add] + list(add)
+    os.makedirs(log_path, exist_ok=True)
+
+    tmp_commit_path = f"{log_path}/.{uuid.uuid4().hex}.tmp"
+    with open(tmp_commit_path, "w") as f:
+        commit = {"operation": operation, "timestamp": time.time(), "add": list(add), "remove": list(remove)}
+        if metadata is not None:
+            commit["metadata"] = metadata
+        json.dump(commit, f)
+    try:
+        while True:
+            try:
+                os.link(tmp_commit_path, f"{log_path}/{version + 1:020d}.json")
+                return version + 1
+            except FileExistsError:
+                version, parts, _ = read_table_log(file_path)
+                if not set(remove) <= set(parts):
+                    raise RuntimeError(f"Parts removed from {file_path} by a concurrent commit")
+    finally:
+        os.remove(tmp_commit_path)
+
+
+# Turn a table stored as a single file by an older version into a directory with a log, whose first
+# part is the file. The directory is built aside and moved in place once
+def migrate_table_file(file_path):
+    root, extension = os.path.splitext(file_path)
+    tmp_file_path = f"{root}.tmp{extension}"
+    shutil.rmtree(tmp_file_path, ignore_errors=True)
+    os.makedirs(tmp_file_path)
+    part = f"part-{uuid.uuid4().hex}{extension}"
+    os.link(file_path, f"{tmp_file_path}/{part}")
+    commit_table(tmp_file_path, [part], operation="migrate")
+    os.remove(file_path)
+    os.replace(tmp_file_path, file_path)
+
+
+# Replace the rows of a table with the given rows, in a single commit removing every part, with the
+# given metadata. Returns the version committed
+def rewrite_table(df, file_path, metadata=None):
+    if os.path.isfile(file_path):
+        migrate_table_file(file_path)
+    os.makedirs(file_path, exist_ok=True)
+    removed = [os.path.basename(part_path) for part_path in list_part_files(file_path)]
+    part = write_table_part(df, file_path)
+    return commit_table(file_path, [part], removed, "overwrite", metadata)
+
+
+# Delete the parts of a table removed more than retention seconds ago, and the parts no commit lists,
+# left by failed writes, once as old. The parts of a partition are found in the log of its partitioned
+# table. Tables without a log are left alone
+def vacuum_table(file_path, retention=COMPACTION_RETENTION):
+    log_table_path = get_partition_table_path(file_path) or file_path
+    prefix = f"{os.path.relpath(file_path, log_table_path)}/" if log_table_path != file_path else ""
+    if not os.path.isdir(get_log_path(log_table_path)):
+        return []
+    _, parts, removed = read_table_log(log_table_path)
+    now = time.time()
+    deleted = []
+    for name in sorted(os.listdir(file_path)):
+        if name == TABLE_LOG_DIRECTORY or f"{prefix}{name}" in parts:
+            continue
+        part_path = f"{file_path}/{name}"
+        removed_at = removed.get(f"{prefix}{name}", os.path.getmtime(part_path))
+        if now - removed_at >= retention:
+            os.remove(part_path)
+            deleted.append(name)
+    return deleted
+
+
+# Compact a table: every run of consecutive parts smaller than target_size is merged into a single
+# part, without the rows repeated within the run, or the rows of a key already seen when key is set,
+# or with the rows of the run merged by merge when it is set, and committed in place of the run. Appends committed meanwhile are kept, since only the merged parts
+# are removed. Returns the number of parts merged
+def compact_table(file_path, key=None, target_size=COMPACTION_TARGET_SIZE, retention=COMPACTION_RETENTION,
+                  merge=None):
+    if not os.path.isdir(file_path):
+        return 0
+    runs, run = [], []
+    for part_path in list_part_files(file_path) + [None]:
+        if part_path is not None and os.path.getsize(part_path) < target_size:
+            run.append(part_path)
+            continue
+        if len(run) > 1:
+            runs.append(run)
+        run = []
+
+    merged = 0
+    for run in runs:
+        df = pd.concat([read_table_file(part_path) for part_path in run], ignore_index=True)
+        if merge is not None:
+            df = merge(df)
+        else:
+            df = df.drop_duplicates(key) if key is not None else df.drop_duplicates()
+        part = write_table_part(df, file_path, keep_schema=True)
+        commit_table(file_path, [part], [os.path.basename(part_path) for part_path in run], "compact")
+        merged += len(run)
+    vacuum_table(file_path, retention)
+    return merged
+
+
+# ----------------- Schemas -----------------
+# Dtypes of the columns of the tables of every layer, applied when the tables are loaded and saved,
+# instead of the dtypes pandas infers from the files. Columns not listed keep the inferred dtype.
+# - "category": strings repeated on many rows, stored once with an integer code per row
+# - "string": plain strings, for tables of distinct rows derived from categorical columns
+# - "datetime": dates, parsed once instead of kept as strings
+# - numeric dtypes: integers downcast to int32, "Int32" when they may be missing. Amounts stay
+#   float64, since they are summed and compared with the totals of the customers
+
+TABLE_SCHEMAS = {
+    "bronze": {
+        "data": {"signup_date": "datetime", "last_purchase": "datetime", "total_spent": "float64"},
+        "transactions": {"date": "datetime", "amount": "float64", "product_id": "category",
+                         "product_name": "category", "customer_id": "category", "customer_row": "int32"},
+    },
+    "silver": {
+        "denormalized": {"date": "datetime", "amount": "float64", "product_id": "category",
+                         "product_name": "category", "customer_id": "category", "customer_name": "category",
+                         "customer_email": "category", "signup_date": "datetime", "last_purchase": "datetime",
+                         "total_spent": "float64"},
+        "transactions": {"date": "datetime", "amount": "float64", "product_id": "category",
+                         "customer_id": "category"},
+        "customers": {"customer_id": "string", "customer_name": "string", "customer_email": "string",
+                      "signup_date": "datetime"},
+        "products": {"product_id": "string", "product_name": "string"},
+    },
+    "gold": {
+        "fact_transactions": {"date": "datetime", "amount": "float64", "product_key": "Int32",
+                              "customer_key": "Int32"},
+        "dimension_customers": {"customer_key": "Int32", "customer_id": "string", "customer_name": "string",
+                                "customer_email": "string", "signup_date": "datetime", "valid_from": "datetime",
+                                "valid_to": "datetime"},
+        "dimension_products": {"product_key": "Int32", "product_id": "string", "product_name": "string"},
+        "agg_customer_spend": {"customer_key": "Int32", "transactions": "int64", "total_spent": "float64",
+                               "first_transaction_date": "datetime", "last_transaction_date": "datetime"},
+        "agg_product_revenue": {"product_key": "Int32", "transactions": "int64", "revenue": "float64"},
+        "agg_daily_revenue": {"date": "datetime", "transactions": "int64", "revenue": "float64"},
+    },
+}
+
+
+# Convert the columns of a table of a layer to the dtypes of its schema. Values that can not be
+# converted become missing values, which the sanity checks report
+def apply_schema(df, layer, table_name):
+    converted = {}
+    for column, dtype in TABLE_SCHEMAS.get(layer, {}).get(table_name, {}).items():
+        if column not in df.columns or df[column].dtype == dtype:
+            continue
+        if dtype == "datetime":
+            if not pd.api.types.is_datetime64_any_dtype(df[column]):
+                converted[column] = pd.to_datetime(df[column], errors="coerce")
+        elif dtype == "category":
+            converted[column] = df[column].astype("category")
+        elif dtype == "string":
+            if isinstance(df[column].dtype, pd.CategoricalDtype):
+                converted[column] = df[column].astype(df[column].cat.categories.dtype)
+        else:
+            converted[column] = pd.to_numeric(df[column], errors="coerce").astype(dtype)
+    return df.assign(**converted) if converted else df
+
+
+# ----------------- Statistics -----------------
+# Every table written by the bronze and silver layers gets a sidecar, <table>.stats.json, with a summary
+# of its columns: the number of values and missing values, the min and max, the mean and variance of
+# numeric columns, and sketches of the distinct values and of the quantiles. Summaries of chunks and
+# of partitions are merged without their rows: means and variances with the pairwise formula of Chan
+# et al., distinct values with HyperLogLog registers and quantiles with weighted centroids. Profiling a
+# table across partitions merges their sidecars, and readers skip the partitions whose min and max
+# exclude the values they look for
+
+# Bits of the hash of a value indexing the registers of the distinct value sketch. 2**11 registers
+# estimate the number of distinct values with a standard error of about 2%
+DISTINCT_SKETCH_PRECISION = 11
+# Centroids kept by the quantile sketch of a numeric column
+QUANTILE_SKETCH_SIZE = 256
+# Quantiles reported by the profiles of the tables
+PROFILE_QUANTILES = [0.25, 0.5, 0.75]
+
+
+# Path of the statistics of the table stored at path, given without extension
+def get_statistics_path(path):
+    return f"{path}.stats.json"
+
+
+# Kind of summary of a column: "numeric", "datetime" or "string", None for other values, like the
+# nested transactions of the bronze layer
+def get_column_kind(series):
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return "string"
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_numeric_dtype(series):
+        return "numeric"
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return "datetime"
+    if pd.api.types.infer_dtype(series, skipna=True) in ("string", "empty"):
+        return "string"
+    return None
+
+
+# Registers of the distinct value sketch of the values. Every value sets the register indexed by the
+# first bits of its hash to the position of the first one bit that follows, at most; a value repeated
+# sets the same register again, so distinct values only need to be hashed once
+def build_distinct_sketch(values):
+    registers = np.zeros(2**DISTINCT_SKETCH_PRECISION, dtype=np.uint8)
+    if len(values):
+        hashes = pd.util.hash_array(np.asarray(values), categorize=False)
+        index = (hashes >> np.uint64(64 - DISTINCT_SKETCH_PRECISION)).astype(np.intp)
+        bits = (hashes >> np.uint64(32 - DISTINCT_SKETCH_PRECISION)) & np.uint64(0xFFFFFFFF)
+        # frexp gives the number of bits of the 32 bits that follow the index, exactly in a float64
+        ranks = 33 - np.frexp(bits.astype(np.float64))[1]
+        np.maximum.at(registers, index, ranks.astype(np.uint8))
+    return registers
+
+
+def encode_distinct_sketch(registers):
+    return base64.b64encode(registers.tobytes()).decode()
+
+
+def decode_distinct_sketch(sketch):
+    return np.frombuffer(base64.b64decode(sketch), dtype=np.uint8)
+
+
+# Estimate the number of distinct values from the registers of a sketch, counting the empty registers
+# when few are set
+def estimate_distinct(registers):
+    size = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / size) * size * size / np.sum(np.exp2(-registers.astype(np.float64)))
+    empty = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * size and empty:
+        estimate = size * np.log(size / empty)
+    return int(round(estimate))
+
+
+# Compress weighted values into at most QUANTILE_SKETCH_SIZE centroids of about the same weight, in
+# the order of the values
+def compress_centroids(values, weights):
+    order = np.argsort(values, kind="stable")
+    values, weights = values[order], weights[order]
+    if len(values) > QUANTILE_SKETCH_SIZE:
+        cumulative = np.cumsum(weights)
+        bins = np.minimum(((cumulative - weights / 2) * QUANTILE_SKETCH_SIZE / cumulative[-1]).astype(np.intp),
+                          QUANTILE_SKETCH_SIZE - 1)
+        totals = np.bincount(bins, weights, QUANTILE_SKETCH_SIZE)
+        sums = np.bincount(bins, weights * values, QUANTILE_SKETCH_SIZE)
+        kept = totals > 0
+        values, weights = sums[kept] / totals[kept], totals[kept]
+    return {"values": values.tolist(), "weights": weights.tolist()}
+
+
+# Estimate quantiles from the centroids of a quantile sketch, interpolating between their centers
+def estimate_quantiles(centroids, quantiles):
+    values, weights = np.array(centroids["values"]), np.array(centroids["weights"])
+    centers = np.cumsum(weights) - weights / 2
+    return np.interp(np.array(quantiles) * weights.sum(), centers, values).tolist()
+
+
+# Summarize the values of a column. Returns None for columns of values that can not be summarized
+def summarize_column(series):
+    kind = get_column_kind(series)
+    if kind is None:
+        return None
+    values = series.dropna()
+    summary = {"kind": kind, "count": len(values), "null_count": len(series) - len(values), "min": None, "max": None}
+    if kind == "string":
+        # Categorical columns are summarized from the categories they use
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            distinct = values.cat.categories[np.unique(values.cat.codes)]
+        else:
+            distinct = values.unique()
+        distinct = pd.Index(distinct).astype(str)
+        sketch_values = np.asarray(distinct, dtype=object)
+        if len(distinct):
+            summary["min"], summary["max"] = str(distinct.min()), str(distinct.max())
+    elif kind == "datetime":
+        sketch_values = values.astype("datetime64[ns]").to_numpy().view(np.int64)
+        if len(values):
+            summary["min"] = str(np.datetime64(int(sketch_values.min()), "ns"))
+            summary["max"] = str(np.datetime64(int(sketch_values.max()), "ns"))
+    else:
+        sketch_values = values.to_numpy(dtype=np.float64)
+        mean = float(sketch_values.mean()) if len(values) else 0.0
+        summary.update(mean=mean, m2=float(np.sum((sketch_values - mean) ** 2)),
+                       quantiles=compress_centroids(sketch_values, np.ones(len(sketch_values))))
+        if len(values):
+            summary["min"], summary["max"] = float(sketch_values.min()), float(sketch_values.max())
+    summary["distinct"] = encode_distinct_sketch(build_distinct_sketch(sketch_values))
+    return summary
+
+
+# Merge the summaries of the values of a column in two tables. A column without values in one of them
+# keeps the summary of the other, columns with values of different kinds only keep their counts
+def merge_column_summaries(summary, other):
+    counts = {"count": summary["count"] + other["count"], "null_count": summary["null_count"] + other["null_count"]}
+    if other["count"] == 0 or summary["count"] == 0:
+        return {**(summary if other["count"] == 0 else other), **counts}
+    if summary["kind"] != other["kind"]:
+        return {"kind": None, **counts, "min": None, "max": None}
+
+    merged = {"kind": summary["kind"], **counts, "min": min(summary["min"], other["min"]),
+              "max": max(summary["max"], other["max"])}
+    if summary["kind"] == "numeric":
+        delta = other["mean"] - summary["mean"]
+        merged["mean"] = summary["mean"] + delta * other["count"] / counts["count"]
+        merged["m2"] = summary["m2"] + other["m2"] + delta**2 * summary["count"] * other["count"] / counts["count"]
+        merged["quantiles"] = compress_centroids(
+            np.array(summary["quantiles"]["values"] + other["quantiles"]["values"]),
+            np.array(summary["quantiles"]["weights"] + other["quantiles"]["weights"]))
+    merged["distinct"] = encode_distinct_sketch(np.maximum(decode_distinct_sketch(summary["distinct"]),
+                                                           decode_distinct_sketch(other["distinct"])))
+    return merged
+
+
+# Summarize the columns of a table
+def summarize_table(df):
+    columns = {column: summarize_column(df[column]) for column in df.columns}
+    return {"rows": len(df), "columns": {column: summary for column, summary in columns.items() if summary}}
+
+
+# Merge the summaries of two tables, or chunks of a table. The rows of a table without a column count
+# as missing values of the column
+def merge_table_summaries(summary, other):
+    if summary is None or other is None:
+        return summary or other
+    columns = {}
+    for column in list(dict.fromkeys([*summary["columns"], *other["columns"]])):
+        missing = [{"kind": None, "count": 0, "null_count": table["rows"], "min": None, "max": None}
+                   for table in (summary, other)]
+        columns[column] = merge_column_summaries(summary["columns"].get(column, missing[0]),
+                                                 other["columns"].get(column, missing[1]))
+    return {"rows": summary["rows"] + other["rows"], "columns": columns}
+
+
+# Write the summary of the table stored at path, given without extension, next to it
+def write_table_statistics(summary, path):
+    with open(f"{get_statistics_path(path)}.tmp", "w") as f:
+        json.dump(summary, f)
+    os.replace(f"{get_statistics_path(path)}.tmp", get_statistics_path(path))
+
+
+def read_table_statistics(path):
+    with open(get_statistics_path(path)) as f:
+        return json.load(f)
+
+
+# Summary of a table of a partition of a layer, read from its sidecar. A table written without one, by
+# an older version, is summarized chunk by chunk once and gets its sidecar. None when there is no table
+def load_table_statistics(layer, date, table_name):
+    path = f"data/{layer}/{date}/{table_name}"
+    if os.path.exists(get_statistics_path(path)):
+        return read_table_statistics(path)
+    file_path = find_table_file(path)
+    if file_path is None:
+        return None
+    summary = {"rows": 0, "columns": {}}
+    for df_chunk in iter_table_file_chunks(file_path, BRONZE_CHUNK_SIZE):
+        summary = merge_table_summaries(summary, summarize_table(apply_schema(df_chunk, layer, table_name)))
+    write_table_statistics(summary, path)
+    return summary
+
+
+# Dates of the partitions of a layer, between start_date and end_date when they are given
+def list_layer_partitions(layer, start_date=None, end_date=None):
+    directory_path = f"data/{layer}"
+    dates = sorted(name for name in os.listdir(directory_path) if os.path.isdir(f"{directory_path}/{name}")) \
+        if os.path.isdir(directory_path) else []
+    return [date for date in dates if (start_date is None or date >= start_date) and (end_date is None or date <= end_date)]
+
+
+# Describe the columns of a summary, like DataFrame.describe: one column per column of the table, with
+# the counts, the estimated number of distinct values, the min and max, and for numeric columns the
+# mean, the standard deviation and the estimated quantiles
+def describe_statistics(summary):
+    described = {}
+    for column, column_summary in summary["columns"].items():
+        described[column] = {"count": column_summary["count"], "null_count": column_summary["null_count"],
+                             "distinct": estimate_distinct(decode_distinct_sketch(column_summary["distinct"]))
+                             if "distinct" in column_summary else None,
+                             "min": column_summary["min"], "max": column_summary["max"]}
+        if column_summary["kind"] == "numeric" and column_summary["count"]:
+            count = column_summary["count"]
+            described[column]["mean"] = column_summary["mean"]
+            described[column]["std"] = (column_summary["m2"] / (count - 1)) ** 0.5 if count > 1 else None
+            quantiles = estimate_quantiles(column_summary["quantiles"], PROFILE_QUANTILES)
+            # The centroids average the extreme values, the quantiles stay within the min and max
+            described[column].update({f"{quantile:.0%}": min(max(value, column_summary["min"]), column_summary["max"])
+                                      for quantile, value in zip(PROFILE_QUANTILES, quantiles)})
+    return pd.DataFrame(described)
+
+
+# Profile a table of a layer across its partitions, or the partitions between start_date and end_date,
+# by merging the summaries of the partitions instead of reading their rows
+@instrument
+def profile_table(layer, table_name, start_date=None, end_date=None):
+    summary = None
+    for date in list_layer_partitions(layer, start_date, end_date):
+        summary = merge_table_summaries(summary, load_table_statistics(layer, date, table_name))
+    if summary is None:
+        raise FileNotFoundError(f"No partition of {layer} has a {table_name} table")
+    return describe_statistics(summary)
+
+
+# Convert a value to the representation of the min and max of the summaries of a kind of column
+def to_statistics_value(value, kind):
+    if kind == "datetime":
+        return str(pd.to_datetime(value).to_datetime64().astype("datetime64[ns]"))
+    return float(value) if kind == "numeric" else str(value)
+
+
+# Dates of the partitions of a layer whose table may hold values of column between min_value and
+# max_value, both included. Partitions are skipped from the min and max of their summary, without
+# opening the table, and partitions where the column has no value are skipped as well
+def find_partitions(layer, table_name, column, min_value=None, max_value=None):
+    dates = []
+    for date in list_layer_partitions(layer):
+        summary = load_table_statistics(layer, date, table_name)
+        column_summary = summary["columns"].get(column) if summary is not None else None
+        if column_summary is None or column_summary["count"] == 0:
+            continue
+        if column_summary["kind"] is not None:
+            if min_value is not None and column_summary["max"] < to_statistics_value(min_value, column_summary["kind"]):
+                continue
+            if max_value is not None and column_summary["min"] > to_statistics_value(max_value, column_summary["kind"]):
+                continue
+        dates.append(date)
+    return dates
+
+
 # ----------------- Bronze Layer -----------------
 
 
 # Open the file and load the data
+@instrument
 def open_file(file):
     with open(file) as f:
         data = json.load(f)
         return data
 
 
+# Read more text from the file into the buffer, returns False once the file is exhausted
+def fill_buffer(f, buffer, block_size):
+    block = f.read(block_size)
+    return buffer + block, bool(block)
+
+
+# Skip whitespace and the given separators, reading more of the file when the buffer runs out
+def skip_separators(f, buffer, position, separators, block_size):
+    while True:
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] in separators):
+            position += 1
+        if position < len(buffer):
+            return buffer, position
+        buffer, more = fill_buffer(f, buffer[position:], block_size)
+        position = 0
+        if not more:
+            return buffer, position
+
+
+# Decode the next JSON value from the buffer, reading more of the file until the value is complete
+def decode_next(f, decoder, buffer, position, block_size):
+    while True:
+        try:
+            value, end = decoder.raw_decode(buffer, position)
+            # A number cut by the end of the buffer decodes fine but may continue in the next
+            # block, so only trust a value followed by a delimiter
+            if end < len(buffer) and (buffer[end].isspace() or buffer[end] in ",:]}"):
+                return value, buffer, end
+        except json.JSONDecodeError:
+            pass
+        buffer, more = fill_buffer(f, buffer[position:], block_size)
+        position = 0
+        if not more:
+            value, end = decoder.raw_decode(buffer, position)
+            return value, buffer, end
+
+
+# Walk the array stored under `key` of the top level JSON object, yielding one element at a time.
+# Only the element being decoded is kept in memory, so the file size does not matter
+def iter_json_array(file, key, block_size=1 << 16):
+    decoder = json.JSONDecoder()
+    with open(file) as f:
+        buffer, _ = fill_buffer(f, "", block_size)
+        buffer, position = skip_separators(f, buffer, 0, "", block_size)
+        if buffer[position:position + 1] != "{":
+            raise ValueError(f"Expected a JSON object at the top level of {file}")
+        position += 1
+
+        while True:
+            buffer, position = skip_separators(f, buffer, position, ",", block_size)
+            if buffer[position:position + 1] in ("}", ""):
+                raise KeyError(key)
+            name, buffer, position = decode_next(f, decoder, buffer, position, block_size)
+            buffer, position = skip_separators(f, buffer, position, ":", block_size)
+            if name != key:
+                # Other top level values are small, decode them and move on
+                _, buffer, position = decode_next(f, decoder, buffer, position, block_size)
+                continue
+
+            if buffer[position:position + 1] != "[":
+                raise ValueError(f"Expected a JSON array under {key!r} in {file}")
+            position += 1
+            while True:
+                buffer, position = skip_separators(f, buffer, position, ",", block_size)
+                if buffer[position:position + 1] == "]":
+                    return
+                if position >= len(buffer):
+                    raise ValueError(f"Unterminated JSON array under {key!r} in {file}")
+                # Consumed text is dropped whenever the buffer is refilled, so it stays bounded
+                element, buffer, position = decode_next(f, decoder, buffer, position, block_size)
+                yield element
+
+
+# Stream the customers of the file in lists of at most chunk_size customers
+def iter_customer_chunks(file, chunk_size=BRONZE_CHUNK_SIZE):
+    chunk = []
+    for customer in iter_json_array(file, "customers"):
+        chunk.append(customer)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
 # Check if directories exist before creating them
 def check_directory(directory_path):
     if not os.path.exists(directory_path):
@@ -44,36 +1172,280 @@ def get_basic_statistics(df):
     return df.describe()
 
 
+# Converts the customers into two tables: the customers without their transactions, and a child table
+# with one row per transaction. Every transaction keeps the customer_id, and customer_row, the position
+# of its customer in the customers table, since the source may contain the same customer more than once.
+# first_row is the position of the first customer of data, when converting a chunk of the source
+def convert_to_split_tables(data, first_row=0):
+    df_customers = convert_to_tabular(
+        [{key: value for key, value in customer.items() if key != "transactions"} for customer in data])
+    df_transactions = pd.DataFrame(
+        [{**transaction, "customer_id": customer["id"], "customer_row": row}
+         for row, customer in enumerate(data, start=first_row)
+         for transaction in customer.get("transactions", [])])
+    return df_customers, df_transactions
+
+
 # Create a folder with date of the import, within the bronze directory, and drop there the dataframe as csv file
-def save_bronze_data(df_bronze_data):
-    today = pd.Timestamp("today").strftime("%Y-%m-%d")
+@instrument
+def save_bronze_data(df_bronze_data, table_name="data"):
+    today = get_partition_date()
     directory_path = f"data/bronze/{today}"
     os.makedirs(directory_path, exist_ok=True)
-    df_bronze_data.to_csv(f"{directory_path}/data.csv", index=False)
+    df_bronze_data = apply_schema(df_bronze_data, "bronze", table_name)
+    write_table(df_bronze_data, f"{directory_path}/{table_name}")
+    write_table_statistics(summarize_table(df_bronze_data), f"{directory_path}/{table_name}")
 
-# Create the bronze layer. This runs on daily basis
 
+# Same as save_bronze_data, but the tables are written one chunk after the other as they arrive.
+# Every chunk maps the table names to the dataframes to append to them. The partition is written
+# to temporary files and only moved in place once complete
+@instrument
+def save_bronze_data_chunked(chunks):
+    today = get_partition_date()
+    directory_path = f"data/bronze/{today}"
+    os.makedirs(directory_path, exist_ok=True)
 
-def create_bronze_layer():
-    data = open_file("data/customers.json")
+    writers = {}
+    columns = {}
+    summaries = {}
+    try:
+        for chunk in chunks:
+            for table_name, df_chunk in chunk.items():
+                df_chunk = apply_schema(df_chunk, "bronze", table_name)
+                # A chunk without rows may not know the columns yet, wait for one that does. Once the table
+                # is open, chunks without rows, like the CDC chunks without changes, have nothing to write
+                if table_name not in writers and df_chunk.columns.empty:
+                    columns.setdefault(table_name, None)
+                    continue
+                if table_name in writers and df_chunk.empty:
+                    continue
+                tmp_file_path = f"{directory_path}/{table_name}.{STORAGE_FORMAT}.tmp"
+                if table_name not in writers:
+                    columns[table_name] = list(df_chunk.columns)
+                    writers[table_name] = open_chunk_writer(tmp_file_path, STORAGE_FORMAT, df_chunk)
+                # Fields first found in a later chunk, or with values of a wider type, widen the table
+                new_columns = [column for column in df_chunk.columns if column not in columns[table_name]]
+                schema = get_widened_schema(writers[table_name], df_chunk)
+                if new_columns or schema is not None:
+                    writers[table_name] = widen_chunk_writer(writers[table_name], tmp_file_path, STORAGE_FORMAT,
+                                                             new_columns, schema)
+                    columns[table_name] += new_columns
+                df_chunk = df_chunk.reindex(columns=columns[table_name])
+                write_chunk(writers[table_name], df_chunk)
+                summaries[table_name] = merge_table_summaries(summaries.get(table_name), summarize_table(df_chunk))
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    for table_name in columns:
+        file_path = f"{directory_path}/{table_name}.{STORAGE_FORMAT}"
+        if table_name in writers:
+            os.replace(f"{file_path}.tmp", file_path)
+        else:
+            write_table(pd.DataFrame(), f"{directory_path}/{table_name}")
+        write_table_statistics(summaries.get(table_name, summarize_table(pd.DataFrame())),
+                               f"{directory_path}/{table_name}")
+
+
+# Convert a list of customers into the bronze tables, keyed by table name
+def convert_to_bronze_tables(customer_data, split_transactions, first_row=0):
+    if split_transactions:
+        df_customers, df_transactions = convert_to_split_tables(customer_data, first_row)
+        return {"data": df_customers, "transactions": df_transactions}
+    return {"data": convert_to_tabular(customer_data)}
+
+
+# Convert the chunks of customers into bronze tables, keeping track of the position of every chunk
+def iter_bronze_table_chunks(file, chunk_size, split_transactions):
+    first_row = 0
+    for chunk in iter_customer_chunks(file, chunk_size):
+        yield convert_to_bronze_tables(chunk, split_transactions, first_row)
+        first_row += len(chunk)
+
+
+# ---------------------- Change Data Capture ----------------------
+# In CDC mode the bronze partition of the day only holds the customers inserted or updated since the
+# previous partition, so the silver and gold layers only process the churn. Every customer of the
+# input is hashed, and the hashes are stored in the partition as the baseline of the next day
+
+# Columns of the changes table: the id of every changed customer and "insert", "update" or "delete"
+CHANGE_COLUMNS = ["customer_id", "change_type"]
+
+
+# Hash of a customer record, including its transactions. Keys are sorted so the hash does not depend
+# on the order of the fields in the input
+def hash_customer(customer):
+    return hashlib.blake2b(json.dumps(customer, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+# Load the (customer_id, row_hash) pairs of the latest bronze partition before today with hashes.
+# Without one, every customer of the day is an insert
+def load_previous_hashes():
+    today = get_partition_date()
+    partitions = sorted(os.listdir("data/bronze")) if os.path.exists("data/bronze") else []
+    for partition in reversed(partitions):
+        file_path = find_table_file(f"data/bronze/{partition}/hashes")
+        if partition < today and file_path is not None:
+            df_hashes = read_table_file(file_path, ["customer_id", "row_hash"], dtype=str)
+            return set(zip(df_hashes["customer_id"], df_hashes["row_hash"]))
+    return set()
+
+
+# Compare chunks of customers with the hashes of the previous partition, and convert only the inserted
+# and updated customers into bronze tables. Every chunk also carries the changes and the hashes of all
+# its customers; the customers of the previous partition missing from the input are deleted at the end
+def iter_cdc_table_chunks(customer_chunks, previous_hashes, split_transactions):
+    previous_ids = {customer_id for customer_id, _ in previous_hashes}
+    seen_ids = set()
+    first_row = 0
+    for chunk in customer_chunks:
+        ids = [str(customer["id"]) for customer in chunk]
+        hashes = [hash_customer(customer) for customer in chunk]
+        changed = []
+        changes = []
+        for customer, customer_id, row_hash in zip(chunk, ids, hashes):
+            if (customer_id, row_hash) in previous_hashes:
+                continue
+            changed.append(customer)
+            changes.append({"customer_id": customer_id,
+                            "change_type": "update" if customer_id in previous_ids else "insert"})
+        seen_ids.update(ids)
+
+        tables = convert_to_bronze_tables(changed, split_transactions, first_row)
+        # Typed columns, so a chunk without changes still gives the parquet writer a string schema
+        tables["changes"] = pd.DataFrame(changes, columns=CHANGE_COLUMNS).astype("string")
+        tables["hashes"] = pd.DataFrame({"customer_id": ids, "row_hash": hashes})
+        yield tables
+        first_row += len(changed)
+
+    deleted_ids = sorted(previous_ids - seen_ids)
+    yield {"changes": pd.DataFrame({"customer_id": deleted_ids, "change_type": "delete"},
+                                   columns=CHANGE_COLUMNS).astype("string")}
+
+
+# Create the bronze layer. This runs on daily basis.
+# With streaming enabled the customers are read, converted and written chunk by chunk, so memory
+# usage depends on chunk_size and not on the size of the input file.
+# With split_transactions enabled the transactions are stored in their own transactions table,
+# instead of a stringified list in the transactions column of the customers.
+# With cdc enabled only the customers changed since the previous partition are stored, along with
+# a changes table listing the inserted, updated and deleted customers
+
+
+@instrument
+def create_bronze_layer(file="data/customers.json", streaming=False, chunk_size=BRONZE_CHUNK_SIZE,
+                        split_transactions=False, cdc=False):
+    if cdc:
+        customer_chunks = iter_customer_chunks(file, chunk_size) if streaming else [open_file(file)["customers"]]
+        save_bronze_data_chunked(iter_cdc_table_chunks(customer_chunks, load_previous_hashes(), split_transactions))
+        return
+
+    if streaming:
+        save_bronze_data_chunked(iter_bronze_table_chunks(file, chunk_size, split_transactions))
+        return
+
+    data = open_file(file)
     customer_data = data["customers"]
-    df_bronze_data = convert_to_tabular(customer_data)
-    save_bronze_data(df_bronze_data)
+    for table_name, df_bronze_data in convert_to_bronze_tables(customer_data, split_transactions).items():
+        save_bronze_data(df_bronze_data, table_name)
 
 
 # ----------------- Silver Layer -----------------
 
 
-# Load the data from the bronze layer
-def load_bronze_data():
-    today = pd.Timestamp("today").strftime("%Y-%m-%d")
+# Load the data from the bronze layer, only the given columns when columns is set
+@instrument
+def load_bronze_data(table_name="data", columns=None):
+    today = get_partition_date()
     directory_path = f"data/bronze/{today}"
-    file_path = f"{directory_path}/data.csv"
-    return pd.read_csv(file_path)
+    return apply_schema(read_table(f"{directory_path}/{table_name}", columns), "bronze", table_name)
 
 
-# Rearrage the data from the bronze to sort it by transactions. Data is stored denormalized
-def rearrange_data(df):
+# Load the transactions table of the bronze layer, None when the bronze data keeps the transactions
+# nested. Only the given columns when columns is set
+@instrument
+def load_bronze_transactions(columns=None):
+    today = get_partition_date()
+    file_path = find_table_file(f"data/bronze/{today}/transactions")
+    if file_path is None:
+        return None
+    try:
+        return apply_schema(read_table_file(file_path, columns), "bronze", "transactions")
+    except pd.errors.EmptyDataError:
+        return pd.DataFrame(columns=["customer_id", "customer_row"])
+
+
+# Load the changes table of a bronze partition created in CDC mode, None for a full snapshot
+def load_bronze_changes():
+    today = get_partition_date()
+    file_path = find_table_file(f"data/bronze/{today}/changes")
+    if file_path is None:
+        return None
+    return read_table_file(file_path, dtype=str)
+
+
+# Columns of the customer copied into every transaction, and the name they get in the denormalized table
+CUSTOMER_FIELDS = {
+    "id": "customer_id",
+    "name": "customer_name",
+    "email": "customer_email",
+    "signup_date": "signup_date",
+    "last_purchase": "last_purchase",
+    "total_spent": "total_spent",
+}
+
+
+# Parse a stringified list of transactions, as stored in the transactions column of the bronze layer.
+# The column holds the python representation of the list, which is valid JSON once the quotes are
+# swapped, unless a value contains an apostrophe; those fall back to a python literal parser.
+# Parquet files keep the column nested, those values are already parsed
+def parse_transactions(x):
+    if not isinstance(x, str):
+        return list(x)
+    try:
+        return json.loads(x.replace("'", '"'))
+    except json.JSONDecodeError:
+        return ast.literal_eval(x)
+
+
+# Turn the transactions column of the bronze layer into a table with one row per transaction, in the
+# same layout as the transactions table of the split bronze layout. Every string is parsed only once
+@instrument
+def explode_transactions(df):
+    transactions = df["transactions"].reset_index(drop=True).map(parse_transactions).explode().dropna()
+    df_transactions = pd.DataFrame(transactions.tolist())
+    df_transactions["customer_id"] = df["id"].to_numpy()[transactions.index.to_numpy()]
+    df_transactions["customer_row"] = transactions.index.to_numpy()
+    return df_transactions
+
+
+# Rearrage the data from the bronze to sort it by transactions. Data is stored denormalized.
+# Every transaction takes the fields of the customer row it belongs to. The transactions table of the
+# bronze layer is used when given, otherwise it is built from the transactions column. Only the given
+# columns of the denormalized table are built when columns is set
+@instrument
+def rearrange_data(df, df_transactions=None, columns=None):
+    if df_transactions is None:
+        df_transactions = explode_transactions(df)
+    if df_transactions.empty:
+        return pd.DataFrame()
+
+    transaction_columns = [column for column in df_transactions.columns
+                           if column not in ("customer_id", "customer_row")]
+    customer_fields = CUSTOMER_FIELDS
+    if columns is not None:
+        transaction_columns = [column for column in transaction_columns if column in columns]
+        customer_fields = {field: name for field, name in CUSTOMER_FIELDS.items() if name in columns}
+    df_customer_fields = df[list(customer_fields)].rename(columns=customer_fields)
+    df_customer_fields = df_customer_fields.iloc[df_transactions["customer_row"].to_numpy()]
+    return pd.concat([df_transactions[transaction_columns].reset_index(drop=True),
+                      df_customer_fields.reset_index(drop=True)], axis=1)
+
+
+# Row by row version of rearrange_data, it builds a dict per transaction in python. It is kept as the
+# reference for the benchmarks of the vectorized version
+def rearrange_data_rowwise(df):
     # Convert DataFrame rows to tuples
     data_tuples = df.apply(dict, axis=1).tolist()
 
@@ -94,35 +1466,36 @@ def rearrange_data(df):
 # Create raw tables for transactions, that can be used for further analysis
 
 
+@instrument
 def create_transaction_table(df):
     return df[["transaction_id", "date", "amount", "product_id", "customer_id"]]
 
 
-# Create raw tables for customers, that can be used for further analysis
+# Create raw tables for customers, that can be used for further analysis. Distinct rows are found by
+# hashing them, in the order they first appear, and rows with a missing value are left out
+@instrument
 def create_customer_table(df):
-    df_customer = df.groupby(["customer_id", "customer_name",
-                             "customer_email", "signup_date"]).size().reset_index(name="count")
-    df_customer = df_customer[["customer_id",
-                               "customer_name", "customer_email", "signup_date"]]
-    return df_customer
+    columns = ["customer_id", "customer_name", "customer_email", "signup_date"]
+    return df[columns].dropna().drop_duplicates().reset_index(drop=True)
 
 # Create raw tables for product, that can be used for further analysis
 
 
+@instrument
 def create_product_table(df):
-    df_product = df.groupby(["product_id", "product_name"]
-                            ).size().reset_index(name="count")
-    df_product = df_product[["product_id", "product_name"]]
-    return df_product
+    columns = ["product_id", "product_name"]
+    return df[columns].dropna().drop_duplicates().reset_index(drop=True)
 
 
 # Serialize the data to a csv file
+@instrument
 def save_silver_data(df, table_name):
-    today = pd.Timestamp("today").strftime("%Y-%m-%d")
+    today = get_partition_date()
     directory_path = f"data/silver/{today}"
     os.makedirs(directory_path, exist_ok=True)
-    df.to_csv(
-        f"{directory_path}/{table_name}.csv", index=False)
+    df = apply_schema(df, "silver", table_name)
+    write_table(df, f"{directory_path}/{table_name}")
+    write_table_statistics(summarize_table(df), f"{directory_path}/{table_name}")
 
 
 # ---------------------- Sanity Check ----------------------
@@ -158,65 +1531,429 @@ def get_total_spent(x):
         return 0
 
 
-def sanity_check(df):
-    # create a clone of the dataframe
-    df_sanity = df.copy()
-
-    df_sanity["signup_date"] = pd.to_datetime(df["signup_date"])
-    df_sanity["last_purchase"] = pd.to_datetime(df["last_purchase"])
-    df_sanity["total_spent"] = pd.to_numeric(df["total_spent"])
-
-    # Check that the last_purchase date is greater than the signup_date
-    df_sanity["last_purchase_vs_signup"] = df_sanity["last_purchase"] > df_sanity["signup_date"]
-
-    df_sanity["last_transaction_date"] = df_sanity["transactions"].apply(
-        lambda x: get_last_transaction(x))
-    df_sanity["total_transaction_spent"] = df_sanity["transactions"].apply(
-        lambda x: get_total_spent(x))
-
-    # Check that the last_purchase date is the same or greater than the transaction date
-    df_sanity["last_purchase_vs_transaction"] = df_sanity["last_purchase"] >= df_sanity["last_transaction_date"]
-
-    # Check that the total_spent is the sum of all the transactions for the customer
-    df_sanity["total_spent_vs_transaction"] = df_sanity["total_spent"] == df_sanity["total_transaction_spent"]
-
-    # Check that the email is a valid email
-    df_sanity["email_valid"] = df_sanity["email"].str.contains(r'[^@]+@[^@]+\.[^@]+')
+# Aggregate the transactions per customer row: date of the last transaction and total amount spent.
+# Both are computed in a single groupby, and rows without transactions get no date and a total of 0
+def aggregate_transactions(df_transactions, customers):
+    df_transactions = df_transactions.reindex(columns=["date", "amount", "customer_row"])
+    df_aggregated = pd.DataFrame({
+        "last_transaction_date": pd.to_datetime(df_transactions["date"]),
+        "total_transaction_spent": pd.to_numeric(df_transactions["amount"]),
+    }).groupby(df_transactions["customer_row"].to_numpy()).agg(
+        {"last_transaction_date": "max", "total_transaction_spent": "sum"})
+    df_aggregated = df_aggregated.reindex(pd.RangeIndex(customers))
+    df_aggregated["total_transaction_spent"] = df_aggregated["total_transaction_spent"].fillna(0)
+    return df_aggregated
+
+
+# Run all the checks on the customers of the bronze layer in one columnar pass over their transactions.
+# The transactions table is built from the transactions column when not given. The input is not copied,
+# the checked and converted columns are added to a new frame that shares the other columns: it is built
+# from the columns without copy, since assign copies every column before pandas 3
+@instrument
+def sanity_check(df, df_transactions=None):
+    if df_transactions is None:
+        df_transactions = explode_transactions(df)
+    df_aggregated = aggregate_transactions(df_transactions, len(df))
+
+    signup_date = pd.to_datetime(df["signup_date"])
+    last_purchase = pd.to_datetime(df["last_purchase"])
+    total_spent = pd.to_numeric(df["total_spent"])
+    last_transaction_date = df_aggregated["last_transaction_date"].to_numpy()
+    total_transaction_spent = df_aggregated["total_transaction_spent"].to_numpy()
+
+    columns = {column: df[column] for column in df.columns}
+    columns.update(
+        signup_date=signup_date,
+        last_purchase=last_purchase,
+        total_spent=total_spent,
+        # Check that the last_purchase date is greater than the signup_date
+        last_purchase_vs_signup=last_purchase > signup_date,
+        last_transaction_date=last_transaction_date,
+        total_transaction_spent=total_transaction_spent,
+        # Check that the last_purchase date is the same or greater than the transaction date
+        last_purchase_vs_transaction=last_purchase >= last_transaction_date,
+        # Check that the total_spent is the sum of all the transactions for the customer
+        total_spent_vs_transaction=total_spent == total_transaction_spent,
+        # Check that the email is a valid email. A chunk of the bronze data with only missing emails is not
+        # read as strings
+        email_valid=df["email"].astype(str).str.contains(r'[^@]+@[^@]+\.[^@]+'),
+    )
+    return pd.DataFrame(columns, copy=False)
+
+
+# Derive a table from the denormalized data and save it in the silver layer
+def save_silver_table(create_table, df_denormalized, table_name):
+    save_silver_data(create_table(df_denormalized), table_name)
+
+
+# Copy the changes of a bronze partition created in CDC mode to the silver layer, for the gold layer to
+# apply the updates and deletions. Returns False when no customer was inserted or updated, since the
+# partition then has no customer to process
+def save_silver_changes():
+    df_changes = load_bronze_changes()
+    if df_changes is None:
+        return True
+    save_silver_data(df_changes, "changes")
+    return bool((df_changes["change_type"] != "delete").any())
 
-    return df_sanity
 
+# Create the silver layer. This runs on daily basis.
+# The denormalization and the sanity check, and then the derivation and serialization of the five
+# tables, are independent from each other and run on a pool of workers
+@instrument
+def create_silver_layer(workers=None, executor=None):
+    if not save_silver_changes():
+        return
 
-# Create the silver layer. This runs on daily basis
-def create_silver_layer():
     df_bronze_data = load_bronze_data()
-    df_denormalized = rearrange_data(df_bronze_data)
-    df_sanitized = sanity_check(df_bronze_data)
+    df_bronze_transactions = load_bronze_transactions()
+    if df_bronze_transactions is None:
+        # Parse the nested transactions once, and share them between the denormalization and the checks
+        df_bronze_transactions = explode_transactions(df_bronze_data)
+
+    df_denormalized, df_sanitized = run_parallel([
+        partial(rearrange_data, df_bronze_data, df_bronze_transactions),
+        partial(sanity_check, df_bronze_data, df_bronze_transactions),
+    ], workers, executor)
+
+    run_parallel([
+        partial(save_silver_data, df_sanitized, "sanitation"),
+        partial(save_silver_data, df_denormalized, "denormalized"),
+        partial(save_silver_table, create_transaction_table, df_denormalized, "transactions"),
+        partial(save_silver_table, create_customer_table, df_denormalized, "customers"),
+        partial(save_silver_table, create_product_table, df_denormalized, "products"),
+    ], workers, executor)
+
+
+# ---------------------- Chunked Silver Layer ----------------------
+# Bronze partitions larger than the memory are processed in shards of customers. Every shard is
+# denormalized and checked by a worker process, which writes its part of the silver tables. The parts
+# are then merged into the five silver tables
+
+# Number of customers of every shard of the chunked silver layer
+SILVER_CHUNK_SIZE = 100_000
+# Silver tables made of the rows of every shard, and tables distinct across shards, with the function deduplicating them
+SILVER_SHARD_TABLES = ["sanitation", "denormalized", "transactions"]
+SILVER_DISTINCT_TABLES = {"customers": create_customer_table, "products": create_product_table}
+# Key the distinct tables are hash partitioned on before they are deduplicated, the repeats of a row
+# across shards share it
+SILVER_DISTINCT_KEYS = {"customers": "customer_id", "products": "product_id"}
+# Number of buckets of the distinct tables. Every bucket holds about this fraction of the distinct rows,
+# so a bucket, and not the table, has to fit in memory
+SILVER_DISTINCT_BUCKETS = 64
+# Column with the position of every row of a distinct table while it is deduplicated: the shard it
+# was found in, in the high bits, and its row in the part of the shard
+SILVER_POSITION_COLUMN = "_position"
+
+
+# Read the bronze partition in shards of customers. Every shard comes with its transactions when the
+# bronze layer has a transactions table, with customer_row relative to the shard. The transactions table
+# is sorted by customer_row, so it is read alongside the customers
+def iter_bronze_shards(directory_path, chunk_size):
+    transactions_file = find_table_file(f"{directory_path}/transactions")
+    transaction_chunks = iter_table_file_chunks(transactions_file, chunk_size) if transactions_file else None
+    df_pending = pd.DataFrame(columns=["customer_row"])
+    transactions_left = transaction_chunks is not None
+
+    first_row = 0
+    for df_customers in iter_table_file_chunks(find_table_file(f"{directory_path}/data"), chunk_size):
+        end_row = first_row + len(df_customers)
+        df_shard_transactions = None
+        if transaction_chunks is not None:
+            # Read transactions until one belongs to a later shard
+            while transactions_left and (df_pending.empty or df_pending["customer_row"].iloc[-1] < end_row):
+                df_chunk = next(transaction_chunks, None)
+                if df_chunk is None:
+                    transactions_left = False
+                else:
+                    df_pending = df_chunk if df_pending.empty else pd.concat([df_pending, df_chunk], ignore_index=True)
+            in_shard = df_pending["customer_row"] < end_row
+            df_shard_transactions = df_pending[in_shard].reset_index(drop=True)
+            df_shard_transactions["customer_row"] = df_shard_transactions["customer_row"] - first_row
+            df_pending = df_pending[~in_shard].reset_index(drop=True)
+
+        if df_shard_transactions is not None:
+            df_shard_transactions = apply_schema(df_shard_transactions, "bronze", "transactions")
+        yield apply_schema(df_customers.reset_index(drop=True), "bronze", "data"), df_shard_transactions
+        first_row = end_row
+
+
+# Denormalize and check a shard of customers, and write its part of every silver table in shards_path
+@instrument
+def process_silver_shard(shard, df_customers, df_transactions, shards_path, storage_format):
+    if df_transactions is None:
+        df_transactions = explode_transactions(df_customers)
+    df_denormalized = rearrange_data(df_customers, df_transactions)
+
+    tables = {"sanitation": sanity_check(df_customers, df_transactions)}
+    # A shard of customers without transactions has no rows in the other tables
+    if not df_denormalized.empty:
+        tables["denormalized"] = df_denormalized
+        tables["transactions"] = create_transaction_table(df_denormalized)
+        for table_name, create_table in SILVER_DISTINCT_TABLES.items():
+            tables[table_name] = create_table(df_denormalized)
+
+    for table_name, df in tables.items():
+        os.makedirs(f"{shards_path}/{table_name}", exist_ok=True)
+        df = apply_schema(df, "silver", table_name)
+        write_table(df, f"{shards_path}/{table_name}/part-{shard:06d}", storage_format)
+        if table_name in SILVER_SHARD_TABLES:
+            write_table_statistics(summarize_table(df), f"{shards_path}/{table_name}/part-{shard:06d}")
+
+
+# Deduplicate a distinct table from the parts written by the shards, out of core. The rows of every part
+# are tagged with their position and hash partitioned on the key of the table into bucket files, so the
+# repeats of a row are in the same bucket. Every bucket is deduplicated on its own, keeping the first
+# position of every row, then the buckets are merged by position a shard at a time, so the table keeps
+# the order the rows are first found in. Returns False when no part has rows
+def merge_distinct_shards(table_name, file_paths, buckets_path, file_path):
+    os.makedirs(buckets_path, exist_ok=True)
+    bucket_writers, shards = {}, []
+    try:
+        for part_path in file_paths:
+            df = read_table_file(part_path)
+            if df.empty:
+                continue
+            shards.append(int(os.path.basename(part_path).split(".")[0].split("-")[1]))
+            df[SILVER_POSITION_COLUMN] = (shards[-1] << 32) + np.arange(len(df))
+            key = df[SILVER_DISTINCT_KEYS[table_name]].astype(str)
+            buckets = pd.util.hash_pandas_object(key, index=False).to_numpy() % SILVER_DISTINCT_BUCKETS
+            for bucket, df_bucket in df.groupby(buckets, sort=True):
+                if bucket not in bucket_writers:
+                    bucket_writers[bucket] = open_chunk_writer(f"{buckets_path}/bucket-{bucket:03d}.{STORAGE_FORMAT}",
+                                                               STORAGE_FORMAT, df_bucket)
+                write_chunk(bucket_writers[bucket], df_bucket)
+    finally:
+        for writer in bucket_writers.values():
+            writer.close()
+    if not shards:
+        return False
 
-    df_transactions = create_transaction_table(df_denormalized)
-    df_customers = create_customer_table(df_denormalized)
-    df_products = create_product_table(df_denormalized)
+    cursors = []
+    for bucket in sorted(bucket_writers):
+        df = read_table_file(f"{buckets_path}/bucket-{bucket:03d}.{STORAGE_FORMAT}")
+        df = df[~df.drop(columns=SILVER_POSITION_COLUMN).duplicated()]
+        write_table(df, f"{buckets_path}/distinct-{bucket:03d}")
+        cursors.append(iter_table_file_chunks(f"{buckets_path}/distinct-{bucket:03d}.{STORAGE_FORMAT}",
+                                              SILVER_CHUNK_SIZE))
+
+    # The rows of a bucket are sorted by position, since the parts were partitioned in shard order
+    pending = [pd.DataFrame() for _ in cursors]
+    writer, summary = None, None
+    try:
+        for shard in shards:
+            end_position = (shard + 1) << 32
+            frames = []
+            for number, cursor in enumerate(cursors):
+                while pending[number].empty or pending[number][SILVER_POSITION_COLUMN].iloc[-1] < end_position:
+                    df_chunk = next(cursor, None)
+                    if df_chunk is None:
+                        break
+                    pending[number] = (df_chunk if pending[number].empty
+                                       else pd.concat([pending[number], df_chunk], ignore_index=True))
+                if pending[number].empty:
+                    continue
+                in_shard = pending[number][SILVER_POSITION_COLUMN] < end_position
+                frames.append(pending[number][in_shard])
+                pending[number] = pending[number][~in_shard]
+            # Every row of a shard may repeat a row of an earlier one
+            frames = [df for df in frames if not df.empty]
+            if not frames:
+                continue
+            df_shard = pd.concat(frames).sort_values(SILVER_POSITION_COLUMN).drop(columns=SILVER_POSITION_COLUMN)
+            df_shard = apply_schema(df_shard.reset_index(drop=True), "silver", table_name)
+            if writer is None:
+                writer = open_chunk_writer(file_path, STORAGE_FORMAT, df_shard)
+            write_chunk(writer, df_shard)
+            summary = merge_table_summaries(summary, summarize_table(df_shard))
+    finally:
+        if writer is not None:
+            writer.close()
+    write_table_statistics(summary, os.path.splitext(file_path)[0])
+    return True
+
+
+# Merge the parts written by the shards into the silver tables. Shard tables are concatenated file by
+# file, with the statistics of the shards merged, distinct tables are deduplicated out of core. A
+# distinct table without rows is written from its empty parts
+@instrument
+def merge_silver_shards(shards_path, directory_path):
+    for table_name in SILVER_SHARD_TABLES + list(SILVER_DISTINCT_TABLES):
+        part_directory = f"{shards_path}/{table_name}"
+        parts = sorted(os.listdir(part_directory)) if os.path.exists(part_directory) else []
+        file_paths = [f"{part_directory}/{part}" for part in parts if not part.endswith(get_statistics_path(""))]
+        if table_name in SILVER_DISTINCT_TABLES and merge_distinct_shards(
+                table_name, file_paths, f"{shards_path}/_buckets/{table_name}",
+                f"{directory_path}/{table_name}.{STORAGE_FORMAT}"):
+            continue
+        if table_name in SILVER_DISTINCT_TABLES:
+            df = pd.concat([read_table_file(part_path) for part_path in file_paths], ignore_index=True)
+            df = apply_schema(SILVER_DISTINCT_TABLES[table_name](df), "silver", table_name)
+            write_table(df, f"{directory_path}/{table_name}")
+            write_table_statistics(summarize_table(df), f"{directory_path}/{table_name}")
+        elif file_paths:
+            concat_table_files(file_paths, f"{directory_path}/{table_name}.{STORAGE_FORMAT}")
+            summary = None
+            for part_path in file_paths:
+                summary = merge_table_summaries(summary, read_table_statistics(os.path.splitext(part_path)[0]))
+            write_table_statistics(summary, f"{directory_path}/{table_name}")
+
+
+# Create the silver layer shard by shard, so bronze partitions larger than the memory can be processed.
+# Shards are processed by a pool of worker processes; at most two shards per worker are read ahead, so
+# memory usage depends on chunk_size and workers and not on the size of the partition
+@instrument
+def create_silver_layer_chunked(chunk_size=None, workers=None):
+    chunk_size = chunk_size or SILVER_CHUNK_SIZE
+    workers = workers or PIPELINE_WORKERS
+    today = get_partition_date()
+    bronze_path = f"data/bronze/{today}"
+    directory_path = f"data/silver/{today}"
+    if not save_silver_changes():
+        return
+
+    shards_path = f"{directory_path}/_shards"
+    shutil.rmtree(shards_path, ignore_errors=True)
+    os.makedirs(shards_path)
 
-    save_silver_data(df_sanitized, "sanitation")
-    save_silver_data(df_denormalized, "denormalized")
-    save_silver_data(df_transactions, "transactions")
-    save_silver_data(df_customers, "customers")
-    save_silver_data(df_products, "products")
+    shards = enumerate(iter_bronze_shards(bronze_path, chunk_size))
+    if workers <= 1:
+        for shard, (df_customers, df_transactions) in shards:
+            process_silver_shard(shard, df_customers, df_transactions, shards_path, STORAGE_FORMAT)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for shard, (df_customers, df_transactions) in shards:
+                pending.append(pool.submit(process_silver_shard, shard, df_customers, df_transactions,
+                                           shards_path, STORAGE_FORMAT))
+                if len(pending) >= 2 * workers:
+                    pending.popleft().result()
+            for future in pending:
+                future.result()
+
+    merge_silver_shards(shards_path, directory_path)
+    shutil.rmtree(shards_path)
+
+
+# ---------------------- Lazy Silver Layer ----------------------
+# The silver tables are declared as expressions over the bronze layer, and only computed when they
+# are requested or saved. The columns every table needs are planned from the tables requested, so the
+# columns no table uses are neither read from the bronze layer nor carried through the denormalization,
+# and the tables several others are computed from, like the parsed transactions, are computed once
+
+# Silver tables as expressions: the function computing every table, the table it is computed from,
+# "bronze" for the customers and their transactions, and the columns of that table it uses. None
+# stands for all the columns; without columns the function builds the columns required of its table
+# only, from the same columns of its source. Tables are listed before the tables computed from them
+SILVER_TABLES = {
+    "sanitation": {"function": sanity_check, "source": "bronze", "columns": None},
+    "denormalized": {"function": rearrange_data, "source": "bronze"},
+    "transactions": {"function": create_transaction_table, "source": "denormalized",
+                     "columns": ["transaction_id", "date", "amount", "product_id", "customer_id"]},
+    "customers": {"function": create_customer_table, "source": "denormalized",
+                  "columns": ["customer_id", "customer_name", "customer_email", "signup_date"]},
+    "products": {"function": create_product_table, "source": "denormalized",
+                 "columns": ["product_id", "product_name"]},
+}
+
+
+# Columns of both lists, in the order they first appear. None, all the columns, absorbs any list
+def merge_columns(columns, other_columns):
+    if columns is None or other_columns is None:
+        return None
+    return list(dict.fromkeys(columns + other_columns))
+
+
+# Plan the columns of every table needed to compute the requested tables, None for all of them.
+# Requested tables are computed whole, the tables they are computed from only with the columns used.
+# The bronze layer is planned with the columns of the denormalized table it is read into
+def plan_silver_tables(table_names):
+    plan = {table_name: None for table_name in table_names}
+    # Tables are planned before the tables they are computed from, which then know all their uses
+    for table_name in reversed(SILVER_TABLES):
+        if table_name not in plan:
+            continue
+        expression = SILVER_TABLES[table_name]
+        columns = expression.get("columns", plan[table_name])
+        source = expression["source"]
+        plan[source] = merge_columns(plan[source], columns) if source in plan else columns
+    return plan
+
+
+# Load the customers of the bronze layer and their transactions, only what the given columns of the
+# denormalized table are built from when columns is set. Nested transactions are parsed here, once
+@instrument
+def load_bronze_tables(columns=None):
+    customer_columns = transaction_columns = None
+    if columns is not None:
+        fields = {name: field for field, name in CUSTOMER_FIELDS.items()}
+        customer_columns = ["id"] + [fields[column] for column in columns
+                                     if column in fields and column != "customer_id"]
+        transaction_columns = ["customer_row"] + [column for column in columns if column not in fields]
+
+    df_transactions = load_bronze_transactions(transaction_columns)
+    if df_transactions is not None:
+        return load_bronze_data(columns=customer_columns), df_transactions
+    df = load_bronze_data(columns=customer_columns and customer_columns + ["transactions"])
+    df_transactions = explode_transactions(df)
+    if transaction_columns is not None:
+        df_transactions = df_transactions.reindex(columns=transaction_columns)
+    return df, df_transactions
+
+
+# Compute a table of the plan, after the table it is computed from. Computed tables are kept in frames,
+# so a table several others are computed from is computed once
+def compute_silver_table(table_name, plan, frames):
+    if table_name not in frames:
+        if table_name == "bronze":
+            frames[table_name] = load_bronze_tables(plan[table_name])
+            return frames[table_name]
+        expression = SILVER_TABLES[table_name]
+        source = compute_silver_table(expression["source"], plan, frames)
+        if expression["source"] != "bronze":
+            frames[table_name] = expression["function"](source)
+        elif "columns" in expression:
+            frames[table_name] = expression["function"](*source)
+        else:
+            frames[table_name] = expression["function"](*source, columns=plan[table_name])
+    return frames[table_name]
+
+
+# Compute the given silver tables from the bronze layer of today, without saving them
+def load_silver_tables(table_names):
+    plan = plan_silver_tables(table_names)
+    frames = {}
+    return {table_name: compute_silver_table(table_name, plan, frames) for table_name in table_names}
+
+
+# Create the silver layer with the given tables only, all of them when table_names is not set. The
+# tables are computed one after the other, sharing their intermediates, and saved on a pool of workers
+@instrument
+def create_silver_layer_lazy(table_names=None, workers=None, executor=None):
+    if not save_silver_changes():
+        return
+
+    tables = load_silver_tables(table_names or list(SILVER_TABLES))
+    run_parallel([partial(save_silver_data, df, table_name) for table_name, df in tables.items()],
+                 workers, executor)
 
 
 # ----------------- Golden Layer -----------------
 
-# Load the data from the silver layer
-def load_silver_data(table_name):
-    today = pd.Timestamp("today").strftime("%Y-%m-%d")
+# Load the data from the silver layer, only the given columns when columns is set and only the rows of
+# the rows slice when it is set
+@instrument
+def load_silver_data(table_name, columns=None, rows=None):
+    today = get_partition_date()
     directory_path = f"data/silver/{today}"
-    file_path = f"{directory_path}/{table_name}.csv"
-    return pd.read_csv(file_path)
+    return apply_schema(read_table(f"{directory_path}/{table_name}", columns, rows), "silver", table_name)
 
 # Append the data to an existing table, only if the data is new
 
 
+@instrument
 def append_to_table(df, file_path):
-    existing_data = pd.read_csv(file_path)
+    existing_data = read_table_file(file_path)
 
     df_combined = pd.merge(existing_data, df, how='outer', indicator=True)
     new_rows = df_combined[df_combined['_merge'] == 'right_only']
@@ -226,43 +1963,1714 @@ def append_to_table(df, file_path):
 
     # Append the new data to the existing table
     if not new_data.empty:
-        print(existing_data)
-        # existing_data = existing_data.append(new_data, ignore_index=True)
-        existing_data = pd.concat([existing_data, new_data], ignore_index=True)
-        existing_data.to_csv(file_path, index=False)
+        append_table_rows(new_data, file_path)
+
+
+# Primary key of the gold tables. Keyed tables keep an index of the keys already stored next to
+# the table, so new rows are found by probing the incoming keys instead of merging the whole table
+GOLD_PRIMARY_KEYS = {
+    "fact_transactions": "transaction_id",
+    "dimension_customers": "customer_id",
+    "dimension_products": "product_id",
+}
+
+# The index of a gold table is a directory with Bloom filters of its keys and sorted runs of the 128
+# bit hashes of its keys, both mapped from disk. A key the filters have not seen is new for certain, and
+# only the keys they may have seen are searched in the runs, which tells the keys stored from the false
+# positives. Probing a load reads a few pages per key, so it takes time proportional to the load
+# whatever the number of keys stored. Two different keys with the same 128 bit hash are not expected
+# before about 2**64 keys. The index records the last version of the table it holds the keys of, so the
+# keys of rows committed by a load that failed before extending the index are added on the next load.
+# Keys of the first filter of an index, with this rate of false positives. A full filter is followed
+# by one twice as large with half the rate, so the rate of the index stays below twice this rate
+KEY_FILTER_CAPACITY = 100_000
+KEY_FILTER_ERROR_RATE = 0.01
+# Layout of the runs of hashes, sorted by hash and then other hash
+KEY_RUN_DTYPE = np.dtype([("hash", "<u8"), ("other_hash", "<u8")])
+
+
+# Path of the key index of a gold table
+def get_index_path(file_path):
+    return f"{os.path.splitext(file_path)[0]}.index"
+
+
+# Two independent 64 bit hashes of every key. The positions of a key in the filters are derived from
+# both, and the runs store both
+def hash_keys(keys):
+    keys = np.asarray(keys, dtype=object)
+    return (pd.util.hash_array(keys, categorize=False),
+            pd.util.hash_array(keys, hash_key="medallion_filter", categorize=False))
+
+
+# Filter for capacity keys with the given rate of false positives
+def create_key_filter(capacity, error_rate):
+    bits = 8 * math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2 / 8)
+    return {"capacity": capacity, "error_rate": error_rate, "bits": bits,
+            "hashes": max(1, round(bits / capacity * math.log(2))), "count": 0}
+
+
+# Bit positions of the hashed keys in a filter, one row of positions per key
+def get_filter_positions(key_filter, hashes, other_hashes):
+    steps = np.arange(key_filter["hashes"], dtype=np.uint64)
+    return (hashes[:, None] + steps * other_hashes[:, None]) % np.uint64(key_filter["bits"])
+
+
+# Map the bits of a filter of an index. Only the pages of the positions probed or set are read
+def map_filter_bits(index_path, number, key_filter, mode="r"):
+    return np.memmap(f"{index_path}/filter-{number:05d}.bin", dtype=np.uint8, mode=mode,
+                     shape=(key_filter["bits"] // 8,))
+
+
+# Load the description of the index of a gold table, its filters and runs. A table without an index yet
+# is indexed once from its key column, and the index of an older version, a file of keys, is converted.
+# The keys of the rows committed after the versions the index holds are added first. An index written
+# before versions were recorded holds the keys of the versions there
+def load_table_index(file_path, key):
+    index_path = get_index_path(file_path)
+    if os.path.isfile(index_path):
+        versions = read_gold_versions(file_path)
+        with open(index_path) as f:
+            write_table_index(file_path, f.read().splitlines(), versions)
+    elif not os.path.isdir(index_path):
+        versions = read_gold_versions(file_path)
+        write_table_index(file_path, read_table_keys(file_path, key), versions)
+
+    with open(f"{index_path}/index.json") as f:
+        index = json.load(f)
+    if "versions" not in index:
+        return add_index_keys(index_path, [], read_gold_versions(file_path))
+    df, versions = read_appended_rows(file_path, index["versions"], [key])
+    if versions != index["versions"]:
+        return add_index_keys(index_path, df[key].astype(str), versions)
+    return index
+
+
+# Files of a gold table with a commit log, a partitioned table has a single log for its partitions
+def list_gold_files(file_path):
+    return [file_path] if os.path.exists(file_path) else []
+
+
+# Name of a file of a gold table in the versions of its sidecars, its path from the gold layer
+def get_gold_file_name(file_path, table_file):
+    return os.path.relpath(table_file, os.path.dirname(file_path))
+
+
+# Last committed version of every file of a gold table, by name
+def read_gold_versions(file_path):
+    return {get_gold_file_name(file_path, table_file): get_table_version(table_file)
+            for table_file in list_gold_files(file_path)}
+
+
+# Read the rows appended to the files of a gold table by the commits after the given versions, only the
+# given columns. Files without a version are read from their first commit. Other commits, compactions
+# and rewrites, only move rows already there. Returns the rows and the versions they were read up to
+def read_appended_rows(file_path, versions, columns):
+    frames, read_versions = [], {}
+    for table_file in list_gold_files(file_path):
+        name = get_gold_file_name(file_path, table_file)
+        read_versions[name] = versions.get(name, -1)
+        for version, commit in read_table_commits(table_file, read_versions[name]):
+            if commit["operation"] == "append":
+                frames += [read_table_file(f"{table_file}/{part}", columns) for part in commit["add"]]
+            read_versions[name] = version
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns)
+    return df, {**versions, **read_versions}
+
+
+# Read the distinct keys stored in a gold table, partitioned or not
+def read_table_keys(file_path, key):
+    if is_partitioned_table(file_path):
+        df = read_partitioned_table(file_path, [key])
+    elif os.path.exists(file_path):
+        df = read_table_file(file_path, [key])
+    else:
+        return []
+    return df[key].astype(str).drop_duplicates().tolist()
+
+
+# Tell which of the hashed keys the filters of an index may have seen
+def probe_key_filters(index_path, index, hashes, other_hashes):
+    seen = np.zeros(len(hashes), dtype=bool)
+    for number, key_filter in enumerate(index["filters"]):
+        bits = map_filter_bits(index_path, number, key_filter)
+        positions = get_filter_positions(key_filter, hashes, other_hashes)
+        is_set = (bits[(positions >> np.uint64(3)).astype(np.intp)] >> (positions & np.uint64(7)).astype(np.uint8)) & 1
+        seen |= is_set.all(axis=1)
+    return seen
+
+
+# Tell which of the hashed keys are stored in the runs of an index, by binary search in every run
+def search_key_runs(index_path, index, hashes, other_hashes):
+    found = np.zeros(len(hashes), dtype=bool)
+    for run in index["runs"]:
+        stored = np.memmap(f"{index_path}/{run['name']}", dtype=KEY_RUN_DTYPE, mode="r", shape=(run["count"],))
+        positions = np.searchsorted(stored["hash"], hashes)
+        # Keys with the same first hash follow each other, they are compared one after the other
+        pending = np.flatnonzero(~found)
+        while len(pending):
+            pending = pending[positions[pending] < run["count"]]
+            pending = pending[stored["hash"][positions[pending]] == hashes[pending]]
+            is_stored = stored["other_hash"][positions[pending]] == other_hashes[pending]
+            found[pending[is_stored]] = True
+            pending = pending[~is_stored]
+            positions[pending] += 1
+    return found
+
+
+# Select the rows whose key is not in the table yet. Only the incoming keys are probed against the
+# filters of the index, and only the keys the filters may have seen are searched in its runs
+def select_new_rows(df, file_path, key):
+    index = load_table_index(file_path, key)
+    incoming_keys = df[key].astype(str)
+    is_new = ~incoming_keys.duplicated().to_numpy()
+    first_positions = np.flatnonzero(is_new)
+    hashes, other_hashes = hash_keys(incoming_keys.iloc[first_positions])
+    seen = np.flatnonzero(probe_key_filters(get_index_path(file_path), index, hashes, other_hashes))
+    is_stored = search_key_runs(get_index_path(file_path), index, hashes[seen], other_hashes[seen])
+    is_new[first_positions[seen[is_stored]]] = False
+    return df[is_new]
+
+
+# Add keys to an index. Their bits are set in the last filter, followed by a new filter when it is full.
+# Their hashes are written as a new run, merged with the last runs as long as they are not larger, so
+# runs grow geometrically and a key is in one of a logarithmic number of runs. The versions of the table
+# files the keys were read up to are recorded. The description of the index is only replaced once the
+# filters and runs are written. Returns the description
+def add_index_keys(index_path, keys, versions):
+    description_path = f"{index_path}/index.json"
+    index = {"filters": [], "runs": [], "next_run": 0}
+    if os.path.exists(description_path):
+        with open(description_path) as f:
+            index = json.load(f)
+    hashes, other_hashes = hash_keys(keys)
+
+    key_filters = index["filters"]
+    start = 0
+    while start < len(hashes):
+        if not key_filters or key_filters[-1]["count"] >= key_filters[-1]["capacity"]:
+            key_filters.append(create_key_filter(KEY_FILTER_CAPACITY * 2**len(key_filters),
+                                                 KEY_FILTER_ERROR_RATE / 2**len(key_filters)))
+            map_filter_bits(index_path, len(key_filters) - 1, key_filters[-1], "w+").flush()
+        key_filter = key_filters[-1]
+        stop = min(len(hashes), start + key_filter["capacity"] - key_filter["count"])
+        positions = get_filter_positions(key_filter, hashes[start:stop], other_hashes[start:stop]).ravel()
+        bits = map_filter_bits(index_path, len(key_filters) - 1, key_filter, "r+")
+        np.bitwise_or.at(bits, (positions >> np.uint64(3)).astype(np.intp),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        bits.flush()
+        key_filter["count"] += stop - start
+        start = stop
+
+    run = np.empty(len(hashes), dtype=KEY_RUN_DTYPE)
+    run["hash"], run["other_hash"] = hashes, other_hashes
+    merged_runs = []
+    while index["runs"] and index["runs"][-1]["count"] <= len(run):
+        merged_runs.append(index["runs"].pop())
+        run = np.concatenate([np.fromfile(f"{index_path}/{merged_runs[-1]['name']}", dtype=KEY_RUN_DTYPE), run])
+    if len(run):
+        run.sort(order=["hash", "other_hash"])
+        index["runs"].append({"name": f"keys-{index['next_run']:05d}.bin", "count": len(run)})
+        index["next_run"] += 1
+        run.tofile(f"{index_path}/{index['runs'][-1]['name']}")
+
+    index["versions"] = {**index.get("versions", {}), **versions}
+    with open(f"{description_path}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{description_path}.tmp", description_path)
+    for merged_run in merged_runs:
+        os.remove(f"{index_path}/{merged_run['name']}")
+    return index
+
+
+# Write the index of a gold table with the keys of the given versions of its files. The index is built
+# aside and moved in place
+def write_table_index(file_path, keys, versions):
+    index_path = get_index_path(file_path)
+    tmp_index_path = f"{index_path}.tmp"
+    shutil.rmtree(tmp_index_path, ignore_errors=True)
+    os.makedirs(tmp_index_path)
+    add_index_keys(tmp_index_path, keys, versions)
+    remove_table_index(file_path)
+    os.replace(tmp_index_path, index_path)
+
+
+# Remove the index of a gold table, of the current or an older version
+def remove_table_index(file_path):
+    index_path = get_index_path(file_path)
+    if os.path.isdir(index_path):
+        shutil.rmtree(index_path)
+    elif os.path.exists(index_path):
+        os.remove(index_path)
+
+
+# Add the keys of rows just stored in a gold table to its index, with the versions of the table files
+# that stored them
+def extend_table_index(file_path, keys, versions):
+    add_index_keys(get_index_path(file_path), keys.astype(str),
+                   {get_gold_file_name(file_path, table_file): version for table_file, version in versions.items()})
+
+
+# Append the rows whose key is not in the table yet, and add their keys to the index. Returns the rows
+# appended. Only the incoming keys are probed and only the new rows are written, the table itself is never read
+def append_to_indexed_table(df, file_path, key):
+    new_data = select_new_rows(df, file_path, key)
+    if new_data.empty:
+        return new_data
+
+    version = append_table_rows(new_data, file_path)
+
+    # The index is only extended once the rows are stored
+    extend_table_index(file_path, new_data[key], {file_path: version})
+    return new_data
+
+
+# ---------------------- Partitioned tables ----------------------
+# Large gold tables are partitioned by the year and month of a date column, in directories like
+# fact_transactions/year=2023/month=02/, so loads and reads only touch the partitions they need. The
+# parts of every partition are listed by a single commit log of the table, so a load is committed to
+# all its partitions at once
+
+# Date column used to partition the gold tables
+GOLD_PARTITION_COLUMNS = {
+    "fact_transactions": "date",
+}
+# Partition of the rows without a valid date
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+
+# A partitioned table is a directory of year=/month= partitions, stored at the path of the table without
+# extension. Other directories, tables stored as part files or the key indexes next to them, hold no year
+def is_partitioned_table(path):
+    return os.path.isdir(path) and any(name.startswith("year=") for name in os.listdir(path))
+
+
+# Path of the data of a partition, without extension
+def get_partition_path(table_path, year, month):
+    return f"{table_path}/year={year}/month={month}/data"
+
+
+# Path of the partitioned table of the data of a partition, None for any other file
+def get_partition_table_path(file_path):
+    month_directory = os.path.dirname(file_path)
+    year_directory = os.path.dirname(month_directory)
+    if (os.path.basename(file_path) in {f"data.{f}" for f in STORAGE_FORMATS}
+            and os.path.basename(month_directory).startswith("month=")
+            and os.path.basename(year_directory).startswith("year=")):
+        return os.path.dirname(year_directory)
+    return None
+
+
+# Give a commit log to a partitioned table written by an older version, with a file or a log per
+# partition. A first commit adds the committed parts of every partition, then the logs of the
+# partitions are removed. Parts no partition log lists are left to the commit of the load writing them
+def migrate_partitioned_table(table_path):
+    file_paths = [find_table_file(get_partition_path(table_path, year, month))
+                  for year, month in list_partitions(table_path)]
+    add = []
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            migrate_table_file(file_path)
+        if os.path.isdir(get_log_path(file_path)):
+            prefix = os.path.relpath(file_path, table_path)
+            add += [f"{prefix}/{part}" for part in read_table_log(file_path)[1]]
+    if add:
+        commit_table(table_path, add, operation="migrate")
+    for file_path in file_paths:
+        shutil.rmtree(get_log_path(file_path), ignore_errors=True)
+
+
+# Parts of the partitions of a partitioned table, by file of the partition, all listed from the same
+# version of the table log, so a reader sees every partition at the same version. Partitions without
+# parts committed are left out
+def list_partition_parts(table_path):
+    if not os.path.isdir(get_log_path(table_path)):
+        file_paths = [find_table_file(get_partition_path(table_path, year, month))
+                      for year, month in list_partitions(table_path)]
+        return {file_path: list_part_files(file_path) for file_path in file_paths}
+    partition_parts = {}
+    for part in read_table_log(table_path)[1]:
+        partition_parts.setdefault(f"{table_path}/{os.path.dirname(part)}", []).append(f"{table_path}/{part}")
+    return dict(sorted(partition_parts.items()))
+
+
+# Year and month partition values of every date
+def get_partition_values(dates):
+    dates = pd.to_datetime(dates, errors="coerce")
+    years = dates.dt.strftime("%Y").fillna(NULL_PARTITION)
+    months = dates.dt.strftime("%m").fillna(NULL_PARTITION)
+    return years, months
+
+
+# List the partition directories of a table as (year, month) tuples
+def list_partitions(table_path):
+    partitions = []
+    for year_directory in sorted(name for name in os.listdir(table_path) if name.startswith("year=")):
+        for month_directory in sorted(os.listdir(f"{table_path}/{year_directory}")):
+            partitions.append((year_directory.split("=", 1)[1], month_directory.split("=", 1)[1]))
+    return partitions
+
+
+# Check if a partition may hold dates between start_date and end_date. The partition of the rows
+# without a date is only read when no range is given
+def partition_in_range(year, month, start_date, end_date):
+    if NULL_PARTITION in (year, month):
+        return start_date is None and end_date is None
+    partition_start = pd.Timestamp(f"{year}-{month}-01")
+    partition_end = partition_start + pd.offsets.MonthEnd(1)
+    return ((start_date is None or partition_end >= pd.Timestamp(start_date))
+            and (end_date is None or partition_start <= pd.Timestamp(end_date)))
+
+
+# Read a partitioned table, every partition at the same version. When a date range is given only the
+# partitions of the range are opened, and only the rows of the range are returned
+def read_partitioned_table(table_path, columns=None, start_date=None, end_date=None, date_column="date"):
+    read_columns = columns
+    if columns is not None and date_column not in columns and (start_date or end_date):
+        read_columns = columns + [date_column]
+
+    frames = []
+    for file_path, part_paths in list_partition_parts(table_path).items():
+        year, month = [name.split("=", 1)[1] for name in os.path.dirname(file_path).split("/")[-2:]]
+        if part_paths and partition_in_range(year, month, start_date, end_date):
+            frames.append(read_table_file(file_path, read_columns, part_paths=part_paths))
+    if not frames:
+        return pd.DataFrame(columns=columns)
+
+    df = pd.concat(frames, ignore_index=True)
+    if start_date or end_date:
+        df = filter_date_range(df, date_column, start_date, end_date)
+    return df[columns] if columns is not None else df
+
+
+# Keep the rows whose date is between start_date and end_date, both included
+def filter_date_range(df, date_column, start_date=None, end_date=None):
+    dates = pd.to_datetime(df[date_column], errors="coerce")
+    in_range = dates.notna()
+    if start_date is not None:
+        in_range &= dates >= pd.Timestamp(start_date)
+    if end_date is not None:
+        in_range &= dates <= pd.Timestamp(end_date)
+    return df[in_range].reset_index(drop=True)
+
+
+# Append rows to the partitions of a table, only the partitions of the rows are touched. A part is
+# written to every partition, and all of them are added by a single commit of the table, so a load
+# spanning several partitions is seen whole or not at all. Returns the version committed
+def append_to_partitions(df, table_path, partition_column, operation="append"):
+    years, months = get_partition_values(df[partition_column])
+    add = []
+    for (year, month), df_partition in df.groupby([years, months], sort=True):
+        partition_path = get_partition_path(table_path, year, month)
+        os.makedirs(os.path.dirname(partition_path), exist_ok=True)
+        partition_file_path = find_table_file(partition_path) or f"{partition_path}.{STORAGE_FORMAT}"
+        part = write_appended_part(df_partition, partition_file_path)
+        add.append(f"{os.path.relpath(partition_file_path, table_path)}/{part}")
+    return commit_table(table_path, add, operation=operation)
+
+
+# Split a table stored in a single file into partitions. The partitions are written aside and moved in
+# place once complete, then the single file is removed
+def partition_table(file_path, table_path, partition_column):
+    if not is_partitioned_table(table_path):
+        tmp_table_path = f"{table_path}.tmp"
+        shutil.rmtree(tmp_table_path, ignore_errors=True)
+        append_to_partitions(read_table_file(file_path), tmp_table_path, partition_column, "migrate")
+        os.replace(tmp_table_path, table_path)
+
+    if os.path.isdir(file_path):
+        shutil.rmtree(file_path)
+    else:
+        os.remove(file_path)
+
+
+# Append the rows whose key is not in the partitioned table yet, and add their keys to the index.
+# Returns the rows appended
+def append_to_partitioned_table(df, table_path, key, partition_column):
+    new_data = select_new_rows(df, table_path, key)
+    if new_data.empty:
+        return new_data
+
+    version = append_to_partitions(new_data, table_path, partition_column)
+
+    # The index is only extended once the rows are stored
+    extend_table_index(table_path, new_data[key], {table_path: version})
+    return new_data
+
+
+# ---------------------- Slowly changing dimensions ----------------------
+# Dimensions keep the history of their rows (type 2): every version of a key has the date it became
+# valid, valid_from, the date it was replaced, valid_to, and a current flag. The current versions are
+# stored in the table itself, one row per key, and the closed versions in an append only history table
+# next to it, so current rows are read without scanning the history
+
+# Dimensions with history, and the attributes whose changes open a new version of a key
+GOLD_SCD2_TABLES = {
+    "dimension_customers": ["customer_name", "customer_email", "signup_date"],
+}
+
+
+# Path of the history table of a dimension
+def get_history_path(file_path):
+    root, extension = os.path.splitext(file_path)
+    return f"{root}_history{extension}"
+
+
+# Path of the hash index of a dimension. Every line gives a key, the hash of the attributes of its
+# current version and the part storing it, or no hash and part once the key is closed. Every load appends
+# the lines of the keys it changed, followed by a line with the version of the table they were written for
+def get_hash_index_path(file_path):
+    return f"{os.path.splitext(file_path)[0]}.hashes"
+
+
+# Hash the values of the given columns of every row
+def hash_rows(df, columns):
+    return pd.util.hash_pandas_object(df[columns].astype(str), index=False).astype(str)
+
+
+# Write the hash index of a dimension for a version of the table, a line per key. The index is written
+# aside and moved in place
+def write_hash_index(file_path, hashes, parts, version):
+    hash_index_path = get_hash_index_path(file_path)
+    with open(f"{hash_index_path}.tmp", "w") as f:
+        f.writelines(f"{k},{h},{parts[k]}\n" for k, h in hashes.items())
+        f.write(f"{version}\n")
+    os.replace(f"{hash_index_path}.tmp", hash_index_path)
+
+
+# Append the lines of the keys changed by a version of the table to the hash index of a dimension,
+# deltas of (hash, part) by key, ("", "") for the closed keys
+def append_hash_deltas(file_path, deltas, version):
+    with open(get_hash_index_path(file_path), "a") as f:
+        f.writelines(f"{k},{h},{p}\n" for k, (h, p) in deltas.items())
+        f.write(f"{version}\n")
+
+
+# Build the hash index of a dimension from its current rows, a part after the other
+def build_hash_index(file_path, key, attributes):
+    version = get_table_version(file_path)
+    hashes, parts = {}, {}
+    for part_path in list_part_files(file_path) if os.path.exists(file_path) else []:
+        df = read_table_file(part_path, [key] + attributes)
+        keys = df[key].astype(str)
+        hashes.update(zip(keys, hash_rows(df, attributes)))
+        parts.update(dict.fromkeys(keys, os.path.basename(part_path)))
+    write_hash_index(file_path, hashes, parts, version)
+    return hashes, parts
+
+
+# Load the hash and the part of the current version of every key of a dimension, and the number of lines
+# of its hash index. Lines not followed by a version were written by a load that failed. The index is
+# built again from the current rows when its last version is not the version of the table: after a load
+# that failed between its commits and the index, a compaction, or when it was written by an older version
+def load_hash_index(file_path, key, attributes):
+    hash_index_path = get_hash_index_path(file_path)
+    hashes, parts, pending, version, lines = {}, {}, [], None, 0
+    if os.path.exists(hash_index_path):
+        with open(hash_index_path) as f:
+            for line in f:
+                fields = line.rstrip("\n").rsplit(",", 2)
+                if len(fields) == 3:
+                    pending.append(fields)
+                elif fields[0].lstrip("-").isdigit():
+                    for k, h, p in pending:
+                        if h:
+                            hashes[k], parts[k] = h, p
+                        else:
+                            hashes.pop(k, None)
+                            parts.pop(k, None)
+                    pending, version = [], int(fields[0])
+                lines += 1
+
+    if version != get_table_version(file_path):
+        hashes, parts = build_hash_index(file_path, key, attributes)
+        return hashes, parts, len(hashes) + 1
+    return hashes, parts, lines
+
+
+# Add the history columns to a dimension stored by an older version. The last row of every key is its
+# current version, with an unknown valid_from, and the rows duplicating a key are moved to the history
+def migrate_scd2_table(file_path, key):
+    if not os.path.exists(file_path) or "current" in read_table_columns(file_path):
+        return
+
+    df = read_table_file(file_path).assign(valid_from=pd.NA, valid_to=pd.NA)
+    df["current"] = ~df[key].astype(str).duplicated(keep="last")
+    if not df["current"].all():
+        append_table_rows(df[~df["current"]], get_history_path(file_path))
+    rewrite_table(df[df["current"]], file_path)
+    # The key index of the dimension is replaced by its hash index
+    remove_table_index(file_path)
+
+
+# Close the current versions of keys of a dimension, valid until valid_to. The closed versions are
+# appended to the history, and the parts storing them are replaced by parts with their other rows, in a
+# single commit, so the other parts are not read. The parts given in add, with the new versions of the
+# keys, are added by the same commit, so readers never see a key closed without its new version. The
+# history records the version of the table it closed versions of, so a retry after a failed commit does
+# not append them again. Returns the new part of every key moved
+def close_scd2_versions(file_path, key, closed_keys, parts, valid_to, add=()):
+    version = get_table_version(file_path)
+    replaced = sorted({parts[k] for k in closed_keys})
+    added, moved, frames = [], {}, []
+    for part in replaced:
+        df_part = read_table_file(f"{file_path}/{part}")
+        is_closed = df_part[key].astype(str).isin(closed_keys)
+        frames.append(df_part[is_closed])
+        if not is_closed.all():
+            added.append(write_table_part(df_part[~is_closed], file_path, keep_schema=True))
+            moved.update(dict.fromkeys(df_part.loc[~is_closed, key].astype(str), added[-1]))
+
+    history_path = get_history_path(file_path)
+    if (read_table_metadata(history_path) or {}).get("closes") != version:
+        append_table_rows(pd.concat(frames, ignore_index=True).assign(valid_to=valid_to, current=False),
+                          history_path, {"closes": version})
+    commit_table(file_path, added + list(add), replaced, "update", {"valid_from": valid_to})
+    return moved
+
+
+# Merge the rows of a load into a dimension with history, keyed on key. Changes are found by probing the
+# hash index with the incoming rows. Only the changed and deleted keys are touched: their current
+# version is closed and appended to the history, and the new versions are added to the table by the
+# commit closing them. Keys
+# seen for the first time only append a version. Only the lines of the keys changed are appended to the
+# hash index, which is written again once it has more lines than twice its keys. The commits of the
+# dimension record the date they are valid from, and a load valid from an earlier date, replayed by a
+# backfill, is skipped, since its changes are already in the history and closing the versions of later
+# dates would break it
+def merge_scd2_table(df, file_path, key, attributes, valid_from, deleted_keys=()):
+    migrate_scd2_table(file_path, key)
+    if os.path.isfile(file_path):
+        migrate_table_file(file_path)
+    last_valid_from = (read_table_metadata(file_path) or {}).get("valid_from")
+    if last_valid_from is not None and valid_from < last_valid_from:
+        return
+    hashes, parts, lines = load_hash_index(file_path, key, attributes)
+
+    df = df.drop_duplicates(key, keep="last")
+    incoming_keys = df[key].astype(str)
+    incoming_hashes = hash_rows(df, attributes)
+    stored_hashes = incoming_keys.map(hashes)
+    is_new = stored_hashes.isna()
+    is_version = is_new | (stored_hashes != incoming_hashes)
+    closed_keys = set(incoming_keys[is_version & ~is_new]) | (set(map(str, deleted_keys)) & hashes.keys())
+
+    if not closed_keys and not is_version.any():
+        return
+    deltas, add = {}, []
+    if is_version.any():
+        add.append(write_appended_part(df[is_version].assign(valid_from=valid_from, valid_to=pd.NA, current=True),
+                                       file_path))
+    if closed_keys:
+        moved = close_scd2_versions(file_path, key, closed_keys, parts, valid_from, add)
+        deltas.update((k, (hashes[k], part)) for k, part in moved.items())
+        deltas.update(dict.fromkeys(closed_keys, ("", "")))
+    else:
+        commit_table(file_path, add, metadata={"valid_from": valid_from})
+    if add:
+        deltas.update((k, (h, add[0])) for k, h in zip(incoming_keys[is_version], incoming_hashes[is_version]))
+
+    for k, (h, part) in deltas.items():
+        if h:
+            hashes[k], parts[k] = h, part
+        else:
+            del hashes[k], parts[k]
+    if lines + len(deltas) + 1 > 2 * len(hashes):
+        write_hash_index(file_path, hashes, parts, get_table_version(file_path))
+    else:
+        append_hash_deltas(file_path, deltas, get_table_version(file_path))
+
+
+# ---------------------- Surrogate keys ----------------------
+# Dimensions give an integer surrogate key to the natural key of their rows, and fact tables reference
+# them by these keys instead of repeating the string ids. The keys of every dimension are persisted
+# in a key map next to it, so a natural key keeps its surrogate key across loads, and a customer keeps
+# the same key across its versions
+
+# Natural key of every dimension and the name of its surrogate key
+GOLD_SURROGATE_KEYS = {
+    "dimension_customers": ("customer_id", "customer_key"),
+    "dimension_products": ("product_id", "product_key"),
+}
+# Dimensions referenced by every fact table
+GOLD_FOREIGN_KEYS = {
+    "fact_transactions": ["dimension_customers", "dimension_products"],
+}
+
+
+# Path of the key map of a dimension, given without extension, one natural key and its surrogate key per line
+def get_key_map_path(path):
+    return f"{path}.keys"
+
+
+def load_key_map(path):
+    key_map_path = get_key_map_path(path)
+    if not os.path.exists(key_map_path):
+        return {}
+    with open(key_map_path) as f:
+        return {k: int(v) for k, v in (line.rsplit(",", 1) for line in f.read().splitlines())}
+
+
+# Give surrogate keys to the natural keys not in the key map of the dimension yet, numbered after the
+# last key, and return the key map. Only the new keys are appended to the key map
+def assign_surrogate_keys(natural_keys, path):
+    key_map = load_key_map(path)
+    distinct_keys = pd.Series(natural_keys.dropna().astype(str).unique())
+    new_keys = distinct_keys[~distinct_keys.isin(list(key_map))]
+    if new_keys.empty:
+        return key_map
+
+    first_key = max(key_map.values(), default=0) + 1
+    new_key_map = dict(zip(new_keys, range(first_key, first_key + len(new_keys))))
+    with open(get_key_map_path(path), "a") as f:
+        f.writelines(f"{k},{v}\n" for k, v in new_key_map.items())
+    key_map.update(new_key_map)
+    return key_map
+
+
+# Surrogate keys of the natural keys, assigning the missing ones
+def map_surrogate_keys(natural_keys, dimension):
+    key_map = assign_surrogate_keys(natural_keys, f"data/gold/{dimension}")
+    return natural_keys.astype(str).map(key_map).astype("Int64")
+
+
+# Add the surrogate key of a dimension to its rows, as first column
+def add_surrogate_keys(df, table_name):
+    natural_key, surrogate_key = GOLD_SURROGATE_KEYS[table_name]
+    df = df.copy()
+    df.insert(0, surrogate_key, map_surrogate_keys(df[natural_key], table_name))
+    return df
 
 
-# Save the data to the golden layer, in an incremental way
-def save_golden_data(df, table_name):
-    directory_path = "data/gold/"
-    file_path = f"{directory_path}/{table_name}.csv"
-    if os.path.exists(file_path):
+# Replace the natural keys of the rows of a fact table by the surrogate keys of its dimensions
+def replace_foreign_keys(df, table_name):
+    for dimension in GOLD_FOREIGN_KEYS[table_name]:
+        natural_key, surrogate_key = GOLD_SURROGATE_KEYS[dimension]
+        if natural_key in df.columns:
+            position = df.columns.get_loc(natural_key)
+            surrogate_keys = map_surrogate_keys(df[natural_key], dimension)
+            df = df.drop(columns=[natural_key])
+            df.insert(position, surrogate_key, surrogate_keys)
+    return df
+
+
+# Files of a gold table, the partitions of a partitioned table
+def list_table_files(path):
+    if is_partitioned_table(path):
+        return list(list_partition_parts(path))
+    file_path = find_table_file(path)
+    return [file_path] if file_path else []
+
+
+# Parts of a gold table, the parts of all the partitions of a partitioned table at the same version
+def list_table_parts(path):
+    if is_partitioned_table(path):
+        return [part_path for part_paths in list_partition_parts(path).values() for part_path in part_paths]
+    return [part_path for file_path in list_table_files(path) for part_path in list_part_files(file_path)]
+
+
+# Add the surrogate key to a dimension, and its history, stored by an older version
+def migrate_surrogate_keys(path, table_name):
+    for file_path in [find_table_file(path), find_table_file(f"{path}_history")]:
+        if file_path is not None and GOLD_SURROGATE_KEYS[table_name][1] not in read_table_columns(file_path):
+            rewrite_table(add_surrogate_keys(read_table_file(file_path), table_name), file_path)
+
+
+# Replace the natural keys of a fact table stored by an older version. Tables are migrated as a whole,
+# so only the first file is checked
+def migrate_foreign_keys(path, table_name):
+    file_paths = list_table_files(path)
+    natural_keys = [GOLD_SURROGATE_KEYS[dimension][0] for dimension in GOLD_FOREIGN_KEYS[table_name]]
+    if not file_paths or not set(natural_keys) & set(read_table_columns(file_paths[0])):
+        return
+    for file_path in file_paths:
+        rewrite_table(replace_foreign_keys(read_table_file(file_path), table_name), file_path)
+
+
+# ---------------------- Aggregate tables ----------------------
+# Aggregates asked for by the dashboards are materialized in gold tables. They are updated with the rows
+# appended to their source table by every load: the new rows are aggregated and appended as a part of
+# delta rows, so neither the source table nor the stored aggregates are read again. A group may have a
+# row in several parts, readers merge them into one row per group, and compaction merges the parts
+
+# Source table, group column and aggregations (output column: (source column, function)) of every
+# aggregate table. Counts and sums of the new rows are added to the stored ones, minimums and maximums
+# are compared with them
+GOLD_AGGREGATES = {
+    "agg_customer_spend": {
+        "source": "fact_transactions",
+        "by": "customer_key",
+        "aggregations": {
+            "transactions": ("transaction_id", "count"),
+            "total_spent": ("amount", "sum"),
+            "first_transaction_date": ("date", "min"),
+            "last_transaction_date": ("date", "max"),
+        },
+    },
+    "agg_product_revenue": {
+        "source": "fact_transactions",
+        "by": "product_key",
+        "aggregations": {"transactions": ("transaction_id", "count"), "revenue": ("amount", "sum")},
+    },
+    "agg_daily_revenue": {
+        "source": "fact_transactions",
+        "by": "date",
+        "aggregations": {"transactions": ("transaction_id", "count"), "revenue": ("amount", "sum")},
+    },
+}
+# Function merging the stored aggregates with the aggregates of the new rows
+AGGREGATE_MERGE_FUNCTIONS = {"count": "sum", "sum": "sum", "min": "min", "max": "max"}
+
+
+# Aggregate the rows of a source table by the group column of an aggregate table
+def aggregate_rows(df, aggregate):
+    return df.groupby(aggregate["by"]).agg(**aggregate["aggregations"]).reset_index()
+
+
+# Merge the rows of an aggregate table into one row per group, the columns of the aggregations in df
+def merge_aggregates(df, aggregate):
+    merge_functions = {column: AGGREGATE_MERGE_FUNCTIONS[function]
+                       for column, (_, function) in aggregate["aggregations"].items() if column in df.columns}
+    return df.groupby(aggregate["by"]).agg(merge_functions).reset_index()
+
+
+# Update the aggregate tables of a source table with the rows appended to it. Every commit of an
+# aggregate table records the versions of the source files it aggregates, so the rows appended since
+# are the ones of the later commits, including the rows of a load that failed before updating the
+# aggregates. The aggregates of these rows are appended to the table, without reading it. An aggregate
+# table that does not exist yet is built once from the whole source table, and one written before
+# versions were recorded is appended the aggregates of new_data, the rows just appended. Source rows
+# without the columns of an aggregate are skipped
+@instrument
+def update_aggregate_tables(new_data, table_name):
+    source_path = f"data/gold/{table_name}"
+    source_path = find_table_file(source_path) or source_path
+    for aggregate_name, aggregate in GOLD_AGGREGATES.items():
+        columns = list(dict.fromkeys([aggregate["by"]] + [column for column, _ in aggregate["aggregations"].values()]))
+        if aggregate["source"] != table_name or not set(columns) <= set(new_data.columns):
+            continue
+        path = f"data/gold/{aggregate_name}"
+        file_path = find_table_file(path)
+        metadata = read_table_metadata(file_path) if file_path is not None else None
+        if file_path is None:
+            versions = read_gold_versions(source_path)
+            df_aggregate = aggregate_rows(load_golden_data(table_name, columns), aggregate)
+            rewrite_table(apply_schema(df_aggregate, "gold", aggregate_name), f"{path}.{STORAGE_FORMAT}",
+                          {"versions": versions})
+            continue
+
+        if metadata is None:
+            df_appended, versions = new_data, read_gold_versions(source_path)
+        else:
+            df_appended, versions = read_appended_rows(source_path, metadata["versions"], columns)
+        if df_appended.empty:
+            continue
+        df_delta = aggregate_rows(apply_schema(df_appended, "gold", table_name), aggregate)
+        append_table_rows(apply_schema(df_delta, "gold", aggregate_name), file_path, {"versions": versions})
+
+
+# Save the data to the golden layer, in an incremental way. A gold table keeps the format it was
+# created with, since new rows are appended to it. Partitioned tables stored in a single file by an
+# older version are split into partitions first. Dimensions with history get a new version of every
+# changed row, and the customers deleted by a CDC load are closed. Dimensions get surrogate keys, which
+# replace the natural keys in the fact tables. The rows appended to a fact table update its aggregates
+@instrument
+def save_golden_data(df, table_name, df_changes=None):
+    directory_path = "data/gold"
+    path = f"{directory_path}/{table_name}"
+    file_path = find_table_file(path) or f"{path}.{STORAGE_FORMAT}"
+    if table_name in GOLD_PARTITION_COLUMNS and os.path.exists(file_path):
+        partition_table(file_path, path, GOLD_PARTITION_COLUMNS[table_name])
+    if table_name in GOLD_SURROGATE_KEYS:
+        migrate_surrogate_keys(path, table_name)
+        df = add_surrogate_keys(df, table_name)
+    elif table_name in GOLD_FOREIGN_KEYS:
+        migrate_foreign_keys(path, table_name)
+        df = replace_foreign_keys(df, table_name)
+    df = apply_schema(df, "gold", table_name)
+
+    if table_name in GOLD_PARTITION_COLUMNS:
+        new_data = append_to_partitioned_table(df, path, GOLD_PRIMARY_KEYS[table_name],
+                                               GOLD_PARTITION_COLUMNS[table_name])
+        update_aggregate_tables(new_data, table_name)
+    elif table_name in GOLD_SCD2_TABLES:
+        today = get_partition_date()
+        deleted_keys = [] if df_changes is None else df_changes.loc[
+            df_changes["change_type"] == "delete", "customer_id"]
+        merge_scd2_table(df, file_path, GOLD_PRIMARY_KEYS[table_name], GOLD_SCD2_TABLES[table_name], today,
+                         deleted_keys)
+    elif table_name in GOLD_PRIMARY_KEYS:
+        append_to_indexed_table(df, file_path, GOLD_PRIMARY_KEYS[table_name])
+    elif os.path.exists(file_path):
         append_to_table(df, file_path)
     else:
-        df.to_csv(file_path, index=False)
+        append_table_rows(df, file_path)
+
+
+# Load a table of the golden layer, only the given columns when columns is set. For tables with a date
+# column, start_date and end_date select the rows of a date range, both included; on partitioned
+# tables only the partitions of the range are read. Dimensions with history return every version,
+# or only the current ones with current_only, which does not read the history
+@instrument
+def load_golden_data(table_name, columns=None, start_date=None, end_date=None, current_only=False):
+    df = read_golden_table(table_name, columns, start_date, end_date, current_only)
+    return apply_schema(df, "gold", table_name)
+
+
+def read_golden_table(table_name, columns=None, start_date=None, end_date=None, current_only=False):
+    path = f"data/gold/{table_name}"
+    date_column = GOLD_PARTITION_COLUMNS.get(table_name)
+    if (start_date or end_date) and date_column is None:
+        raise ValueError(f"{table_name} has no date column to select a date range")
+    if current_only and table_name not in GOLD_SCD2_TABLES:
+        raise ValueError(f"{table_name} has no history to select the current rows from")
+
+    if table_name in GOLD_SCD2_TABLES and not current_only:
+        history_file_path = find_table_file(f"{path}_history")
+        if history_file_path is not None:
+            return pd.concat([read_table_file(history_file_path, columns), read_table(path, columns)],
+                             ignore_index=True)
+
+    if is_partitioned_table(path):
+        return read_partitioned_table(path, columns, start_date, end_date, date_column)
+
+    # The delta rows of an aggregate table are merged into one row per group
+    if table_name in GOLD_AGGREGATES:
+        aggregate = GOLD_AGGREGATES[table_name]
+        read_columns = list(dict.fromkeys([aggregate["by"]] + columns)) if columns is not None else None
+        df = merge_aggregates(read_table(path, read_columns), aggregate)
+        return df[columns] if columns is not None else df
+
+    if not (start_date or end_date):
+        return read_table(path, columns)
+    read_columns = columns + [date_column] if columns is not None and date_column not in columns else columns
+    df = filter_date_range(read_table(path, read_columns), date_column, start_date, end_date)
+    return df[columns] if columns is not None else df
+
+
+# Compact every gold table, the partitions of a partitioned table one by one, merging the parts written
+# by the daily loads. Keyed tables drop the rows of a key already seen, the others the repeated rows.
+# Returns the number of parts merged in every table file
+@instrument
+def compact_golden_layer(target_size=COMPACTION_TARGET_SIZE, retention=COMPACTION_RETENTION):
+    directory_path = "data/gold"
+    merged = {}
+    for name in sorted(os.listdir(directory_path)) if os.path.isdir(directory_path) else []:
+        path = f"{directory_path}/{name}"
+        table_name, extension = os.path.splitext(name)
+        if is_partitioned_table(path):
+            file_paths = list_table_files(path)
+        elif os.path.isdir(path) and extension[1:] in STORAGE_FORMATS:
+            file_paths = [path]
+        else:
+            continue
+        merge = None
+        if table_name in GOLD_AGGREGATES:
+            merge = partial(merge_aggregates, aggregate=GOLD_AGGREGATES[table_name])
+        for file_path in file_paths:
+            merged[file_path] = compact_table(file_path, GOLD_PRIMARY_KEYS.get(table_name), target_size, retention,
+                                              merge)
+    return merged
+
+
+# Load the changes of a silver partition created from a CDC bronze partition, None for a full snapshot
+def load_silver_changes():
+    today = get_partition_date()
+    file_path = find_table_file(f"data/silver/{today}/changes")
+    if file_path is None:
+        return None
+    return read_table_file(file_path, dtype=str)
+
+
+# Load an entity from the silver layer and save it in the golden layer. A CDC load without inserted or
+# updated customers has no silver tables, only its deletions are applied
+def update_golden_entity(entity, df_changes=None):
+    table_name = f"{entity['type']}_{entity['table_name']}"
+    today = get_partition_date()
+    if df_changes is not None and find_table_file(f"data/silver/{today}/{entity['table_name']}") is None:
+        df_silver_data = pd.DataFrame(columns=[GOLD_PRIMARY_KEYS[table_name]] + GOLD_SCD2_TABLES.get(table_name, []))
+    else:
+        df_silver_data = load_silver_data(entity["table_name"])
+    save_golden_data(df_silver_data, table_name, df_changes)
 
 
-# Create the golden layer. This runs on daily basis, but it is incremental, there is no need to create the golden layer from scratch
-def create_update_golden_layer():
+# Create the golden layer. This runs on daily basis, but it is incremental, there is no need to create the golden layer from scratch.
+# Every entity is stored in its own tables, so they are loaded on a pool of workers
+@instrument
+def create_update_golden_layer(workers=None, executor=None):
     entities = [
         {"table_name": "transactions", "type": "fact"},
         {"table_name": "customers", "type": "dimension"},
         {"table_name": "products", "type": "dimension"}
     ]
 
+    # Surrogate keys are given before the entities are loaded in parallel, so the workers only read the
+    # key maps. Keys of the transactions are given too, since ids missing from the dimension tables, like
+    # customers dropped for missing values, are only found there
+    today = get_partition_date()
     for entity in entities:
-        df_silver_data = load_silver_data(entity["table_name"])
-        save_golden_data(df_silver_data, f"{entity['type']}_{entity['table_name']}")
-
+        table_name = f"{entity['type']}_{entity['table_name']}"
+        if table_name not in GOLD_SURROGATE_KEYS:
+            continue
+        natural_key = GOLD_SURROGATE_KEYS[table_name][0]
+        for silver_table in [entity["table_name"], "transactions"]:
+            file_path = find_table_file(f"data/silver/{today}/{silver_table}")
+            if file_path is not None and natural_key in read_table_columns(file_path):
+                assign_surrogate_keys(load_silver_data(silver_table, [natural_key])[natural_key],
+                                      f"data/gold/{table_name}")
+
+    df_changes = load_silver_changes()
+    run_parallel([partial(update_golden_entity, entity, df_changes) for entity in entities], workers, executor)
+
+
+# ----------------- Backfill -----------------
+# Reprocess the bronze partitions of a range of dates, after a fix of the silver or gold logic. The
+# silver partitions of the dates do not depend on each other and are created on a pool of workers,
+# a date per worker; the gold layer is then merged one date after the other in date order, as the
+# daily runs would have done
+
+
+# Dates of the range, both included, that have a bronze partition, in date order
+def list_backfill_dates(start_date, end_date):
+    dates = pd.date_range(start_date, end_date).strftime("%Y-%m-%d")
+    return [date for date in dates if os.path.isdir(f"data/bronze/{date}")]
+
+
+# Create the silver partition of a date again, in a worker of the backfill. The tables left by the
+# previous run are removed first; the tables of the date are created one after the other
+def create_silver_partition(date, silver_tables=None):
+    with partition_date(date):
+        shutil.rmtree(f"data/silver/{date}", ignore_errors=True)
+        if silver_tables:
+            create_silver_layer_lazy(silver_tables, 1)
+        else:
+            create_silver_layer(1)
+
+
+# Backfill the silver and gold layers from the bronze partitions of the dates between start_date and
+# end_date. Returns the dates processed. The gold merges are incremental, so rows already stored in
+# the fact tables are kept, and the dimensions with history skip the dates older than their last load,
+# so their history is the same whatever the number of backfills
+@instrument
+def backfill(start_date, end_date, workers=None, executor=None, silver_tables=None):
+    dates = list_backfill_dates(start_date, end_date)
+    run_parallel([partial(create_silver_partition, date, silver_tables) for date in dates], workers, executor)
+    for date in dates:
+        with partition_date(date):
+            create_update_golden_layer(workers, executor)
+    return dates
+
+
+# ----------------- Query Engine -----------------
+# The gold tables are registered in an embedded SQLite database, so BI queries, aggregations and joins
+# of the facts with the dimensions run in SQL without loading the tables in pandas. The tables are
+# copied chunk by chunk and indexed on the keys they are joined and filtered on. The database records
+# the part files registered for every table and the rows they were copied to, so every registration
+# only copies the parts committed since the last one, and deletes the rows of the parts removed since
+
+GOLD_DATABASE = "data/gold.sqlite"
+# Number of rows copied at once to the database
+DATABASE_CHUNK_SIZE = 100_000
+# Columns indexed in the database for every gold table
+GOLD_DATABASE_INDEXES = {
+    "fact_transactions": ["customer_key", "product_key", "date"],
+    "dimension_customers": ["customer_key", "customer_id"],
+    "dimension_products": ["product_key", "product_id"],
+    "agg_customer_spend": ["customer_key"],
+    "agg_product_revenue": ["product_key"],
+    "agg_daily_revenue": ["date"],
+}
+# Table of the database with the part files registered, by path from the gold layer, and the first and
+# last rowid of their rows
+DATABASE_PARTS_TABLE = "_gold_parts"
+# Suffix of the database tables with the delta rows of the aggregate tables, which are queried through
+# a view of the aggregate table merging them into one row per group
+DATABASE_DELTAS_SUFFIX = "_deltas"
+
+
+# Table of the database a gold table is copied to
+def get_database_table(table_name):
+    return f"{table_name}{DATABASE_DELTAS_SUFFIX}" if table_name in GOLD_AGGREGATES else table_name
+
+
+# Create the view of an aggregate table, merging its delta rows into one row per group like
+# merge_aggregates. Dates are stored as text that sorts like the dates, for MIN and MAX
+def create_aggregate_view(connection, table_name):
+    aggregate = GOLD_AGGREGATES[table_name]
+    merged = ", ".join(f'{AGGREGATE_MERGE_FUNCTIONS[function].upper()}("{column}") AS "{column}"'
+                       for column, (_, function) in aggregate["aggregations"].items())
+    connection.execute(f'CREATE VIEW {table_name} AS SELECT "{aggregate["by"]}", {merged} '
+                       f'FROM {get_database_table(table_name)} GROUP BY "{aggregate["by"]}"')
+
+
+# Drop a table or a view of the database, if it exists
+def drop_database_table(connection, name):
+    row = connection.execute("SELECT type FROM sqlite_master WHERE type IN ('table', 'view') AND name = ?",
+                             [name]).fetchone()
+    if row is not None:
+        connection.execute(f"DROP {row[0].upper()} {name}")
+
+
+# Values of the rows of a chunk, as stored by the database: dates as text, missing values as NULL
+def to_database_rows(df):
+    columns = []
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = values.dt.strftime("%Y-%m-%d %H:%M:%S")
+        columns.append([None if pd.isna(v) else v.item() if isinstance(v, np.generic) else v
+                        for v in values.tolist()])
+    return list(zip(*columns))
+
+
+# Copy the rows of a part file to its table in the database, created and indexed with the first part.
+# The rows of a part get consecutive rowids, which are recorded with the part
+def register_part(connection, table_name, columns, part, part_path, chunk_size):
+    database_table = get_database_table(table_name)
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                [database_table]).fetchone()
+    first_row = connection.execute(f"SELECT COALESCE(MAX(rowid), 0) + 1 FROM {database_table}").fetchone()[0] \
+        if exists else 1
+    for df_chunk in iter_table_file_chunks(part_path, chunk_size):
+        df_chunk = apply_schema(df_chunk, "gold", table_name)
+        if not exists:
+            connection.execute(pd.io.sql.get_schema(df_chunk, database_table, con=connection))
+            for column in columns:
+                connection.execute(f"CREATE INDEX idx_{database_table}_{column} ON {database_table} ({column})")
+            exists = True
+        names = ", ".join(f'"{column}"' for column in df_chunk.columns)
+        connection.executemany(f"INSERT INTO {database_table} ({names}) "
+                               f"VALUES ({', '.join('?' * df_chunk.shape[1])})", to_database_rows(df_chunk))
+    last_row = connection.execute(f"SELECT COALESCE(MAX(rowid), 0) FROM {database_table}").fetchone()[0] \
+        if exists else 0
+    connection.execute(f"INSERT INTO {DATABASE_PARTS_TABLE} VALUES (?, ?, ?, ?)",
+                       [table_name, part, first_row, last_row])
+
+
+# Register the gold tables in the database and index them. Only the parts committed since the last
+# registration are copied, and the rows of the parts no longer in the tables, rewritten or compacted,
+# are deleted. Everything is done in a single transaction, so queries never see a partial copy. A
+# database written by an older version, without the parts registered, is copied again, and so are the
+# aggregate tables of one copied before they were views of their delta rows. Dimensions with history are
+# copied with every version, current ones have current = 1
+@instrument
+def register_gold_tables(database=GOLD_DATABASE, chunk_size=DATABASE_CHUNK_SIZE):
+    connection = sqlite3.connect(database)
+    try:
+        connection.execute("BEGIN")
+        if not connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                  [DATABASE_PARTS_TABLE]).fetchone():
+            for table_name in GOLD_DATABASE_INDEXES:
+                drop_database_table(connection, table_name)
+                drop_database_table(connection, get_database_table(table_name))
+            connection.execute(f"CREATE TABLE {DATABASE_PARTS_TABLE} "
+                               "(table_name TEXT, part TEXT, first_row INTEGER, last_row INTEGER)")
+        for table_name in GOLD_AGGREGATES:
+            if connection.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                                  [table_name]).fetchone():
+                connection.execute(f"DROP TABLE {table_name}")
+                drop_database_table(connection, get_database_table(table_name))
+                connection.execute(f"DELETE FROM {DATABASE_PARTS_TABLE} WHERE table_name = ?", [table_name])
+
+        for table_name, columns in GOLD_DATABASE_INDEXES.items():
+            path = f"data/gold/{table_name}"
+            paths = [path, f"{path}_history"] if table_name in GOLD_SCD2_TABLES else [path]
+            part_paths = {os.path.relpath(part_path, "data/gold"): part_path
+                          for table_path in paths for part_path in list_table_parts(table_path)}
+            registered = connection.execute(f"SELECT part, first_row, last_row FROM {DATABASE_PARTS_TABLE} "
+                                            "WHERE table_name = ?", [table_name]).fetchall()
+            for part, first_row, last_row in registered:
+                if part not in part_paths:
+                    connection.execute(f"DELETE FROM {get_database_table(table_name)} WHERE rowid BETWEEN ? AND ?",
+                                       [first_row, last_row])
+                    connection.execute(f"DELETE FROM {DATABASE_PARTS_TABLE} WHERE table_name = ? AND part = ?",
+                                       [table_name, part])
+            registered_parts = {part for part, _, _ in registered}
+            for part, part_path in part_paths.items():
+                if part not in registered_parts:
+                    register_part(connection, table_name, columns, part, part_path, chunk_size)
+            if table_name in GOLD_AGGREGATES and part_paths and not connection.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = ?", [table_name]).fetchone():
+                create_aggregate_view(connection, table_name)
+        connection.commit()
+    finally:
+        connection.close()
+
+
+# Run a SQL query on the gold database and return its result. The database is opened read only
+def query_gold(sql, params=None, database=GOLD_DATABASE):
+    connection = sqlite3.connect(f"file:{database}?mode=ro", uri=True)
+    try:
+        return pd.read_sql_query(sql, connection, params=params)
+    finally:
+        connection.close()
+
+
+# ----------------- Pipeline Runner -----------------
+# The layers are stages of a small DAG. Every stage declares the files it reads and writes, and is
+# skipped when its outputs exist and were produced from inputs with the same content and parameters.
+# Fingerprints of the inputs and of the completed stages are kept in a state file, so re-runs and
+# runs after a partial failure only do the work that changed
+
+PIPELINE_STATE_FILE = "data/.pipeline_state.json"
+
+
+# List the files of a path, every file of a directory, sorted so the fingerprints are stable
+def list_files(path):
+    if os.path.isfile(path):
+        return [path]
+    files = []
+    for directory_path, directories, file_names in os.walk(path):
+        directories.sort()
+        files.extend(os.path.join(directory_path, file_name) for file_name in sorted(file_names))
+    return files
+
+
+# Hash the content of a file. The hash is cached with the size and modification time of the file, so
+# files that did not change are not read again
+def hash_file(file_path, file_hashes):
+    stat = os.stat(file_path)
+    cached = file_hashes.get(file_path)
+    if cached and cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+        return cached["sha256"]
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(partial(f.read, 1 << 20), b""):
+            digest.update(block)
+    file_hashes[file_path] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+    return digest.hexdigest()
+
+
+# Fingerprint of a stage: its name, its parameters and the content of all its input files
+def fingerprint_stage(stage, file_hashes):
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage["name"], stage.get("params", {})], sort_keys=True, default=str).encode())
+    for path in stage["inputs"]:
+        files = list_files(path)
+        digest.update(f"{path}:{len(files)}".encode())
+        for file_path in files:
+            digest.update(f"{file_path}:{hash_file(file_path, file_hashes)}".encode())
+    return digest.hexdigest()
+
+
+def load_pipeline_state(state_file):
+    if not os.path.exists(state_file):
+        return {"stages": {}, "files": {}}
+    with open(state_file) as f:
+        return json.load(f)
+
+
+# Save the state of the pipeline atomically, dropping the hashes of files that no longer exist
+def save_pipeline_state(state, state_file):
+    state["files"] = {path: value for path, value in state["files"].items() if os.path.exists(path)}
+    os.makedirs(os.path.dirname(state_file) or ".", exist_ok=True)
+    with open(f"{state_file}.tmp", "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.replace(f"{state_file}.tmp", state_file)
+
+
+# Order the stages so every stage comes after the stages it depends on
+def order_stages(stages):
+    stages_by_name = {stage["name"]: stage for stage in stages}
+    ordered = []
+    visited = set()
+    visiting = set()
+
+    def visit(stage):
+        if stage["name"] in visited:
+            return
+        if stage["name"] in visiting:
+            raise ValueError(f"Cycle in the pipeline at stage {stage['name']}")
+        visiting.add(stage["name"])
+        for name in stage.get("depends_on", []):
+            visit(stages_by_name[name])
+        visiting.discard(stage["name"])
+        visited.add(stage["name"])
+        ordered.append(stage)
+
+    for stage in stages:
+        visit(stage)
+    return ordered
+
+
+# Run the stages in dependency order, skipping those whose outputs are current. The state is saved
+# after every stage, so a failure does not lose the stages already completed. Returns the name of
+# every stage with "run" or "skipped"
+def run_pipeline(stages, force=False, state_file=PIPELINE_STATE_FILE):
+    state = load_pipeline_state(state_file)
+    results = {}
+    for stage in order_stages(stages):
+        fingerprint = fingerprint_stage(stage, state["files"])
+        outputs_exist = all(os.path.exists(path) for path in stage["outputs"])
+        if not force and outputs_exist and state["stages"].get(stage["name"]) == fingerprint:
+            results[stage["name"]] = "skipped"
+            continue
+
+        stage["function"]()
+        state["stages"][stage["name"]] = fingerprint
+        save_pipeline_state(state, state_file)
+        results[stage["name"]] = "run"
+    return results
+
+
+# Stages of the medallion pipeline for the source file. Every layer reads the partition of the day
+# written by the previous one, so a layer whose input did not change is skipped
+def create_pipeline_stages(source_file="data/customers.json", streaming=False, split_transactions=False,
+                           workers=None, silver_chunk_size=None, cdc=False, silver_tables=None):
+    today = get_partition_date()
+    params = {"date": today, "storage_format": STORAGE_FORMAT}
+    if silver_tables:
+        create_silver = partial(create_silver_layer_lazy, silver_tables, workers)
+    elif silver_chunk_size:
+        create_silver = partial(create_silver_layer_chunked, silver_chunk_size, workers)
+    else:
+        create_silver = partial(create_silver_layer, workers)
+
+    return [
+        {"name": "layers", "function": create_layers, "inputs": [],
+         "outputs": ["data/bronze", "data/silver", "data/gold"]},
+        {"name": "bronze", "depends_on": ["layers"],
+         "function": partial(create_bronze_layer, source_file, streaming, split_transactions=split_transactions,
+                             cdc=cdc),
+         "inputs": [source_file], "outputs": [f"data/bronze/{today}"],
+         "params": {**params, "split_transactions": split_transactions, "cdc": cdc}},
+        {"name": "silver", "depends_on": ["bronze"], "function": create_silver,
+         "inputs": [f"data/bronze/{today}"], "outputs": [f"data/silver/{today}"],
+         "params": {**params, "silver_tables": silver_tables}},
+        {"name": "gold", "depends_on": ["silver"], "function": partial(create_update_golden_layer, workers),
+         "inputs": [f"data/silver/{today}"], "outputs": ["data/gold"], "params": params},
+        {"name": "database", "depends_on": ["gold"], "function": register_gold_tables,
+         "inputs": ["data/gold"], "outputs": [GOLD_DATABASE]},
+    ]
 
-if __name__ == "__main__":
-    create_layers()
 
-    # Create the bronze layer
-    create_bronze_layer()
+# ----------------- Object Storage -----------------
+# The data tree can be kept in an Azure Blob Storage container, or in an emulator of its API like
+# Azurite, instead of the local disk only. The layers work on a local copy of the tree, which is
+# synchronized with the container: the files changed in the container are downloaded before a run, and
+# the files the run changed are uploaded after it. A run only downloads what it reads: the partitions of
+# its dates and the files describing the gold tables, while the part files of the gold tables are left
+# in the container until the run opens them. Blobs are named after the path of their file. Files larger
+# than a block are sent and received in blocks, several at a time, read from and written to the file
+# directly, and requests reuse a pool of keep-alive connections
+
+# "local" keeps the data tree on the local disk only, "blob" synchronizes it with a blob container
+STORAGE_BACKEND = "local"
+STORAGE_BACKENDS = ["local", "blob"]
+# Environment variables with the connection string of the storage account and the name of the container
+STORAGE_CONNECTION_VARIABLE = "PIPELINE_STORAGE_CONNECTION_STRING"
+STORAGE_CONTAINER_VARIABLE = "PIPELINE_STORAGE_CONTAINER"
+STORAGE_CONTAINER = "lakehouse"
+# Size of the blocks of a transfer, number of concurrent requests and attempts of a request
+BLOB_BLOCK_SIZE = 8 * 2**20
+BLOB_CONCURRENCY = 8
+BLOB_ATTEMPTS = 3
+BLOB_TIMEOUT = 60
+BLOB_API_VERSION = "2021-08-06"
+# Size and modification time of every file of the local copy when it was last synchronized, and the
+# ETag of its blob then
+STORAGE_MANIFEST_FILE = "data/.storage_manifest.json"
+# Files downloaded when they were opened, a JSON line per file appended by every process of the run,
+# merged into the manifest when it is next loaded
+STORAGE_JOURNAL_FILE = "data/.storage_journal.jsonl"
+# Client, process and blobs of the part files left in the container by the last pull, downloaded when
+# they are opened. Worker processes forked by the run inherit them
+REMOTE_FILES = SimpleNamespace(client=None, pid=None, blobs={})
+
+
+# Connect to the blob container set by the environment, None with the local backend. The container is
+# created when it does not exist yet
+def connect_storage(backend=None):
+    if (backend or STORAGE_BACKEND) != "blob":
+        return None
+    connection_string = os.environ.get(STORAGE_CONNECTION_VARIABLE)
+    if not connection_string:
+        raise ValueError(f"{STORAGE_CONNECTION_VARIABLE} must be set to use the blob storage backend")
+
+    settings = dict(item.split("=", 1) for item in connection_string.split(";") if item)
+    endpoint = settings.get("BlobEndpoint") or (f"{settings.get('DefaultEndpointsProtocol', 'https')}://"
+                                                f"{settings['AccountName']}.blob."
+                                                f"{settings.get('EndpointSuffix', 'core.windows.net')}")
+    url = urllib.parse.urlsplit(endpoint)
+    client = {
+        "account": settings["AccountName"],
+        "key": base64.b64decode(settings["AccountKey"]),
+        "scheme": url.scheme,
+        "host": url.netloc,
+        # Emulators serve the account in the path of the endpoint
+        "path": url.path.rstrip("/"),
+        "container": os.environ.get(STORAGE_CONTAINER_VARIABLE, STORAGE_CONTAINER),
+        "connections": queue.LifoQueue(),
+    }
+    status, _, data = blob_request(client, "PUT", query={"restype": "container"})
+    check_blob_response(status, data, (201, 409))
+    return client
+
+
+# Close the connections of the pool of a client
+def close_storage(client):
+    if client is None:
+        return
+    while True:
+        try:
+            client["connections"].get_nowait().close()
+        except queue.Empty:
+            return
+
+
+# Sign a request with the shared key of the account
+def sign_blob_request(client, method, path, query, headers):
+    standard_headers = ["Content-Encoding", "Content-Language", "Content-Length", "Content-MD5", "Content-Type",
+                        "Date", "If-Modified-Since", "If-Match", "If-None-Match", "If-Unmodified-Since", "Range"]
+    values = [headers.get(header, "") for header in standard_headers]
+    # An empty body is signed without length
+    values[2] = "" if values[2] == "0" else values[2]
+    canonical_headers = "".join(f"{name}:{value}\n" for name, value in
+                                sorted((name.lower(), value) for name, value in headers.items()
+                                       if name.lower().startswith("x-ms-")))
+    canonical_resource = f"/{client['account']}{path}" + "".join(
+        f"\n{name.lower()}:{value}" for name, value in sorted(query.items()))
+    string_to_sign = "\n".join([method] + values) + "\n" + canonical_headers + canonical_resource
+    signature = hmac.new(client["key"], string_to_sign.encode(), hashlib.sha256).digest()
+    return f"SharedKey {client['account']}:{base64.b64encode(signature).decode()}"
+
+
+# Borrow a connection of the pool of the client, opened when the pool is empty. A connection is only
+# given back after a complete exchange, a failed one is closed
+@contextmanager
+def pooled_connection(client):
+    try:
+        connection = client["connections"].get_nowait()
+    except queue.Empty:
+        connection_class = http.client.HTTPSConnection if client["scheme"] == "https" else http.client.HTTPConnection
+        connection = connection_class(client["host"], timeout=BLOB_TIMEOUT)
+    try:
+        yield connection
+    except BaseException:
+        connection.close()
+        raise
+    client["connections"].put(connection)
+
+
+# Send a request on the container, or on one of its blobs, and return the status, headers and body of
+# the response. All the requests sent are idempotent, a request failed on a closed connection is sent again
+def blob_request(client, method, blob_name=None, body=None, headers=None, query=None):
+    path = f"{client['path']}/{client['container']}"
+    if blob_name is not None:
+        path += f"/{urllib.parse.quote(blob_name)}"
+    query = query or {}
+    url = f"{path}?{urllib.parse.urlencode(query)}" if query else path
+
+    for attempt in range(BLOB_ATTEMPTS):
+        request_headers = {"x-ms-date": formatdate(usegmt=True), "x-ms-version": BLOB_API_VERSION,
+                           "Content-Length": str(len(body or b"")), **(headers or {})}
+        request_headers["Authorization"] = sign_blob_request(client, method, path, query, request_headers)
+        try:
+            with pooled_connection(client) as connection:
+                connection.request(method, url, body=body, headers=request_headers)
+                response = connection.getresponse()
+                data = response.read()
+            return response.status, response.headers, data
+        except (ConnectionError, http.client.HTTPException):
+            if attempt == BLOB_ATTEMPTS - 1:
+                raise
+
+
+def check_blob_response(status, data, expected_statuses):
+    if status not in expected_statuses:
+        raise OSError(f"Blob storage request failed with status {status}: {data[:500].decode(errors='replace')}")
+
+
+# List the blobs whose name is path or is below the directory path, with their size and ETag
+def list_blobs(client, path):
+    blobs = {}
+    marker = None
+    while True:
+        query = {"restype": "container", "comp": "list", "prefix": path}
+        if marker:
+            query["marker"] = marker
+        status, _, data = blob_request(client, "GET", query=query)
+        check_blob_response(status, data, (200,))
+        root = ElementTree.fromstring(data)
+        for blob in root.iter("Blob"):
+            name = blob.findtext("Name")
+            if name == path or name.startswith(f"{path}/"):
+                properties = blob.find("Properties")
+                blobs[name] = {"size": int(properties.findtext("Content-Length")),
+                               "etag": properties.findtext("Etag").strip('"')}
+        marker = root.findtext("NextMarker")
+        if not marker:
+            return blobs
+
+
+# Upload a block of a file, read from the file when it is sent
+def upload_block(client, file_path, blob_name, block_id, offset):
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        body = f.read(BLOB_BLOCK_SIZE)
+    status, _, data = blob_request(client, "PUT", blob_name, body, query={"comp": "block", "blockid": block_id})
+    check_blob_response(status, data, (201,))
+
+
+# Upload a file as the blob named after its path and return its ETag. A file larger than a block is
+# uploaded as blocks sent at the same time on the pool, then committed at once, so the blob is never
+# seen half written
+def upload_blob(client, file_path, pool=None):
+    blob_name = file_path
+    size = os.path.getsize(file_path)
+    if size <= BLOB_BLOCK_SIZE or pool is None:
+        with open(file_path, "rb") as f:
+            body = f.read()
+        status, headers, data = blob_request(client, "PUT", blob_name, body, {"x-ms-blob-type": "BlockBlob"})
+        check_blob_response(status, data, (201,))
+        return headers["ETag"].strip('"')
+
+    offsets = range(0, size, BLOB_BLOCK_SIZE)
+    block_ids = [base64.b64encode(f"{number:08d}".encode()).decode() for number in range(len(offsets))]
+    list(pool.map(partial(upload_block, client, file_path, blob_name), block_ids, offsets))
+    body = "".join(f"<Latest>{block_id}</Latest>" for block_id in block_ids)
+    body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{body}</BlockList>'.encode()
+    status, headers, data = blob_request(client, "PUT", blob_name, body, query={"comp": "blocklist"})
+    check_blob_response(status, data, (201,))
+    return headers["ETag"].strip('"')
+
+
+# Download a range of a blob into the same range of a file. The ETag makes sure every range comes from
+# the same version of the blob
+def download_range(client, blob_name, etag, file_path, offset):
+    headers = {"x-ms-range": f"bytes={offset}-{offset + BLOB_BLOCK_SIZE - 1}", "If-Match": f'"{etag}"'}
+    status, _, data = blob_request(client, "GET", blob_name, headers=headers)
+    check_blob_response(status, data, (206,))
+    with open(file_path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+# Download a blob into the file of the same path. A blob larger than a block is downloaded as ranges
+# received at the same time on the pool, and written in place in the file
+def download_blob(client, blob_name, blob, pool=None):
+    file_path = blob_name
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    if blob["size"] <= BLOB_BLOCK_SIZE or pool is None:
+        status, _, data = blob_request(client, "GET", blob_name, headers={"If-Match": f'"{blob["etag"]}"'})
+        check_blob_response(status, data, (200,))
+        with open(file_path, "wb") as f:
+            f.write(data)
+        return
+
+    with open(file_path, "wb") as f:
+        f.truncate(blob["size"])
+    list(pool.map(partial(download_range, client, blob_name, blob["etag"], file_path),
+                  range(0, blob["size"], BLOB_BLOCK_SIZE)))
+
+
+def delete_blob(client, blob_name):
+    status, _, data = blob_request(client, "DELETE", blob_name)
+    check_blob_response(status, data, (202, 404))
+
+
+# Load the manifest, with the files downloaded when they were opened since it was saved
+def load_storage_manifest():
+    manifest = {}
+    if os.path.exists(STORAGE_MANIFEST_FILE):
+        with open(STORAGE_MANIFEST_FILE) as f:
+            manifest = json.load(f)
+    if os.path.exists(STORAGE_JOURNAL_FILE):
+        with open(STORAGE_JOURNAL_FILE) as f:
+            for line in f:
+                name, stat, etag = json.loads(line)
+                manifest[name] = {"stat": stat, "etag": etag}
+    return manifest
+
+
+def save_storage_manifest(manifest):
+    os.makedirs(os.path.dirname(STORAGE_MANIFEST_FILE), exist_ok=True)
+    with open(f"{STORAGE_MANIFEST_FILE}.tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(f"{STORAGE_MANIFEST_FILE}.tmp", STORAGE_MANIFEST_FILE)
+    if os.path.exists(STORAGE_JOURNAL_FILE):
+        os.remove(STORAGE_JOURNAL_FILE)
+
+
+# Size and modification time of a file, to find the files changed since they were synchronized
+def get_file_stat(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def is_below_paths(name, paths):
+    return any(name == path or name.startswith(f"{path}/") for path in paths)
+
+
+# Transfer files with the function, called with every tuple of arguments. Small files are transferred
+# several at a time on the pool, and large files one after the other, their blocks at the same time on
+# the pool. Returns the results in the order of the arguments
+def transfer_files(function, arguments, sizes, pool):
+    futures = [pool.submit(function, *args) if size <= BLOB_BLOCK_SIZE else None
+               for args, size in zip(arguments, sizes)]
+    return [future.result() if future is not None else function(*args, pool=pool)
+            for args, future in zip(arguments, futures)]
+
+
+# Download the blobs below the given paths that changed since the local copy was last synchronized,
+# and remove the files whose blob was deleted. Files changed locally but not in the container are kept.
+# Below lazy_paths, the part files are not downloaded but left to fetch_remote_files, and only the files
+# describing the tables, like their commit logs and indexes, are
+def pull_paths(client, paths, lazy_paths=()):
+    manifest = load_storage_manifest()
+    paths = list(paths) + list(lazy_paths)
+    blobs = {}
+    for path in paths:
+        blobs.update(list_blobs(client, path))
+    changed = [name for name, blob in blobs.items()
+               if manifest.get(name, {}).get("etag") != blob["etag"] or not os.path.exists(name)]
+    lazy = {name for name in changed
+            if is_below_paths(name, lazy_paths) and os.path.basename(name).startswith("part-")}
+    REMOTE_FILES.client, REMOTE_FILES.pid = client, os.getpid()
+    REMOTE_FILES.blobs = {name: blobs[name] for name in lazy}
+    changed = [name for name in changed if name not in lazy]
+
+    with ThreadPoolExecutor(BLOB_CONCURRENCY) as pool:
+        transfer_files(partial(download_blob, client), [(name, blobs[name]) for name in changed],
+                       [blobs[name]["size"] for name in changed], pool)
+    for name in changed:
+        manifest[name] = {"stat": get_file_stat(name), "etag": blobs[name]["etag"]}
+    for name in [name for name in manifest if is_below_paths(name, paths) and name not in blobs]:
+        if os.path.exists(name):
+            os.remove(name)
+        del manifest[name]
+    save_storage_manifest(manifest)
+    return changed
+
+
+# Upload the files below the given paths that changed since the local copy was last synchronized, and
+# delete the blobs of the files removed since
+def push_paths(client, paths):
+    manifest = load_storage_manifest()
+    files = [file_path for path in paths for file_path in list_files(path)
+             if not file_path.startswith((STORAGE_MANIFEST_FILE, STORAGE_JOURNAL_FILE))]
+    changed = [file_path for file_path in files
+               if manifest.get(file_path, {}).get("stat") != get_file_stat(file_path)]
+    removed = [name for name in manifest if is_below_paths(name, paths) and not os.path.exists(name)]
+
+    with ThreadPoolExecutor(BLOB_CONCURRENCY) as pool:
+        etags = transfer_files(partial(upload_blob, client), [(file_path,) for file_path in changed],
+                               [os.path.getsize(file_path) for file_path in changed], pool)
+        list(pool.map(partial(delete_blob, client), removed))
+    for file_path, etag in zip(changed, etags):
+        manifest[file_path] = {"stat": get_file_stat(file_path), "etag": etag}
+    for name in removed:
+        del manifest[name]
+    save_storage_manifest(manifest)
+    return changed
+
+
+# Download the given files of the tree left in the container by the last pull, before they are opened.
+# A worker process opens its own connections, since the pool of the client belongs to the run
+def fetch_remote_files(file_paths):
+    missing = [name for name in file_paths if name in REMOTE_FILES.blobs and not os.path.exists(name)]
+    if not missing:
+        return
+    if REMOTE_FILES.pid != os.getpid():
+        REMOTE_FILES.client = {**REMOTE_FILES.client, "connections": queue.LifoQueue()}
+        REMOTE_FILES.pid = os.getpid()
+    blobs = REMOTE_FILES.blobs
+    with ThreadPoolExecutor(BLOB_CONCURRENCY) as pool:
+        transfer_files(partial(download_blob, REMOTE_FILES.client), [(name, blobs[name]) for name in missing],
+                       [blobs[name]["size"] for name in missing], pool)
+    with open(STORAGE_JOURNAL_FILE, "a") as f:
+        f.writelines(json.dumps([name, get_file_stat(name), blobs[name]["etag"]]) + "\n" for name in missing)
+
+
+# Download what a run of the pipeline reads instead of the whole tree: its state, the source file when
+# it is in the tree, the bronze and silver partitions of the dates, the hashes of the last bronze
+# partition before them for a CDC load, the gold database and the gold layer, whose part files are only
+# downloaded when they are opened
+def pull_run_paths(client, dates, source_file=None, cdc=False):
+    paths = [PIPELINE_STATE_FILE, GOLD_DATABASE] + ([source_file] if source_file else [])
+    paths += [f"data/{layer}/{date}" for date in dates for layer in ["bronze", "silver"]]
+    if cdc:
+        hashes = [name for name in list_blobs(client, "data/bronze")
+                  if name.split("/")[2] < min(dates) and os.path.basename(name).startswith("hashes.")]
+        paths += [max(hashes)] if hashes else []
+    return pull_paths(client, paths, lazy_paths=["data/gold"])
 
-    # Create the silver layer
-    create_silver_layer()
 
-    # Crete the golden layer
-    create_update_golden_layer()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Medallion pipeline: bronze, silver and gold layers")
+    parser.add_argument("source_file", nargs="?", default="data/customers.json")
+    parser.add_argument("--force", action="store_true", help="run every stage, even when its outputs are current")
+    parser.add_argument("--storage-format", choices=STORAGE_FORMATS, default=STORAGE_FORMAT)
+    parser.add_argument("--storage-backend", choices=STORAGE_BACKENDS, default=STORAGE_BACKEND,
+                        help=f"synchronize the data tree with the blob container set by {STORAGE_CONNECTION_VARIABLE}")
+    parser.add_argument("--streaming", action="store_true", help="read the source file in chunks")
+    parser.add_argument("--split-transactions", action="store_true",
+                        help="store the transactions of the bronze layer in their own table")
+    parser.add_argument("--cdc", action="store_true",
+                        help="only process the customers changed since the previous bronze partition")
+    parser.add_argument("--workers", type=int, default=PIPELINE_WORKERS)
+    parser.add_argument("--silver-chunk-size", type=int, help="create the silver layer in shards of customers")
+    parser.add_argument("--silver-tables", nargs="+", choices=list(SILVER_TABLES),
+                        help="only compute and save these silver tables, from the bronze columns they need")
+    parser.add_argument("--query", help="run a SQL query on the gold database instead of the pipeline")
+    parser.add_argument("--backfill", nargs=2, metavar=("START_DATE", "END_DATE"),
+                        help="reprocess the silver and gold layers from the bronze partitions of these dates")
+    parser.add_argument("--describe", nargs=2, metavar=("LAYER", "TABLE"),
+                        help="profile a bronze or silver table across its partitions, from their statistics")
+    parser.add_argument("--compact", action="store_true",
+                        help="merge the small part files of the gold tables instead of running the pipeline")
+    parser.add_argument("--metrics", help="write the metrics of the instrumented functions to this JSON file")
+    parser.add_argument("--trace-memory", action="store_true", help="record the memory peak of every call")
+    parser.add_argument("--profile", help="run under cProfile and write the statistics to this file")
+    args = parser.parse_args()
+    STORAGE_FORMAT = args.storage_format
+    # With the blob backend the run works on a local copy of the data tree, synchronized before and after
+    storage = connect_storage(args.storage_backend)
+    # The connections of the pool are closed whatever the command run
+    atexit.register(close_storage, storage)
+
+    if args.query:
+        if storage:
+            pull_paths(storage, [GOLD_DATABASE])
+        print(query_gold(args.query).to_string(index=False))
+        raise SystemExit
+
+    if args.describe:
+        if storage:
+            pull_paths(storage, [f"data/{args.describe[0]}"])
+        print(profile_table(*args.describe).to_string())
+        raise SystemExit
+
+    if args.compact:
+        if storage:
+            pull_paths(storage, ["data/gold"])
+        for file_path, merged in compact_golden_layer().items():
+            print(f"{file_path}: {merged} parts merged")
+        if storage:
+            push_paths(storage, ["data/gold"])
+        raise SystemExit
+
+    if storage:
+        if args.backfill:
+            pull_run_paths(storage, list(pd.date_range(*args.backfill).strftime("%Y-%m-%d")))
+        else:
+            pull_run_paths(storage, [get_partition_date()], args.source_file, args.cdc)
+    try:
+        with collect_metrics(args.metrics, args.trace_memory, args.profile):
+            if args.backfill:
+                dates = backfill(*args.backfill, args.workers, silver_tables=args.silver_tables)
+                register_gold_tables()
+            else:
+                stages = create_pipeline_stages(args.source_file, args.streaming, args.split_transactions,
+                                                args.workers, args.silver_chunk_size, args.cdc, args.silver_tables)
+                results = run_pipeline(stages, args.force)
+    finally:
+        # The outputs of the stages completed are kept even when a later one fails
+        if storage:
+            push_paths(storage, ["data"])
+
+    if args.backfill:
+        print(f"backfilled: {', '.join(dates) or 'no bronze partition in the range'}")
+    else:
+        for name, result in results.items():
+            print(f"{name}: {result}")
@@ -1,31 +1,172 @@
+import base64
+import hashlib
+import hmac
+import io
 import json
 import os
 import shutil
+import threading
 import unittest
+import urllib.parse
+from contextlib import redirect_stdout
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
 from unittest.mock import patch
 
+import numpy as np
 import pandas as pd
 
+import main
 from main import (
+    append_table_rows,
+    append_to_indexed_table,
     append_to_table,
+    apply_schema,
+    backfill,
     check_directory,
+    collect_metrics,
+    connect_storage,
+    convert_to_split_tables,
     convert_to_tabular,
+    create_bronze_layer,
     create_customer_table,
     create_layers,
     create_product_table,
+    create_silver_layer,
+    create_silver_layer_chunked,
+    create_silver_layer_lazy,
     create_transaction_table,
+    create_update_golden_layer,
+    explode_transactions,
+    find_table_file,
     get_basic_statistics,
+    get_index_path,
     get_last_transaction,
     get_total_spent,
+    iter_customer_chunks,
+    iter_json_array,
     load_bronze_data,
+    load_golden_data,
     load_silver_data,
     open_file,
+    parse_transactions,
+    plan_silver_tables,
+    pull_paths,
+    push_paths,
+    query_gold,
+    read_table,
+    read_table_file,
     rearrange_data,
+    rearrange_data_rowwise,
+    register_gold_tables,
+    run_parallel,
+    run_pipeline,
+    sanity_check,
     save_bronze_data,
     save_golden_data,
     save_silver_data,
+    write_table,
 )
 
+# Account and key of the Azurite storage emulator
+EMULATOR_ACCOUNT = "devstoreaccount1"
+EMULATOR_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+
+# Start an in-memory emulator of the blob storage API, with the requests of the pipeline only. Requests
+# must be signed with the key of the emulator account. Listings return two blobs per page
+def start_blob_emulator():
+    blobs, blocks = {}, {}
+    server_stats = {"connections": 0, "requests": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            server_stats["connections"] += 1
+
+        def log_message(self, *args):
+            pass
+
+        def check_signature(self, path, query):
+            headers = ["Content-Encoding", "Content-Language", "Content-Length", "Content-MD5", "Content-Type",
+                       "Date", "If-Modified-Since", "If-Match", "If-None-Match", "If-Unmodified-Since", "Range"]
+            values = [self.headers.get(header, "") for header in headers]
+            values[2] = "" if values[2] == "0" else values[2]
+            ms_headers = sorted((k.lower(), v) for k, v in self.headers.items() if k.lower().startswith("x-ms-"))
+            string_to_sign = "\n".join([self.command] + values) + "\n"
+            string_to_sign += "".join(f"{k}:{v}\n" for k, v in ms_headers) + f"/{EMULATOR_ACCOUNT}{path}"
+            string_to_sign += "".join(f"\n{k}:{v[0]}" for k, v in sorted(query.items()))
+            signature = base64.b64encode(hmac.new(base64.b64decode(EMULATOR_KEY), string_to_sign.encode(),
+                                                  hashlib.sha256).digest()).decode()
+            return self.headers.get("Authorization") == f"SharedKey {EMULATOR_ACCOUNT}:{signature}"
+
+        def respond(self, status, body=b"", headers=None):
+            self.send_response(status)
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def handle_request(self):
+            server_stats["requests"] += 1
+            url = urllib.parse.urlsplit(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if not self.check_signature(url.path, query):
+                return self.respond(403)
+            # Blobs are stored with the name of their container
+            container = url.path.split("/")[2]
+            name = urllib.parse.unquote(url.path).split("/", 2)[2] if url.path.count("/") > 2 else None
+            comp = query.get("comp", [None])[0]
+
+            if self.command == "PUT" and name is None:
+                return self.respond(201)
+            if self.command == "PUT" and comp == "block":
+                blocks[(name, query["blockid"][0])] = body
+                return self.respond(201)
+            if self.command == "PUT":
+                if comp == "blocklist":
+                    block_ids = body.decode().split("<Latest>")[1:]
+                    body = b"".join(blocks.pop((name, block_id.split("<")[0])) for block_id in block_ids)
+                etag = hashlib.md5(body).hexdigest()
+                blobs[name] = (body, etag)
+                return self.respond(201, headers={"ETag": f'"{etag}"'})
+            if self.command == "DELETE":
+                return self.respond(202 if blobs.pop(name, None) else 404)
+            if self.command == "GET" and comp == "list":
+                prefix = f"{container}/{query.get('prefix', [''])[0]}"
+                names = sorted(n for n in blobs if n.startswith(prefix))
+                start = int(query.get("marker", ["0"])[0])
+                entries = "".join(f"<Blob><Name>{n.split('/', 1)[1]}</Name><Properties><Content-Length>"
+                                  f"{len(blobs[n][0])}</Content-Length><Etag>{blobs[n][1]}</Etag></Properties></Blob>"
+                                  for n in names[start:start + 2])
+                marker = str(start + 2) if start + 2 < len(names) else ""
+                return self.respond(200, f"<EnumerationResults><Blobs>{entries}</Blobs>"
+                                         f"<NextMarker>{marker}</NextMarker></EnumerationResults>".encode())
+            if self.command == "GET":
+                if name not in blobs:
+                    return self.respond(404)
+                data, etag = blobs[name]
+                if self.headers.get("If-Match") not in (None, f'"{etag}"'):
+                    return self.respond(412)
+                if "x-ms-range" in self.headers:
+                    first, last = self.headers["x-ms-range"].split("=")[1].split("-")
+                    return self.respond(206, data[int(first):int(last) + 1])
+                return self.respond(200, data)
+            return self.respond(400)
+
+        do_GET = do_PUT = do_DELETE = handle_request
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    connection_string = (f"DefaultEndpointsProtocol=http;AccountName={EMULATOR_ACCOUNT};AccountKey={EMULATOR_KEY};"
+                         f"BlobEndpoint=http://127.0.0.1:{server.server_address[1]}/{EMULATOR_ACCOUNT};")
+    return server, connection_string, blobs, server_stats
+
 
 class TestMain(unittest.TestCase):
     def remove_data_directories(self):
@@ -98,6 +239,329 @@ class TestMain(unittest.TestCase):
         df = convert_to_tabular(data)
         pd.testing.assert_frame_equal(df, expected_df)
 
+    def test_iter_json_array(self):
+        # Create a file with other keys around the array and values split across read blocks
+        file_path = 'test_customers.json'
+        with open(file_path, 'w') as f:
+            f.write('{"meta": {"a": [1, 2]}, "customers": [1, 22.5, {"b": "]}"}, true, null], "n": 3}')
+
+        # Small blocks force values to be split between reads
+        for block_size in [1, 2, 3, 1 << 16]:
+            result = list(iter_json_array(file_path, "customers", block_size=block_size))
+            self.assertEqual(result, [1, 22.5, {"b": "]}"}, True, None])
+
+        # Test when the key does not exist
+        with self.assertRaises(KeyError):
+            list(iter_json_array(file_path, "missing"))
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_iter_customer_chunks(self):
+        file_path = 'test_customers.json'
+        customers = [{"id": f"C{i}"} for i in range(5)]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        chunks = list(iter_customer_chunks(file_path, chunk_size=2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual([customer for chunk in chunks for customer in chunk], customers)
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_bronze_layer_streaming(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": "C001", "name": "John", "total_spent": 10.5,
+             "transactions": [{"transaction_id": "T1", "amount": 10.5}]},
+            {"id": "C002", "name": "Jane", "total_spent": 0, "transactions": []},
+            {"id": "C003", "name": "Alice", "total_spent": 3,
+             "transactions": [{"transaction_id": "T2", "amount": 3}]},
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        # The streamed partition must match the one created in memory
+        expected_file_path = 'data/bronze/2022-01-01/data.csv'
+        with patch('main.pd.Timestamp') as mock_timestamp:
+            mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+            create_bronze_layer(file_path)
+            df_expected = pd.read_csv(expected_file_path)
+            create_bronze_layer(file_path, streaming=True, chunk_size=2)
+
+        df_loaded = pd.read_csv(expected_file_path)
+        pd.testing.assert_frame_equal(df_loaded, df_expected)
+        self.assertFalse(os.path.exists(f"{expected_file_path}.tmp"))
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_bronze_layer_streaming_new_fields(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C00{c}", "name": f"Customer {c}", "total_spent": 1.5 * c,
+             "transactions": [{"transaction_id": f"T{c}", "amount": 1.5 * c}]} for c in range(4)
+        ]
+        customers[3]["loyalty"] = {"tier": "gold"}
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        # A field first found in the last chunk widens the table written by the earlier chunks
+        for storage_format in ['csv', 'parquet', 'arrow']:
+            self.remove_data_directories()
+            with patch('main.pd.Timestamp') as mock_timestamp, patch('main.STORAGE_FORMAT', storage_format):
+                mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+                create_bronze_layer(file_path)
+                df_expected = load_bronze_data()
+                create_bronze_layer(file_path, streaming=True, chunk_size=2)
+                df_loaded = load_bronze_data()
+            self.assertEqual(df_loaded['loyalty.tier'].tolist()[3], 'gold')
+            self.assertTrue(df_loaded['loyalty.tier'].iloc[:3].isna().all())
+            pd.testing.assert_frame_equal(df_loaded, df_expected)
+            self.assertFalse([name for name in os.listdir('data/bronze/2022-01-01') if 'tmp' in name or 'narrow' in name])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_bronze_layer_streaming_nested_types(self):
+        file_path = 'test_customers.json'
+        # Nested transactions are only found after a customer without any, and the amounts are integers in
+        # the first chunk with transactions and floats in the later ones
+        customers = [
+            {"id": "C0", "total_spent": 0, "transactions": []},
+            {"id": "C1", "total_spent": 51, "transactions": [{"transaction_id": "T1", "amount": 51}]},
+            {"id": "C2", "total_spent": 52.5, "transactions": [{"transaction_id": "T2", "amount": 50.5},
+                                                               {"transaction_id": "T3", "amount": 2}]},
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        # The types of the values of a later chunk widen the table written by the earlier chunks
+        for storage_format in ['parquet', 'arrow']:
+            self.remove_data_directories()
+            with patch('main.pd.Timestamp') as mock_timestamp, patch('main.STORAGE_FORMAT', storage_format):
+                mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+                create_bronze_layer(file_path, streaming=True, chunk_size=1)
+                df_loaded = load_bronze_data()
+            self.assertEqual([[transaction["amount"] for transaction in transactions]
+                              for transactions in df_loaded["transactions"]], [[], [51.0], [50.5, 2.0]])
+            self.assertFalse([name for name in os.listdir('data/bronze/2022-01-01') if 'tmp' in name or 'narrow' in name])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_profile_table(self):
+        file_path = 'test_customers.json'
+        days = {
+            '2022-01-01': [{"id": "C1", "total_spent": 10.0, "signup_date": "2023-01-01"},
+                           {"id": "C2", "total_spent": 20.0, "signup_date": "2023-01-05"},
+                           {"id": "C3", "total_spent": None, "signup_date": "2023-01-10"}],
+            '2022-01-02': [{"id": "C1", "total_spent": 30.0, "signup_date": "2023-03-01"},
+                           {"id": "C4", "total_spent": 40.0, "signup_date": "2023-03-02"}],
+        }
+        for date, customers in days.items():
+            with open(file_path, 'w') as f:
+                json.dump({"customers": customers}, f)
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = date
+                # The summaries of the chunks are merged into the statistics of the partition
+                create_bronze_layer(file_path, streaming=True, chunk_size=2)
+        self.assertEqual(main.read_table_statistics('data/bronze/2022-01-01/data')['rows'], 3)
+
+        # The profile of the history merges the statistics of the partitions without reading their rows
+        with patch('main.read_table_file') as mock_read:
+            profile = main.profile_table('bronze', 'data')
+        mock_read.assert_not_called()
+        total_spent = pd.Series([10.0, 20.0, None, 30.0, 40.0])
+        self.assertEqual(profile.loc[['count', 'null_count', 'distinct', 'min', 'max'], 'total_spent'].tolist(),
+                         [4, 1, 4, 10.0, 40.0])
+        self.assertAlmostEqual(profile.loc['mean', 'total_spent'], total_spent.mean())
+        self.assertAlmostEqual(profile.loc['std', 'total_spent'], total_spent.std())
+        self.assertEqual(profile.loc['50%', 'total_spent'], 25.0)
+        self.assertEqual(profile.loc['distinct', 'id'], 4)
+        self.assertEqual(profile.loc[['min', 'max'], 'id'].tolist(), ['C1', 'C4'])
+
+        # Partitions whose min and max exclude the values are skipped
+        self.assertEqual(main.find_partitions('bronze', 'data', 'signup_date', '2023-02-01'), ['2022-01-02'])
+        self.assertEqual(main.find_partitions('bronze', 'data', 'total_spent', max_value=25), ['2022-01-01'])
+
+        # A partition written without statistics gets them on its first profile
+        os.remove('data/bronze/2022-01-02/data.stats.json')
+        pd.testing.assert_frame_equal(main.profile_table('bronze', 'data'), profile)
+        self.assertTrue(os.path.exists('data/bronze/2022-01-02/data.stats.json'))
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_convert_to_split_tables(self):
+        data = [
+            {"id": "C1", "name": "O'Brien", "transactions": [{"transaction_id": "T1", "amount": 10}]},
+            {"id": "C2", "name": "Jane", "transactions": []},
+            {"id": "C1", "name": "O'Brien", "transactions": [{"transaction_id": "T2", "amount": 5.5}]},
+        ]
+
+        df_customers, df_transactions = convert_to_split_tables(data, first_row=10)
+
+        expected_customers = pd.DataFrame({"id": ["C1", "C2", "C1"], "name": ["O'Brien", "Jane", "O'Brien"]})
+        expected_transactions = pd.DataFrame({
+            "transaction_id": ["T1", "T2"],
+            "amount": [10, 5.5],
+            "customer_id": ["C1", "C1"],
+            "customer_row": [10, 12],
+        })
+        pd.testing.assert_frame_equal(df_customers, expected_customers)
+        pd.testing.assert_frame_equal(df_transactions, expected_transactions)
+
+    def test_create_bronze_layer_split_transactions(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": "C001", "name": "John", "transactions": [{"transaction_id": "T1", "amount": 10.5}]},
+            {"id": "C002", "name": "Jane", "transactions": []},
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        # Streaming and in memory creation must produce the same tables
+        for streaming in [False, True]:
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+                create_bronze_layer(file_path, streaming=streaming, chunk_size=1, split_transactions=True)
+
+            df_customers = pd.read_csv('data/bronze/2022-01-01/data.csv')
+            df_transactions = pd.read_csv('data/bronze/2022-01-01/transactions.csv')
+            self.assertEqual(list(df_customers.columns), ["id", "name"])
+            self.assertEqual(df_transactions.to_dict("records"), [
+                {"transaction_id": "T1", "amount": 10.5, "customer_id": "C001", "customer_row": 0}])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_bronze_layer_cdc(self):
+        file_path = 'test_customers.json'
+        first_day = [
+            {"id": "C001", "name": "John", "transactions": [{"transaction_id": "T1", "amount": 10.5}]},
+            {"id": "C002", "name": "Jane", "transactions": []},
+            {"id": "C003", "name": "Alice", "transactions": [{"transaction_id": "T2", "amount": 3}]},
+        ]
+        # John is unchanged, Jane has a new transaction, Alice is deleted and Bob is inserted
+        second_day = [
+            {"name": "John", "id": "C001", "transactions": [{"amount": 10.5, "transaction_id": "T1"}]},
+            {"id": "C002", "name": "Jane", "transactions": [{"transaction_id": "T3", "amount": 7}]},
+            {"id": "C004", "name": "Bob", "transactions": []},
+        ]
+
+        # Streaming and in memory creation must find the same changes
+        for streaming in [False, True]:
+            self.remove_data_directories()
+            for date, customers in [('2022-01-01', first_day), ('2022-01-02', second_day)]:
+                with open(file_path, 'w') as f:
+                    json.dump({"customers": customers}, f)
+                with patch('main.pd.Timestamp') as mock_timestamp:
+                    mock_timestamp.return_value.strftime.return_value = date
+                    create_bronze_layer(file_path, streaming=streaming, chunk_size=2, split_transactions=True,
+                                        cdc=True)
+
+            # Without a previous partition every customer is inserted
+            df_changes = pd.read_csv('data/bronze/2022-01-01/changes.csv')
+            self.assertEqual(df_changes["change_type"].tolist(), ["insert"] * 3)
+
+            df_changes = pd.read_csv('data/bronze/2022-01-02/changes.csv')
+            self.assertEqual(df_changes.to_dict("records"), [
+                {"customer_id": "C002", "change_type": "update"},
+                {"customer_id": "C004", "change_type": "insert"},
+                {"customer_id": "C003", "change_type": "delete"}])
+            df_customers = pd.read_csv('data/bronze/2022-01-02/data.csv')
+            df_transactions = pd.read_csv('data/bronze/2022-01-02/transactions.csv')
+            self.assertEqual(df_customers["id"].tolist(), ["C002", "C004"])
+            self.assertEqual(df_transactions.to_dict("records"), [
+                {"transaction_id": "T3", "amount": 7, "customer_id": "C002", "customer_row": 0}])
+            df_hashes = pd.read_csv('data/bronze/2022-01-02/hashes.csv')
+            self.assertEqual(df_hashes["customer_id"].tolist(), ["C001", "C002", "C004"])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_bronze_layer_cdc_streaming_arrow(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C{c:03d}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "total_spent": 5.0,
+             "transactions": [{"transaction_id": f"T{c}", "amount": 5.0}]} for c in range(20)
+        ]
+        # Only the first chunk of the second day has a change, the later chunks have no customer
+        second_day = json.loads(json.dumps(customers))
+        second_day[0]["email"] = "new@example.com"
+
+        for storage_format in ['parquet', 'arrow']:
+            self.remove_data_directories()
+            for date, day in [('2022-01-01', customers), ('2022-01-02', second_day)]:
+                with open(file_path, 'w') as f:
+                    json.dump({"customers": day}, f)
+                with patch('main.pd.Timestamp') as mock_timestamp, patch('main.STORAGE_FORMAT', storage_format):
+                    mock_timestamp.return_value.strftime.return_value = date
+                    create_bronze_layer(file_path, streaming=True, chunk_size=7, cdc=True)
+
+            df_customers = read_table_file(f'data/bronze/2022-01-02/data.{storage_format}')
+            self.assertEqual(df_customers["id"].tolist(), ["C000"])
+            self.assertEqual(df_customers["email"].tolist(), ["new@example.com"])
+            df_changes = read_table_file(f'data/bronze/2022-01-02/changes.{storage_format}')
+            self.assertEqual(df_changes["change_type"].tolist(), ["update"])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_layers_cdc(self):
+        file_path = 'test_customers.json'
+
+        def customer(c, transactions, name=None):
+            return {"id": f"C{c}", "name": name or f"Customer {c}", "email": f"customer{c}@example.com",
+                    "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 5.0 * transactions,
+                    "transactions": [{"transaction_id": f"T{c}{t}", "date": f"2023-0{t + 1}-01", "amount": 5.0,
+                                      "product_id": f"P{t}", "product_name": f"Product {t}"}
+                                     for t in range(transactions)]}
+
+        days = [
+            ('2022-01-01', [customer(1, 1), customer(2, 1), customer(3, 2)]),
+            # Customer 1 is renamed, customer 2 is deleted and customer 4 is inserted
+            ('2022-01-02', [customer(1, 1, "Renamed"), customer(3, 2), customer(4, 1)]),
+            # Nothing changes
+            ('2022-01-03', [customer(1, 1, "Renamed"), customer(3, 2), customer(4, 1)]),
+            # Customer 4 is deleted
+            ('2022-01-04', [customer(1, 1, "Renamed"), customer(3, 2)]),
+        ]
+        for date, customers in days:
+            with open(file_path, 'w') as f:
+                json.dump({"customers": customers}, f)
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = date
+                create_layers()
+                create_bronze_layer(file_path, cdc=True)
+                create_silver_layer()
+                create_update_golden_layer()
+
+        # Only the changed customers reach the silver layer
+        df_denormalized = pd.read_csv('data/silver/2022-01-02/denormalized.csv')
+        self.assertEqual(sorted(df_denormalized["customer_id"].unique()), ["C1", "C4"])
+        self.assertFalse(os.path.exists('data/silver/2022-01-03/denormalized.csv'))
+
+        df_customers = load_golden_data('dimension_customers', current_only=True)
+        self.assertEqual(df_customers[["customer_id", "customer_name"]].to_dict("records"), [
+            {"customer_id": "C3", "customer_name": "Customer 3"},
+            {"customer_id": "C1", "customer_name": "Renamed"}])
+        # The updated and deleted customers are closed in the history
+        df_history = read_table_file('data/gold/dimension_customers_history.csv')
+        self.assertEqual(df_history[["customer_id", "valid_to"]].to_dict("records"), [
+            {"customer_id": "C1", "valid_to": "2022-01-02"},
+            {"customer_id": "C2", "valid_to": "2022-01-02"},
+            {"customer_id": "C4", "valid_to": "2022-01-04"}])
+        # Transactions are events, they are kept for deleted customers
+        self.assertEqual(sorted(load_golden_data('fact_transactions')["transaction_id"]),
+                         ["T10", "T20", "T30", "T31", "T40"])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
     def test_get_basic_statistics(self):
         # Test when the DataFrame is not empty
         df = pd.DataFrame({'A': [1, 2, 3], 'B': [4, 5, 6]})
@@ -132,8 +596,9 @@ class TestMain(unittest.TestCase):
         df_loaded = pd.read_csv(expected_file_path)
         pd.testing.assert_frame_equal(df_loaded, df_bronze_data)
 
-        # Clean up the created directory and file
+        # Clean up the created directory and files
         os.remove(expected_file_path)
+        os.remove('data/bronze/2022-01-01/data.stats.json')
         os.rmdir(expected_directory_path)
         os.rmdir(expected_bronze_path)
 
@@ -189,6 +654,124 @@ class TestMain(unittest.TestCase):
         # Check if the result matches the expected result
         pd.testing.assert_frame_equal(result, expected_result)
 
+    def test_rearrange_data_matches_rowwise(self):
+        df = pd.DataFrame({
+            "id": ["C1", "C2", "C3"],
+            "name": ["John", "Jane", "Alice"],
+            "email": ["john@example.com", "jane@example.com", "alice@example.com"],
+            "signup_date": ["2022-01-01", "2022-01-02", "2022-01-03"],
+            "last_purchase": ["2022-02-01", "2022-02-02", "2022-02-03"],
+            "total_spent": [100.0, 0.0, 30.5],
+            "transactions": ["[{'transaction_id': 'T1', 'amount': 50}, {'transaction_id': 'T2', 'amount': 50}]",
+                             "[]",
+                             "[{'transaction_id': 'T3', 'amount': 30.5}]"]
+        })
+
+        pd.testing.assert_frame_equal(rearrange_data(df), rearrange_data_rowwise(df))
+
+    def test_parse_transactions(self):
+        # Test a list stringified by the bronze layer
+        self.assertEqual(parse_transactions("[{'id': 1, 'amount': 50.5}]"), [{"id": 1, "amount": 50.5}])
+
+        # Test a value containing an apostrophe, which is not valid JSON once the quotes are swapped
+        self.assertEqual(parse_transactions(str([{"product_name": "Kid's toy"}])),
+                         [{"product_name": "Kid's toy"}])
+
+    def test_explode_transactions(self):
+        df = pd.DataFrame({
+            "id": ["C1", "C2", "C3"],
+            "transactions": ["[{'id': 1}, {'id': 2}]", "[]", "[{'id': 3}]"],
+        }, index=[5, 6, 7])
+
+        expected_result = pd.DataFrame({
+            "id": [1, 2, 3],
+            "customer_id": ["C1", "C1", "C3"],
+            "customer_row": [0, 0, 2],
+        })
+        pd.testing.assert_frame_equal(explode_transactions(df), expected_result)
+
+    def test_rearrange_data_with_transactions_table(self):
+        df = pd.DataFrame({
+            "id": [1, 2],
+            "name": ["John", "O'Brien"],
+            "email": ["john@example.com", "obrien@example.com"],
+            "signup_date": ["2022-01-01", "2022-01-02"],
+            "last_purchase": ["2022-02-01", "2022-02-02"],
+            "total_spent": [100, 200],
+        })
+        df_transactions = pd.DataFrame({
+            "id": [1, 2, 3],
+            "amount": [50, 75, 100],
+            "customer_id": [1, 1, 2],
+            "customer_row": [0, 0, 1],
+        })
+
+        expected_result = pd.DataFrame({
+            "id": [1, 2, 3],
+            "amount": [50, 75, 100],
+            "customer_id": [1, 1, 2],
+            "customer_name": ["John", "John", "O'Brien"],
+            "customer_email": ["john@example.com", "john@example.com", "obrien@example.com"],
+            "signup_date": ["2022-01-01", "2022-01-01", "2022-01-02"],
+            "last_purchase": ["2022-02-01", "2022-02-01", "2022-02-02"],
+            "total_spent": [100, 100, 200],
+        })
+
+        result = rearrange_data(df, df_transactions)
+        pd.testing.assert_frame_equal(result, expected_result)
+
+    def test_sanity_check_with_transactions_table(self):
+        df = pd.DataFrame({
+            "id": ["C1", "C2", "C3"],
+            "email": ["john@example.com", "invalid", "alice@example.com"],
+            "signup_date": ["2022-01-01", "2022-01-02", "2022-01-03"],
+            "last_purchase": ["2022-02-01", "2022-01-01", "2022-01-03"],
+            "total_spent": [125, 10, 0],
+        })
+        df_transactions = pd.DataFrame({
+            "date": ["2022-01-10", "2022-02-01", "2022-01-05"],
+            "amount": [50, 75, 20],
+            "customer_id": ["C1", "C1", "C2"],
+            "customer_row": [0, 0, 1],
+        })
+
+        result = sanity_check(df, df_transactions)
+
+        self.assertEqual(list(result["last_transaction_date"][:2]),
+                         [pd.Timestamp("2022-02-01"), pd.Timestamp("2022-01-05")])
+        self.assertTrue(pd.isna(result["last_transaction_date"][2]))
+        self.assertEqual(list(result["total_transaction_spent"]), [125, 20, 0])
+        self.assertEqual(list(result["last_purchase_vs_signup"]), [True, False, False])
+        self.assertEqual(list(result["total_spent_vs_transaction"]), [True, False, True])
+        self.assertEqual(list(result["email_valid"]), [True, False, True])
+
+    def test_sanity_check_with_transactions_column(self):
+        df = pd.DataFrame({
+            "id": ["C1", "C2"],
+            "email": ["john@example.com", "jane@example"],
+            "signup_date": ["2022-01-01", "2022-01-02"],
+            "last_purchase": ["2022-02-01", "2022-01-20"],
+            "total_spent": [125, 10],
+            "transactions": ["[{'date': '2022-01-10', 'amount': 50}, {'date': '2022-02-01', 'amount': 75}]",
+                             "[]"],
+            "score": [1.5, 2.5],
+        })
+        df_original = df.copy()
+
+        result = sanity_check(df)
+
+        # The checks are the same as computing them row by row
+        self.assertEqual(list(result["last_transaction_date"][:1]), [get_last_transaction(df["transactions"][0])])
+        self.assertEqual(list(result["total_transaction_spent"]),
+                         [get_total_spent(transactions) for transactions in df["transactions"]])
+        self.assertEqual(list(result["last_purchase_vs_transaction"]), [True, False])
+        self.assertEqual(list(result["total_spent_vs_transaction"]), [True, False])
+        self.assertEqual(list(result["email_valid"]), [True, False])
+
+        # The input is left untouched, and its columns not checked are shared instead of copied
+        pd.testing.assert_frame_equal(df, df_original)
+        self.assertTrue(np.shares_memory(result["score"].to_numpy(), df["score"].to_numpy()))
+
     def test_create_transaction_table(self):
         # Create a sample DataFrame for testing
         df = pd.DataFrame({
@@ -279,8 +862,9 @@ class TestMain(unittest.TestCase):
         df_loaded = pd.read_csv(expected_file_path)
         pd.testing.assert_frame_equal(df_loaded, df_silver_data)
 
-        # Clean up the created directory and file
+        # Clean up the created directory and files
         os.remove(expected_file_path)
+        os.remove('data/silver/2022-01-01/my_table.stats.json')
         os.rmdir(expected_directory_path)
         os.rmdir(expected_silver_path)
 
@@ -389,7 +973,7 @@ class TestMain(unittest.TestCase):
 
         # Check if the file was created and the content matches the DataFrame
         self.assertTrue(os.path.exists(expected_file_path))
-        df_loaded = pd.read_csv(expected_file_path)
+        df_loaded = read_table_file(expected_file_path)
         pd.testing.assert_frame_equal(df_loaded, df_golden_data)
 
         # Call the function again with a different DataFrame
@@ -397,13 +981,1024 @@ class TestMain(unittest.TestCase):
         save_golden_data(df_golden_data_updated, table_name)
 
         # Check if the file content was appended with the updated DataFrame
-        df_loaded_updated = pd.read_csv(expected_file_path).reset_index(drop=True)
+        df_loaded_updated = read_table_file(expected_file_path).reset_index(drop=True)
         df_expected_updated = pd.concat(
             [df_golden_data, df_golden_data_updated]).reset_index(drop=True)
         pd.testing.assert_frame_equal(df_loaded_updated, df_expected_updated)
 
         # Clean up the created file
-        os.remove(expected_file_path)
+        shutil.rmtree(expected_file_path)
+
+    def test_append_to_indexed_table(self):
+        file_path = 'test_data.csv'
+        df = pd.DataFrame({'key': ['K1', 'K2', 'K2'], 'B': [4, 5, 5]})
+
+        # Call the function when the table does not exist, duplicated keys are stored once
+        append_to_indexed_table(df, file_path, 'key')
+        pd.testing.assert_frame_equal(read_table_file(file_path), pd.DataFrame({'key': ['K1', 'K2'], 'B': [4, 5]}))
+
+        # Only the rows with new keys are appended, in the column order of the table
+        df_updated = pd.DataFrame({'B': [6, 7], 'key': ['K2', 'K3']})
+        append_to_indexed_table(df_updated, file_path, 'key')
+        expected_result = pd.DataFrame({'key': ['K1', 'K2', 'K3'], 'B': [4, 5, 7]})
+        pd.testing.assert_frame_equal(read_table_file(file_path), expected_result)
+
+        # The index holds the stored keys
+        incoming = pd.DataFrame({'key': ['K1', 'K3', 'K4']})
+        self.assertEqual(main.select_new_rows(incoming, file_path, 'key')['key'].tolist(), ['K4'])
+
+        # Clean up the temporary files
+        shutil.rmtree(file_path)
+        shutil.rmtree(get_index_path(file_path))
+
+    def test_append_to_indexed_table_builds_missing_index(self):
+        # A table stored before the index existed
+        file_path = 'test_data.csv'
+        pd.DataFrame({'key': ['K1', 'K2'], 'B': [4, 5]}).to_csv(file_path, index=False)
+
+        append_to_indexed_table(pd.DataFrame({'key': ['K1', 'K3'], 'B': [4, 6]}), file_path, 'key')
+
+        expected_result = pd.DataFrame({'key': ['K1', 'K2', 'K3'], 'B': [4, 5, 6]})
+        pd.testing.assert_frame_equal(read_table_file(file_path), expected_result)
+        incoming = pd.DataFrame({'key': ['K1', 'K2', 'K3', 'K4']})
+        self.assertEqual(main.select_new_rows(incoming, file_path, 'key')['key'].tolist(), ['K4'])
+
+        # Clean up the temporary files
+        shutil.rmtree(file_path)
+        shutil.rmtree(get_index_path(file_path))
+
+    def test_select_new_rows_index(self):
+        # An index stored by an older version, one key per line
+        file_path = 'test_data.csv'
+        with open(get_index_path(file_path), 'w') as f:
+            f.writelines(f'K{i}\n' for i in range(50))
+
+        # Small filters with many false positives fill up and are followed by larger ones, the keys they
+        # may have seen are checked against the runs of hashes
+        with patch('main.KEY_FILTER_CAPACITY', 16), patch('main.KEY_FILTER_ERROR_RATE', 0.5):
+            for start in range(50, 200, 30):
+                append_to_indexed_table(pd.DataFrame({'key': [f'K{i}' for i in range(start - 10, start + 30)]}),
+                                        file_path, 'key')
+            index = main.load_table_index(file_path, 'key')
+            incoming = pd.DataFrame({'key': [f'K{i}' for i in range(400)]})
+            self.assertEqual(main.select_new_rows(incoming, file_path, 'key')['key'].tolist(),
+                             [f'K{i}' for i in range(200, 400)])
+
+        # The filters double their capacity, and runs are merged so their sizes grow geometrically
+        self.assertEqual([key_filter['capacity'] for key_filter in index['filters']], [16, 32, 64, 128])
+        self.assertEqual(sum(run['count'] for run in index['runs']), 200)
+        self.assertLessEqual(len(index['runs']), 3)
+        self.assertEqual(read_table_file(file_path)['key'].tolist(), [f'K{i}' for i in range(50, 200)])
+
+        # Clean up the temporary files
+        shutil.rmtree(file_path)
+        shutil.rmtree(get_index_path(file_path))
+
+    def test_save_golden_data_scd2(self):
+        file_path = 'data/gold/dimension_customers.csv'
+        columns = ["customer_id", "customer_name", "customer_email", "signup_date"]
+        # A dimension stored by an older version, with a customer whose email changed stored twice
+        os.makedirs('data/gold', exist_ok=True)
+        pd.DataFrame([
+            ["C1", "John", "john@old.com", "2023-01-01"],
+            ["C2", "Jane", "jane@example.com", "2023-01-01"],
+            ["C1", "John", "john@example.com", "2023-01-01"],
+        ], columns=columns).to_csv(file_path, index=False)
+
+        days = [
+            ('2022-01-01', [["C1", "John", "john@example.com", "2023-01-01"],
+                            ["C2", "Jane", "jane@example.com", "2023-01-01"]]),
+            ('2022-01-02', [["C2", "Jane", "jane@new.com", "2023-01-01"],
+                            ["C3", "Alice", "alice@example.com", "2023-01-01"]]),
+        ]
+        for date, rows in days:
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = date
+                save_golden_data(pd.DataFrame(rows, columns=columns), 'dimension_customers')
+
+        # The current versions are read without the history, one per customer
+        df_current = load_golden_data('dimension_customers', current_only=True)
+        df_current["valid_from"] = df_current["valid_from"].dt.strftime("%Y-%m-%d")
+        self.assertEqual(df_current[["customer_id", "customer_email", "valid_from"]].fillna("").to_dict("records"), [
+            {"customer_id": "C1", "customer_email": "john@example.com", "valid_from": ""},
+            {"customer_id": "C2", "customer_email": "jane@new.com", "valid_from": "2022-01-02"},
+            {"customer_id": "C3", "customer_email": "alice@example.com", "valid_from": "2022-01-02"}])
+        self.assertTrue(df_current["current"].all())
+
+        # The duplicate of the older version and the replaced email are kept in the history
+        df_history = read_table_file('data/gold/dimension_customers_history.csv')
+        self.assertEqual(df_history[["customer_id", "customer_email", "valid_to"]].fillna("").to_dict("records"), [
+            {"customer_id": "C1", "customer_email": "john@old.com", "valid_to": ""},
+            {"customer_id": "C2", "customer_email": "jane@example.com", "valid_to": "2022-01-02"}])
+        self.assertFalse(df_history["current"].any())
+        self.assertEqual(len(load_golden_data('dimension_customers')), 5)
+
+        # The hash index gives the part storing the current version of every customer
+        hashes, parts, _ = main.load_hash_index(file_path, 'customer_id', main.GOLD_SCD2_TABLES['dimension_customers'])
+        self.assertEqual(sorted(hashes), ["C1", "C2", "C3"])
+        self.assertLessEqual(set(parts.values()), {os.path.basename(path) for path in main.list_part_files(file_path)})
+        with self.assertRaises(ValueError):
+            load_golden_data('dimension_products', current_only=True)
+
+    def test_merge_scd2_table_deltas(self):
+        file_path = 'test_dimension.csv'
+        for valid_from, rows in [('2022-01-01', range(0, 50)), ('2022-01-02', range(50, 100))]:
+            main.merge_scd2_table(pd.DataFrame({'key': [f'K{i}' for i in rows], 'A': 1}), file_path, 'key', ['A'],
+                                  valid_from)
+        with open(main.get_hash_index_path(file_path)) as f:
+            lines = len(f.readlines())
+
+        # Closing a version only reads and replaces the part storing it, and appends its changes to the
+        # hash index: the new part of the other keys of the part, the closed key and its new version. The
+        # versions are closed and the new ones added by a single commit
+        version = main.get_table_version(file_path)
+        with patch('main.read_table_file', wraps=read_table_file) as mock_read:
+            main.merge_scd2_table(pd.DataFrame({'key': ['K3'], 'A': [2]}), file_path, 'key', ['A'], '2022-01-03',
+                                  deleted_keys=['K4'])
+        self.assertEqual(len(mock_read.call_args_list), 1)
+        self.assertEqual(main.get_table_version(file_path), version + 1)
+        with open(main.get_hash_index_path(file_path)) as f:
+            self.assertEqual(len(f.readlines()), lines + 50 + 1)
+
+        df = read_table_file(file_path)
+        self.assertEqual(sorted(df['key']), sorted(f'K{i}' for i in range(100) if i != 4))
+        self.assertEqual(df.loc[df['key'] == 'K3', 'A'].tolist(), [2])
+        df_history = read_table_file(main.get_history_path(file_path))
+        self.assertEqual(df_history[['key', 'valid_to']].values.tolist(), [['K3', '2022-01-03'], ['K4', '2022-01-03']])
+        hashes, parts, _ = main.load_hash_index(file_path, 'key', ['A'])
+        self.assertEqual(len(hashes), 99)
+        self.assertEqual(set(parts.values()), {os.path.basename(path) for path in main.list_part_files(file_path)})
+
+        # A load failing once its versions are committed, before the hash index, or before the table once
+        # the history is appended, is retried without closing the versions again
+        for changed_key, failing in [('K60', 'main.commit_table'), ('K70', 'main.append_hash_deltas')]:
+            df_load = pd.DataFrame({'key': [changed_key], 'A': [2]})
+            with patch(failing, side_effect=OSError('crash')):
+                with self.assertRaises(OSError):
+                    main.merge_scd2_table(df_load, file_path, 'key', ['A'], '2022-01-04')
+            main.merge_scd2_table(df_load, file_path, 'key', ['A'], '2022-01-04')
+        df = read_table_file(file_path)
+        self.assertEqual(df.loc[df['key'].isin(['K60', 'K70']), 'A'].tolist(), [2, 2])
+        self.assertEqual(read_table_file(main.get_history_path(file_path))['key'].tolist(), ['K3', 'K4', 'K60', 'K70'])
+
+        # A hash index of another version of the table is built again, with a line per key and its version
+        main.append_hash_deltas(file_path, {}, -1)
+        _, _, lines = main.load_hash_index(file_path, 'key', ['A'])
+        with open(main.get_hash_index_path(file_path)) as f:
+            self.assertEqual(lines, len(f.readlines()))
+
+        # Clean up the temporary files
+        shutil.rmtree(file_path)
+        shutil.rmtree(main.get_history_path(file_path))
+        os.remove(main.get_hash_index_path(file_path))
+
+    def test_save_golden_data_surrogate_keys(self):
+        # A fact table stored by an older version, with the string ids of the customers and products
+        os.makedirs('data/gold', exist_ok=True)
+        pd.DataFrame({
+            'transaction_id': ['T1'], 'date': ['2023-01-15'], 'amount': [10.0], 'product_id': ['P1'],
+            'customer_id': ['C1'],
+        }).to_csv('data/gold/fact_transactions.csv', index=False)
+
+        loads = [
+            (pd.DataFrame({'product_id': ['P1', 'P2'], 'product_name': ['Product 1', 'Product 2']}),
+             pd.DataFrame({'transaction_id': ['T2'], 'date': ['2023-01-20'], 'amount': [20.0],
+                           'product_id': ['P2'], 'customer_id': ['C2']})),
+            (pd.DataFrame({'product_id': ['P3', 'P1'], 'product_name': ['Product 3', 'Product 1']}),
+             pd.DataFrame({'transaction_id': ['T3'], 'date': ['2023-02-01'], 'amount': [30.0],
+                           'product_id': ['P3'], 'customer_id': ['C1']})),
+        ]
+        for df_products, df_transactions in loads:
+            save_golden_data(df_products, 'dimension_products')
+            save_golden_data(df_transactions, 'fact_transactions')
+
+        # Natural keys keep their surrogate key across loads
+        df_products = load_golden_data('dimension_products')
+        self.assertEqual(df_products[['product_key', 'product_id']].to_dict('records'), [
+            {'product_key': 1, 'product_id': 'P1'},
+            {'product_key': 2, 'product_id': 'P2'},
+            {'product_key': 3, 'product_id': 'P3'}])
+
+        # The fact table, migrated ones included, references the dimensions by their surrogate keys
+        df_facts = load_golden_data('fact_transactions')
+        self.assertEqual(list(df_facts.columns), ['transaction_id', 'date', 'amount', 'product_key', 'customer_key'])
+        self.assertEqual(df_facts[['product_key', 'customer_key']].values.tolist(), [[1, 1], [2, 2], [3, 1]])
+        self.assertTrue(pd.api.types.is_integer_dtype(df_facts['customer_key']))
+        with open('data/gold/dimension_customers.keys') as f:
+            self.assertEqual(f.read().splitlines(), ['C1,1', 'C2,2'])
+
+    def test_apply_schema(self):
+        df = pd.DataFrame({
+            'transaction_id': ['T1', 'T2', 'T3'],
+            'date': ['2023-01-15', 'not a date', '2023-02-01'],
+            'amount': ['10.5', '20', 'x'],
+            'customer_id': ['C1', 'C1', 'C2'],
+            'customer_row': [0, 0, 1],
+        })
+
+        result = apply_schema(df, 'bronze', 'transactions')
+
+        self.assertTrue(pd.api.types.is_datetime64_any_dtype(result['date']))
+        self.assertTrue(pd.isna(result['date'][1]))
+        self.assertEqual(result['amount'].dtype, 'float64')
+        self.assertTrue(pd.isna(result['amount'][2]))
+        self.assertIsInstance(result['customer_id'].dtype, pd.CategoricalDtype)
+        self.assertEqual(result['customer_row'].dtype, 'int32')
+        # Columns not in the schema, and the input, are left as they are
+        self.assertEqual(result['transaction_id'].tolist(), ['T1', 'T2', 'T3'])
+        self.assertEqual(df['date'][1], 'not a date')
+
+        # Tables of distinct rows get plain strings back, and unknown tables are not changed
+        result = apply_schema(result.rename(columns={'date': 'signup_date'}), 'silver', 'customers')
+        self.assertNotIsInstance(result['customer_id'].dtype, pd.CategoricalDtype)
+        self.assertIs(apply_schema(df, 'silver', 'unknown'), df)
+
+    def test_write_and_read_table(self):
+        df = pd.DataFrame({'A': [1, 2, 3], 'B': ['x', 'y', 'z'], 'C': pd.to_datetime(['2022-01-01'] * 3)})
+        path = 'test_table'
+
+        for storage_format in ['csv', 'parquet', 'arrow']:
+            with patch('main.STORAGE_FORMAT', storage_format):
+                write_table(df, path)
+                self.assertEqual(find_table_file(path), f'{path}.{storage_format}')
+
+                # Only the requested columns are read, in the requested order
+                pd.testing.assert_frame_equal(read_table(path, ['B', 'A']), df[['B', 'A']])
+                # Only the requested rows are read
+                pd.testing.assert_frame_equal(read_table(path, ['A'], slice(1, 3)), pd.DataFrame({'A': [2, 3]}))
+                pd.testing.assert_frame_equal(read_table(path, ['A'], slice(2, None)), pd.DataFrame({'A': [3]}))
+            os.remove(f'{path}.{storage_format}')
+
+        # Parquet keeps the dtypes of the columns
+        with patch('main.STORAGE_FORMAT', 'parquet'):
+            write_table(df, path)
+            pd.testing.assert_frame_equal(read_table(path), df, check_dtype=False)
+            self.assertTrue(pd.api.types.is_datetime64_any_dtype(read_table(path)['C']))
+        os.remove(f'{path}.parquet')
+
+        # Test when the table does not exist
+        with self.assertRaises(FileNotFoundError):
+            read_table(path)
+
+    def test_append_table_rows_parquet(self):
+        file_path = 'test_table.parquet'
+
+        # Every append adds a part file, cast to the schema of the first one
+        append_table_rows(pd.DataFrame({'A': [1.5, 2.5], 'B': ['x', 'y']}), file_path)
+        append_table_rows(pd.DataFrame({'B': ['z'], 'A': [3]}), file_path)
+
+        self.assertEqual(len(main.list_part_files(file_path)), 2)
+        expected_result = pd.DataFrame({'A': [1.5, 2.5, 3.0], 'B': ['x', 'y', 'z']})
+        pd.testing.assert_frame_equal(read_table_file(file_path), expected_result, check_dtype=False)
+
+        # Clean up the temporary table
+        shutil.rmtree(file_path)
+
+    def test_read_table_file_arrow(self):
+        file_path = 'test_table.arrow'
+        # The temporary tables are removed even when an assertion fails
+        self.addCleanup(shutil.rmtree, file_path, ignore_errors=True)
+        self.addCleanup(lambda: os.path.exists('test_concat.arrow') and os.remove('test_concat.arrow'))
+        append_table_rows(pd.DataFrame({'A': [1.5, 2.5], 'B': pd.Categorical(['x', 'y'])}), file_path)
+        append_table_rows(pd.DataFrame({'A': [3.5], 'B': pd.Categorical(['z'])}), file_path)
+        self.assertEqual(len(main.list_part_files(file_path)), 2)
+
+        # The rows of a range within a part are read from the mapped file, numeric columns without copy
+        table = main.map_arrow_file(file_path, ['A', 'B'])
+        mapped_buffer = np.frombuffer(table['A'].chunk(0).buffers()[1], dtype='float64')
+        with patch('main.map_arrow_file', return_value=table):
+            df = read_table_file(file_path, ['A', 'B'], rows=slice(0, 2))
+        pd.testing.assert_frame_equal(df, pd.DataFrame({'A': [1.5, 2.5], 'B': ['x', 'y']}), check_dtype=False)
+        self.assertTrue(np.shares_memory(df['A'].to_numpy(), mapped_buffer))
+
+        # The rows of a range spanning the parts are joined in order
+        df = read_table_file(file_path, ['A', 'B'], rows=slice(1, 3))
+        pd.testing.assert_frame_equal(df, pd.DataFrame({'A': [2.5, 3.5], 'B': ['y', 'z']}), check_dtype=False)
+
+        # Chunks and the concatenation of the parts keep the rows in order
+        chunks = list(main.iter_table_file_chunks(file_path, 2))
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        main.concat_table_files(main.list_part_files(file_path), 'test_concat.arrow')
+        pd.testing.assert_frame_equal(read_table_file('test_concat.arrow'), read_table_file(file_path))
+
+    def test_compact_table(self):
+        file_path = 'test_table.csv'
+        for rows in [{'key': ['K1', 'K2'], 'B': [1, 2]}, {'key': ['K2', 'K3'], 'B': [2, 3]}, {'key': ['K4'], 'B': [4]}]:
+            append_table_rows(pd.DataFrame(rows), file_path)
+        # A part written by a failed load is not listed by any commit, so it is never read
+        pd.DataFrame({'key': ['K9'], 'B': [9]}).to_csv(f'{file_path}/part-failed.csv', index=False)
+        snapshot = main.list_part_files(file_path)
+        self.assertEqual(len(snapshot), 3)
+
+        # The parts are merged without the repeated keys, in a commit that keeps the rows in order
+        self.assertEqual(main.compact_table(file_path, 'key', retention=3600), 3)
+        expected_result = pd.DataFrame({'key': ['K1', 'K2', 'K3', 'K4'], 'B': [1, 2, 3, 4]})
+        pd.testing.assert_frame_equal(read_table_file(file_path), expected_result)
+        self.assertEqual(len(main.list_part_files(file_path)), 1)
+        # Readers of the previous version still find its parts, until they are older than the retention
+        self.assertTrue(all(os.path.exists(part_path) for part_path in snapshot))
+        self.assertEqual(sorted(main.vacuum_table(file_path, retention=0)),
+                         sorted([os.path.basename(part_path) for part_path in snapshot] + ['part-failed.csv']))
+
+        # Appends and rewrites keep committing on top of the compacted table
+        self.assertEqual(append_table_rows(pd.DataFrame({'B': [5], 'key': ['K5']}), file_path), 4)
+        self.assertEqual(main.rewrite_table(pd.DataFrame({'key': ['K6'], 'B': [6]}), file_path), 5)
+        pd.testing.assert_frame_equal(read_table_file(file_path), pd.DataFrame({'key': ['K6'], 'B': [6]}))
+
+        # Clean up the temporary table
+        shutil.rmtree(file_path)
+
+    def test_compact_golden_layer(self):
+        file_path = 'test_customers.json'
+        for date, count in [('2022-01-01', 2), ('2022-01-02', 4)]:
+            customers = [
+                {"id": f"C{c}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+                 "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 5.0,
+                 "transactions": [{"transaction_id": f"T{c}", "date": f"2023-0{c + 1}-01", "amount": 5.0,
+                                   "product_id": f"P{c}", "product_name": f"Product {c}"}]}
+                for c in range(count)
+            ]
+            with open(file_path, 'w') as f:
+                json.dump({"customers": customers}, f)
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = date
+                create_layers()
+                create_bronze_layer(file_path)
+                create_silver_layer()
+                create_update_golden_layer()
+        tables = {table_name: load_golden_data(table_name)
+                  for table_name in ['fact_transactions', 'dimension_customers', 'dimension_products']}
+
+        # The key indexes and key maps stored next to the gold tables are not taken for partitioned tables
+        merged = main.compact_golden_layer(retention=0)
+        self.assertIn(find_table_file('data/gold/dimension_customers'), merged)
+        self.assertFalse(any('.index' in path for path in merged))
+        for table_name, df in tables.items():
+            pd.testing.assert_frame_equal(load_golden_data(table_name), df)
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_bronze_layer_streaming_parquet(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": "C001", "total_spent": 10.5, "transactions": [{"transaction_id": "T1", "amount": 10.5}]},
+            {"id": "C002", "total_spent": 3, "transactions": [{"transaction_id": "T2", "amount": 3}]},
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        with patch('main.pd.Timestamp') as mock_timestamp, patch('main.STORAGE_FORMAT', 'parquet'):
+            mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+            create_bronze_layer(file_path, streaming=True, chunk_size=1)
+            df_loaded = load_bronze_data()
+
+        # The transactions are kept as a nested column
+        self.assertEqual(list(df_loaded["id"]), ["C001", "C002"])
+        self.assertEqual(list(df_loaded["total_spent"]), [10.5, 3.0])
+        self.assertEqual(explode_transactions(df_loaded)["transaction_id"].tolist(), ["T1", "T2"])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_save_golden_data_partitioned(self):
+        os.makedirs('data/gold', exist_ok=True)
+        df = pd.DataFrame({
+            'transaction_id': ['T1', 'T2', 'T3'],
+            'date': ['2023-01-15', '2023-01-20', '2023-02-01'],
+            'amount': [10.0, 20.0, 30.0],
+        })
+        save_golden_data(df, 'fact_transactions')
+
+        january_path = 'data/gold/fact_transactions/year=2023/month=01/data.csv'
+        february_path = 'data/gold/fact_transactions/year=2023/month=02/data.csv'
+        self.assertEqual(len(read_table_file(january_path)), 2)
+        self.assertEqual(len(read_table_file(february_path)), 1)
+
+        # A load of new rows of February only touches the February partition
+        df_updated = pd.DataFrame({
+            'transaction_id': ['T3', 'T4'],
+            'date': ['2023-02-01', '2023-02-10'],
+            'amount': [30.0, 40.0],
+        })
+        with patch('main.write_appended_part', wraps=main.write_appended_part) as mock_write:
+            save_golden_data(df_updated, 'fact_transactions')
+        written = [call.args[1] for call in mock_write.call_args_list]
+        self.assertEqual([path for path in written if path.startswith('data/gold/fact_transactions/')],
+                         [february_path])
+        self.assertEqual(list(read_table_file(february_path)['transaction_id']), ['T3', 'T4'])
+
+        # Dates are loaded typed
+        pd.testing.assert_frame_equal(
+            load_golden_data('fact_transactions'),
+            pd.concat([df, df_updated.iloc[1:]], ignore_index=True).assign(date=lambda x: pd.to_datetime(x['date'])))
+
+    def test_save_golden_data_partitioned_single_commit(self):
+        os.makedirs('data/gold', exist_ok=True)
+        table_path = 'data/gold/fact_transactions'
+        df = pd.DataFrame({'transaction_id': ['T1'], 'date': ['2023-01-15'], 'amount': [10.0]})
+        save_golden_data(df, 'fact_transactions')
+
+        # A load failing once its parts are written leaves every partition as it was
+        df_failed = pd.DataFrame({'transaction_id': ['T2', 'T3'], 'date': ['2023-01-20', '2023-02-01'],
+                                  'amount': [20.0, 30.0]})
+        with patch('main.commit_table', side_effect=OSError):
+            with self.assertRaises(OSError):
+                save_golden_data(df_failed, 'fact_transactions')
+        self.assertEqual(list(load_golden_data('fact_transactions')['transaction_id']), ['T1'])
+
+        # A load spanning two months is a single commit of the table adding a part to both partitions
+        version = main.get_table_version(table_path)
+        save_golden_data(df_failed, 'fact_transactions')
+        self.assertEqual(main.get_table_version(table_path), version + 1)
+        commit = main.read_table_commits(table_path, version)[0][1]
+        self.assertEqual([os.path.dirname(part) for part in commit['add']],
+                         ['year=2023/month=01/data.csv', 'year=2023/month=02/data.csv'])
+        self.assertEqual(list(load_golden_data('fact_transactions')['transaction_id']), ['T1', 'T2', 'T3'])
+
+    def test_save_golden_data_partition_logs(self):
+        # A partitioned table written by an older version, with a log per partition
+        partition_path = 'data/gold/fact_transactions/year=2023/month=01/data.csv'
+        os.makedirs(f'{partition_path}/_log')
+        pd.DataFrame({'transaction_id': ['T1'], 'date': ['2023-01-15'], 'amount': [10.0]}).to_csv(
+            f'{partition_path}/part-a.csv', index=False)
+        with open(f'{partition_path}/_log/{0:020d}.json', 'w') as f:
+            json.dump({'operation': 'append', 'timestamp': 0, 'add': ['part-a.csv'], 'remove': []}, f)
+
+        save_golden_data(pd.DataFrame({'transaction_id': ['T2'], 'date': ['2023-02-01'], 'amount': [20.0]}),
+                         'fact_transactions')
+
+        self.assertFalse(os.path.exists(f'{partition_path}/_log'))
+        self.assertEqual(list(load_golden_data('fact_transactions')['transaction_id']), ['T1', 'T2'])
+
+    def test_save_golden_data_partitions_single_file_table(self):
+        # A fact table stored in a single file by an older version
+        os.makedirs('data/gold', exist_ok=True)
+        df = pd.DataFrame({'transaction_id': ['T1', 'T2'], 'date': ['2023-01-15', '2023-03-01'], 'amount': [1, 2]})
+        df.to_csv('data/gold/fact_transactions.csv', index=False)
+
+        save_golden_data(df, 'fact_transactions')
+
+        self.assertFalse(os.path.exists('data/gold/fact_transactions.csv'))
+        self.assertEqual(sorted(os.listdir('data/gold/fact_transactions/year=2023')), ['month=01', 'month=03'])
+        pd.testing.assert_frame_equal(load_golden_data('fact_transactions'),
+                                      df.assign(date=pd.to_datetime(df['date']), amount=df['amount'].astype(float)))
+
+    def test_load_golden_data_date_range(self):
+        os.makedirs('data/gold', exist_ok=True)
+        df = pd.DataFrame({
+            'transaction_id': ['T1', 'T2', 'T3', 'T4'],
+            'date': ['2022-12-31', '2023-01-15', '2023-02-10', '2023-03-01'],
+            'amount': [1.0, 2.0, 3.0, 4.0],
+        })
+        save_golden_data(df, 'fact_transactions')
+
+        # Only the partitions of January and February are opened
+        with patch('main.read_table_file', wraps=main.read_table_file) as mock_read:
+            result = load_golden_data('fact_transactions', ['transaction_id'], '2023-01-15', '2023-02-28')
+        self.assertEqual(mock_read.call_count, 2)
+        self.assertEqual(list(result.columns), ['transaction_id'])
+        self.assertEqual(list(result['transaction_id']), ['T2', 'T3'])
+
+        # Dimensions have no date to select a range on
+        with self.assertRaises(ValueError):
+            load_golden_data('dimension_products', start_date='2023-01-01')
+
+    def test_update_aggregate_tables(self):
+        os.makedirs('data/gold', exist_ok=True)
+        loads = [
+            pd.DataFrame({'transaction_id': ['T1', 'T2'], 'date': ['2023-01-15', '2023-01-15'], 'amount': [10.0, 5.0],
+                          'product_id': ['P1', 'P2'], 'customer_id': ['C1', 'C2']}),
+            # T2 is already stored, only T3 and T4 are new
+            pd.DataFrame({'transaction_id': ['T2', 'T3', 'T4'], 'date': ['2023-01-15', '2023-01-15', '2023-02-01'],
+                          'amount': [5.0, 2.5, 7.0], 'product_id': ['P2', 'P1', 'P1'],
+                          'customer_id': ['C2', 'C1', 'C3']}),
+        ]
+        save_golden_data(loads[0], 'fact_transactions')
+        with patch('main.aggregate_rows', wraps=main.aggregate_rows) as mock_aggregate, \
+                patch('main.read_table_file', wraps=main.read_table_file) as mock_read:
+            save_golden_data(loads[1], 'fact_transactions')
+        # Every aggregate only aggregated the new rows, and was appended their delta rows without being read
+        self.assertEqual([len(call.args[0]) for call in mock_aggregate.call_args_list], [2, 2, 2])
+        self.assertFalse([call for call in mock_read.call_args_list if 'agg_' in call.args[0]])
+        file_paths = {name: find_table_file(f'data/gold/{name}') for name in main.GOLD_AGGREGATES}
+        for file_path in file_paths.values():
+            self.assertEqual(len(main.list_part_files(file_path)), 2)
+
+        # The merged aggregates are the ones of the whole fact table, before and after compaction merged
+        # the delta rows
+        df_facts = load_golden_data('fact_transactions')
+        for compacted in [False, True]:
+            if compacted:
+                main.compact_golden_layer()
+            for aggregate_name, aggregate in main.GOLD_AGGREGATES.items():
+                df_expected = main.apply_schema(main.aggregate_rows(df_facts, aggregate), 'gold', aggregate_name)
+                pd.testing.assert_frame_equal(load_golden_data(aggregate_name), df_expected)
+        for aggregate_name, file_path in file_paths.items():
+            part_paths = main.list_part_files(file_path)
+            self.assertEqual(len(part_paths), 1)
+            self.assertEqual(len(read_table_file(part_paths[0])),
+                             len(load_golden_data(aggregate_name)))
+        df_daily = load_golden_data('agg_daily_revenue')
+        self.assertEqual(df_daily[['transactions', 'revenue']].values.tolist(), [[3, 17.5], [1, 7.0]])
+
+    def test_update_aggregate_tables_builds_missing_table(self):
+        os.makedirs('data/gold', exist_ok=True)
+        save_golden_data(pd.DataFrame({'transaction_id': ['T1'], 'date': ['2023-01-15'], 'amount': [10.0],
+                                       'product_id': ['P1'], 'customer_id': ['C1']}), 'fact_transactions')
+        # An aggregate table created by a later version is built from the whole fact table
+        shutil.rmtree('data/gold/agg_product_revenue.csv')
+        save_golden_data(pd.DataFrame({'transaction_id': ['T2'], 'date': ['2023-01-20'], 'amount': [5.0],
+                                       'product_id': ['P1'], 'customer_id': ['C1']}), 'fact_transactions')
+
+        self.assertEqual(load_golden_data('agg_product_revenue')[['product_key', 'transactions', 'revenue']]
+                         .values.tolist(), [[1, 2, 15.0]])
+        self.assertEqual(load_golden_data('agg_customer_spend')['total_spent'].tolist(), [15.0])
+
+    def test_save_golden_data_retry_after_crash(self):
+        os.makedirs('data/gold', exist_ok=True)
+        loads = [
+            pd.DataFrame({'transaction_id': ['T1', 'T2'], 'date': ['2023-01-15', '2023-02-15'], 'amount': [10.0, 5.0],
+                          'product_id': ['P1', 'P2'], 'customer_id': ['C1', 'C2']}),
+            pd.DataFrame({'transaction_id': ['T3', 'T4'], 'date': ['2023-01-20', '2023-03-01'], 'amount': [2.5, 7.0],
+                          'product_id': ['P1', 'P1'], 'customer_id': ['C1', 'C3']}),
+            pd.DataFrame({'transaction_id': ['T5'], 'date': ['2023-03-05'], 'amount': [1.0],
+                          'product_id': ['P2'], 'customer_id': ['C2']}),
+        ]
+        save_golden_data(loads[0], 'fact_transactions')
+        # A load fails once its rows are committed, before the index, then before the aggregates are updated
+        for load, failing in [(loads[1], 'main.extend_table_index'), (loads[2], 'main.update_aggregate_tables')]:
+            with patch(failing, side_effect=OSError('crash')):
+                with self.assertRaises(OSError):
+                    save_golden_data(load, 'fact_transactions')
+            # The retry finds the rows of the failed load stored, and only updates the sidecars with them
+            save_golden_data(load, 'fact_transactions')
+
+        df_facts = load_golden_data('fact_transactions')
+        self.assertEqual(sorted(df_facts['transaction_id']), ['T1', 'T2', 'T3', 'T4', 'T5'])
+        for aggregate_name, aggregate in main.GOLD_AGGREGATES.items():
+            pd.testing.assert_frame_equal(
+                load_golden_data(aggregate_name),
+                main.apply_schema(main.aggregate_rows(df_facts, aggregate), 'gold', aggregate_name))
+        index = main.load_table_index('data/gold/fact_transactions', 'transaction_id')
+        self.assertEqual(sum(run['count'] for run in index['runs']), 5)
+
+    def test_query_gold(self):
+        database = 'test_gold.sqlite'
+        os.makedirs('data/gold', exist_ok=True)
+        save_golden_data(pd.DataFrame({'customer_id': ['C1', 'C2'], 'customer_name': ['John', 'Jane'],
+                                       'customer_email': ['john@example.com', 'jane@example.com'],
+                                       'signup_date': ['2023-01-01', '2023-01-01']}), 'dimension_customers')
+        save_golden_data(pd.DataFrame({'product_id': ['P1', 'P2'], 'product_name': ['Product 1', 'Product 2']}),
+                         'dimension_products')
+        save_golden_data(pd.DataFrame({
+            'transaction_id': ['T1', 'T2', 'T3'], 'date': ['2023-01-15', '2023-02-01', '2023-02-10'],
+            'amount': [10.0, 20.0, 5.0], 'product_id': ['P1', 'P2', 'P2'], 'customer_id': ['C1', 'C1', 'C2'],
+        }), 'fact_transactions')
+
+        # Partitions are copied in chunks smaller than the tables
+        register_gold_tables(database, chunk_size=1)
+
+        # A star join of the facts with both dimensions, aggregated in the database
+        result = query_gold("""
+            SELECT c.customer_id, p.product_name, SUM(f.amount) AS total
+            FROM fact_transactions f
+            JOIN dimension_customers c ON c.customer_key = f.customer_key AND c.current
+            JOIN dimension_products p ON p.product_key = f.product_key
+            WHERE f.date >= ?
+            GROUP BY c.customer_id, p.product_name
+            ORDER BY c.customer_id
+        """, ['2023-02-01'], database)
+        self.assertEqual(result.to_dict('records'), [
+            {'customer_id': 'C1', 'product_name': 'Product 2', 'total': 20.0},
+            {'customer_id': 'C2', 'product_name': 'Product 2', 'total': 5.0}])
+
+        # The keys are indexed
+        indexes = query_gold("SELECT name FROM sqlite_master WHERE type = 'index'", database=database)
+        self.assertIn('idx_fact_transactions_customer_key', indexes['name'].tolist())
+        plan = query_gold("EXPLAIN QUERY PLAN SELECT * FROM dimension_products WHERE product_id = 'P1'",
+                          database=database)
+        self.assertIn('idx_dimension_products_product_id', ' '.join(plan['detail']))
+
+        # A later load appends a transaction and changes the email of a customer. Only the parts committed
+        # since are copied, and the rows of the parts replaced, the current customers and the aggregates, are deleted
+        with patch('main.pd.Timestamp') as mock_timestamp:
+            mock_timestamp.return_value.strftime.return_value = '2099-01-01'
+            save_golden_data(pd.DataFrame({'customer_id': ['C2'], 'customer_name': ['Jane'],
+                                           'customer_email': ['jane@new.com'], 'signup_date': ['2023-01-01']}),
+                             'dimension_customers')
+        save_golden_data(pd.DataFrame({'transaction_id': ['T4'], 'date': ['2023-02-11'], 'amount': [1.0],
+                                       'product_id': ['P1'], 'customer_id': ['C2']}), 'fact_transactions')
+        with patch('main.iter_table_file_chunks', wraps=main.iter_table_file_chunks) as mock_chunks:
+            register_gold_tables(database, chunk_size=1)
+        copied = [os.path.relpath(call.args[0], 'data/gold').split('/')[0] for call in mock_chunks.call_args_list]
+        self.assertEqual(sorted(copied), sorted(['fact_transactions', 'dimension_customers.csv',
+                                                 'dimension_customers.csv', 'dimension_customers_history.csv']
+                                                + [f'{name}.csv' for name in main.GOLD_AGGREGATES]))
+        for table_name in main.GOLD_DATABASE_INDEXES:
+            df = query_gold(f"SELECT * FROM {table_name}", database=database)
+            self.assertEqual(len(df), len(load_golden_data(table_name)))
+        result = query_gold("SELECT customer_email FROM dimension_customers WHERE current ORDER BY customer_id",
+                            database=database)
+        self.assertEqual(result['customer_email'].tolist(), ['john@example.com', 'jane@new.com'])
+        self.assertEqual(query_gold("SELECT revenue FROM agg_product_revenue ORDER BY product_key",
+                                    database=database)['revenue'].tolist(), [11.0, 25.0])
+
+        # Clean up the temporary database
+        os.remove(database)
+
+    def test_create_silver_layer_lazy(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C{c}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 10.0,
+             "transactions": [{"transaction_id": f"T{c}{t}", "date": f"2023-0{t + 1}-01", "amount": 5.0,
+                               "product_id": f"P{t}", "product_name": f"Product {t}"} for t in range(2)]}
+            for c in range(5)
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+        table_names = ['sanitation', 'denormalized', 'transactions', 'customers', 'products']
+
+        with patch('main.pd.Timestamp') as mock_timestamp:
+            mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+            create_layers()
+            create_bronze_layer(file_path)
+            create_silver_layer()
+            expected_tables = {table_name: load_silver_data(table_name) for table_name in table_names}
+            shutil.rmtree('data/silver/2022-01-01')
+
+            # The lazy silver layer saves the same tables, and parses the transactions once for all of them
+            with patch('main.explode_transactions', wraps=main.explode_transactions) as mock_explode:
+                create_silver_layer_lazy()
+            self.assertEqual(mock_explode.call_count, 1)
+            for table_name in table_names:
+                pd.testing.assert_frame_equal(load_silver_data(table_name), expected_tables[table_name])
+            shutil.rmtree('data/silver/2022-01-01')
+
+            # Only the requested tables are saved
+            create_silver_layer_lazy(['transactions', 'products'])
+            self.assertEqual(sorted(os.listdir('data/silver/2022-01-01')),
+                             ['products.csv', 'products.stats.json', 'transactions.csv', 'transactions.stats.json'])
+            pd.testing.assert_frame_equal(load_silver_data('transactions'), expected_tables['transactions'])
+            pd.testing.assert_frame_equal(load_silver_data('products'), expected_tables['products'])
+
+        # The denormalized table is only built with the columns the requested tables use
+        plan = plan_silver_tables(['products'])
+        self.assertEqual(plan['denormalized'], ['product_id', 'product_name'])
+        self.assertEqual(plan['bronze'], ['product_id', 'product_name'])
+        self.assertIsNone(plan_silver_tables(['products', 'sanitation'])['bronze'])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_backfill(self):
+        file_path = 'test_customers.json'
+
+        def customer(c, name=None):
+            return {"id": f"C{c}", "name": name or f"Customer {c}", "email": f"customer{c}@example.com",
+                    "signup_date": "2021-01-01", "last_purchase": "2022-01-01", "total_spent": 5.0,
+                    "transactions": [{"transaction_id": f"T{c}", "date": "2022-01-01", "amount": 5.0,
+                                      "product_id": f"P{c}", "product_name": f"Product {c}"}]}
+
+        days = [
+            ('2022-01-01', [customer(1), customer(2)]),
+            ('2022-01-02', [customer(1, "Renamed"), customer(2), customer(3)]),
+            ('2022-01-04', [customer(1, "Renamed"), customer(3), customer(4)]),
+        ]
+        for date, customers in days:
+            with open(file_path, 'w') as f:
+                json.dump({"customers": customers}, f)
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = date
+                create_layers()
+                create_bronze_layer(file_path)
+                create_silver_layer()
+                create_update_golden_layer()
+        table_names = ['fact_transactions', 'dimension_customers', 'dimension_products']
+        expected_tables = {table_name: load_golden_data(table_name) for table_name in table_names}
+        expected_silver = pd.read_csv('data/silver/2022-01-02/customers.csv')
+
+        # The silver partitions are created again on a pool of workers, and the gold layer is merged in date order
+        shutil.rmtree('data/silver')
+        shutil.rmtree('data/gold')
+        os.makedirs('data/gold')
+        self.assertEqual(backfill('2021-12-31', '2022-01-05', 2, 'thread'), ['2022-01-01', '2022-01-02', '2022-01-04'])
+
+        self.assertEqual(sorted(os.listdir('data/silver')), ['2022-01-01', '2022-01-02', '2022-01-04'])
+        pd.testing.assert_frame_equal(pd.read_csv('data/silver/2022-01-02/customers.csv'), expected_silver)
+        for table_name in table_names:
+            pd.testing.assert_frame_equal(load_golden_data(table_name), expected_tables[table_name])
+        # The renamed customer is versioned on the date of its bronze partition
+        df_history = read_table_file('data/gold/dimension_customers_history.csv')
+        self.assertEqual(df_history[["customer_name", "valid_from", "valid_to"]].to_dict("records"), [
+            {"customer_name": "Customer 1", "valid_from": "2022-01-01", "valid_to": "2022-01-02"}])
+
+        # A backfill over the dimension skips the dates older than its last load, so the history is unchanged
+        backfill('2022-01-01', '2022-01-04')
+        pd.testing.assert_frame_equal(read_table_file('data/gold/dimension_customers_history.csv'), df_history)
+        for table_name in table_names:
+            pd.testing.assert_frame_equal(load_golden_data(table_name), expected_tables[table_name])
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_push_and_pull_paths(self):
+        server, connection_string, blobs, server_stats = start_blob_emulator()
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C{c}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 10.0,
+             "transactions": [{"transaction_id": f"T{c}{t}", "date": f"2023-0{t + 1}-01", "amount": 5.0,
+                               "product_id": f"P{t}", "product_name": f"Product {t}"} for t in range(2)]}
+            for c in range(20)
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+        paths = ['data/bronze', 'data/silver', 'data/gold']
+
+        # Small blocks, so the larger files are sent as blocks and received as ranges
+        environment = {main.STORAGE_CONNECTION_VARIABLE: connection_string, main.STORAGE_CONTAINER_VARIABLE: 'test'}
+        with patch.dict(os.environ, environment), patch('main.BLOB_BLOCK_SIZE', 512), \
+                patch('main.REMOTE_FILES', SimpleNamespace(client=None, pid=None, blobs={})), \
+                patch('main.pd.Timestamp') as mock_timestamp:
+            mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+            create_layers()
+            create_bronze_layer(file_path)
+            create_silver_layer()
+            create_update_golden_layer()
+            expected_customers = load_golden_data('dimension_customers')
+            self.assertIsNone(connect_storage('local'))
+            client = connect_storage('blob')
+
+            # Every file is uploaded under its path, then only the files changed
+            files = [os.path.join(directory, name) for path in paths for directory, _, names in os.walk(path)
+                     for name in names]
+            self.assertEqual(sorted(push_paths(client, paths)), sorted(files))
+            for path in files:
+                with open(path, 'rb') as f:
+                    self.assertEqual(blobs[f'test/{path}'][0], f.read())
+            self.assertEqual(push_paths(client, paths), [])
+            self.assertLess(server_stats["connections"], server_stats["requests"])
+
+            # A new local copy is downloaded from the container
+            self.remove_data_directories()
+            os.remove(main.STORAGE_MANIFEST_FILE)
+            self.assertEqual(sorted(pull_paths(client, paths)), sorted(files))
+            pd.testing.assert_frame_equal(load_golden_data('dimension_customers'), expected_customers)
+            self.assertEqual(pull_paths(client, paths), [])
+
+            # A run only downloads the partitions of its date and the files describing the gold tables, the
+            # part files of the gold tables are downloaded when they are opened
+            self.remove_data_directories()
+            os.remove(main.STORAGE_MANIFEST_FILE)
+            pulled = main.pull_run_paths(client, ['2022-01-01'])
+            self.assertIn('data/silver/2022-01-01/customers.csv', pulled)
+            self.assertFalse([name for name in pulled if os.path.basename(name).startswith('part-')])
+            customer_parts = main.list_part_files('data/gold/dimension_customers.csv')
+            product_parts = main.list_part_files('data/gold/dimension_products.csv')
+            self.assertFalse([part for part in customer_parts + product_parts if os.path.exists(part)])
+            pd.testing.assert_frame_equal(load_golden_data('dimension_customers'), expected_customers)
+            self.assertTrue(all(os.path.exists(part) for part in customer_parts))
+            # Parts downloaded are not uploaded again, and parts never opened are kept in the container
+            self.assertEqual(push_paths(client, paths), [])
+            self.assertTrue(all(f'test/{part}' in blobs and not os.path.exists(part) for part in product_parts))
+
+            # Removed files are deleted from the container
+            os.remove('data/silver/2022-01-01/products.csv')
+            push_paths(client, paths)
+            self.assertNotIn('test/data/silver/2022-01-01/products.csv', blobs)
+
+        # Clean up the connections and the temporary files
+        main.close_storage(client)
+        self.assertTrue(client['connections'].empty())
+        server.shutdown()
+        server.server_close()
+        os.remove(file_path)
+        os.remove(main.STORAGE_MANIFEST_FILE)
+
+    def test_run_parallel(self):
+        tasks = [partial(pow, 2, exponent) for exponent in range(5)]
+
+        # The results are returned in the order of the tasks, whatever the pool
+        for workers, executor in [(1, None), (3, 'thread'), (3, 'process')]:
+            self.assertEqual(run_parallel(tasks, workers, executor), [1, 2, 4, 8, 16])
+
+    def test_create_layers_parallel(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C{c}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 10.0,
+             "transactions": [{"transaction_id": f"T{c}{t}", "date": f"2023-0{t + 1}-01", "amount": 5.0,
+                               "product_id": f"P{t}", "product_name": f"Product {t}"} for t in range(2)]}
+            for c in range(5)
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        # The layers created by a pool of workers are the same as the ones created one task after the other
+        results = []
+        for workers in [1, 4]:
+            self.remove_data_directories()
+            with patch('main.pd.Timestamp') as mock_timestamp:
+                mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+                create_layers()
+                create_bronze_layer(file_path)
+                create_silver_layer(workers, 'thread')
+                create_update_golden_layer(workers, 'thread')
+            results.append([pd.read_csv(f'data/silver/2022-01-01/{table_name}.csv') for table_name in
+                            ['sanitation', 'denormalized', 'transactions', 'customers', 'products']]
+                           + [load_golden_data('fact_transactions'), load_golden_data('dimension_customers')])
+
+        for df_sequential, df_parallel in zip(*results):
+            pd.testing.assert_frame_equal(df_parallel, df_sequential)
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_update_golden_layer_transaction_keys(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C{c}", "name": f"Customer {c}", "email": None if c == 2 else f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 5.0,
+             "transactions": [{"transaction_id": f"T{c}", "date": "2023-01-01", "amount": 5.0,
+                               "product_id": f"P{c}", "product_name": f"Product {c}"}]}
+            for c in range(3)
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        with patch('main.pd.Timestamp') as mock_timestamp:
+            mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+            create_layers()
+            create_bronze_layer(file_path)
+            create_silver_layer()
+            # The customer dropped for its missing email is only found in the transactions, and gets its
+            # surrogate key before the entities are loaded in parallel
+            with patch('main.run_parallel') as mock_run_parallel:
+                create_update_golden_layer(4, 'thread')
+            mock_run_parallel.assert_called_once()
+            self.assertEqual(main.load_key_map('data/gold/dimension_customers'), {'C0': 1, 'C1': 2, 'C2': 3})
+            self.assertEqual(set(main.load_key_map('data/gold/dimension_products')), {'P0', 'P1', 'P2'})
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_create_silver_layer_chunked(self):
+        file_path = 'test_customers.json'
+        customers = [
+            {"id": f"C{c}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 5.0 * c,
+             "transactions": [{"transaction_id": f"T{c}{t}", "date": f"2023-0{t + 1}-01", "amount": 5.0,
+                               "product_id": f"P{t}", "product_name": f"Product {t}"} for t in range(c)]}
+            for c in range(6)
+        ]
+        # A customer found again in a later shard is deduplicated across the buckets of the customers
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers + customers[2:3]}, f)
+
+        tables = ['sanitation', 'denormalized', 'transactions', 'customers', 'products']
+        for split_transactions, storage_format in [(False, 'csv'), (True, 'csv'), (False, 'arrow')]:
+            with patch('main.pd.Timestamp') as mock_timestamp, patch('main.STORAGE_FORMAT', storage_format):
+                mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+                self.remove_data_directories()
+                create_bronze_layer(file_path, split_transactions=split_transactions)
+                create_silver_layer()
+                expected_results = [load_silver_data(table_name) for table_name in tables]
+
+                # The first shard of a single customer has no transaction
+                for chunk_size, workers in [(1, 1), (4, 2)]:
+                    shutil.rmtree('data/silver')
+                    with patch('main.SILVER_DISTINCT_BUCKETS', 2):
+                        create_silver_layer_chunked(chunk_size, workers)
+                    for table_name, expected_result in zip(tables, expected_results):
+                        pd.testing.assert_frame_equal(load_silver_data(table_name), expected_result)
+                    self.assertFalse(os.path.exists('data/silver/2022-01-01/_shards'))
+
+        # Clean up the temporary file
+        os.remove(file_path)
+
+    def test_run_pipeline(self):
+        directory_path = 'test_pipeline'
+        os.makedirs(directory_path, exist_ok=True)
+        source_path = f'{directory_path}/source.txt'
+        state_file = f'{directory_path}/state.json'
+        with open(source_path, 'w') as f:
+            f.write('a,b')
+        calls = []
+
+        # The first stage writes the number of values of the source, the second one copies it
+        def count_values():
+            calls.append('count')
+            with open(source_path) as source, open(f'{directory_path}/count.txt', 'w') as f:
+                f.write(str(len(source.read().split(','))))
+
+        def copy_count():
+            calls.append('copy')
+            shutil.copy(f'{directory_path}/count.txt', f'{directory_path}/copy.txt')
+
+        stages = [
+            {"name": "copy", "function": copy_count, "depends_on": ["count"],
+             "inputs": [f'{directory_path}/count.txt'], "outputs": [f'{directory_path}/copy.txt']},
+            {"name": "count", "function": count_values,
+             "inputs": [source_path], "outputs": [f'{directory_path}/count.txt']},
+        ]
+
+        # Stages run in dependency order, then are skipped while nothing changes
+        self.assertEqual(run_pipeline(stages, state_file=state_file), {"count": "run", "copy": "run"})
+        self.assertEqual(run_pipeline(stages, state_file=state_file), {"count": "skipped", "copy": "skipped"})
+        self.assertEqual(calls, ['count', 'copy'])
+
+        # A new source with the same number of values does not change the input of the second stage
+        with open(source_path, 'w') as f:
+            f.write('c,d')
+        self.assertEqual(run_pipeline(stages, state_file=state_file), {"count": "run", "copy": "skipped"})
+
+        # Missing outputs and force run the stages again
+        os.remove(f'{directory_path}/copy.txt')
+        self.assertEqual(run_pipeline(stages, state_file=state_file), {"count": "skipped", "copy": "run"})
+        self.assertEqual(run_pipeline(stages, force=True, state_file=state_file), {"count": "run", "copy": "run"})
+
+        # Clean up the temporary directory
+        shutil.rmtree(directory_path)
+
+    def test_run_pipeline_after_failure(self):
+        directory_path = 'test_pipeline'
+        os.makedirs(directory_path, exist_ok=True)
+        state_file = f'{directory_path}/state.json'
+        calls = []
+
+        def first():
+            calls.append('first')
+            with open(f'{directory_path}/first.txt', 'w') as f:
+                f.write('done')
+
+        def failing():
+            calls.append('second')
+            raise RuntimeError('failure')
+
+        stages = [
+            {"name": "first", "function": first, "inputs": [], "outputs": [f'{directory_path}/first.txt']},
+            {"name": "second", "function": failing, "depends_on": ["first"],
+             "inputs": [f'{directory_path}/first.txt'], "outputs": [f'{directory_path}/second.txt']},
+        ]
+        with self.assertRaises(RuntimeError):
+            run_pipeline(stages, state_file=state_file)
+
+        # The completed stage is not run again
+        stages[1]["function"] = lambda: calls.append('second') or open(f'{directory_path}/second.txt', 'w').close()
+        self.assertEqual(run_pipeline(stages, state_file=state_file), {"first": "skipped", "second": "run"})
+        self.assertEqual(calls, ['first', 'second', 'second'])
+
+        # Clean up the temporary directory
+        shutil.rmtree(directory_path)
+
+    def test_collect_metrics(self):
+        file_path = 'test_customers.json'
+        report_file = 'test_metrics.json'
+        customers = [
+            {"id": f"C{c}", "name": f"Customer {c}", "email": f"customer{c}@example.com",
+             "signup_date": "2023-01-01", "last_purchase": "2023-02-01", "total_spent": 10.0,
+             "transactions": [{"transaction_id": f"T{c}{t}", "date": f"2023-0{t + 1}-01", "amount": 5.0,
+                               "product_id": f"P{t}", "product_name": f"Product {t}"} for t in range(2)]}
+            for c in range(3)
+        ]
+        with open(file_path, 'w') as f:
+            json.dump({"customers": customers}, f)
+
+        # The pipeline prints nothing while its calls are recorded
+        output = io.StringIO()
+        with patch('main.pd.Timestamp') as mock_timestamp, redirect_stdout(output):
+            mock_timestamp.return_value.strftime.return_value = '2022-01-01'
+            with collect_metrics(report_file, trace_memory=True):
+                create_layers()
+                create_bronze_layer(file_path)
+                create_silver_layer()
+                create_update_golden_layer()
+        self.assertEqual(output.getvalue(), '')
+
+        with open(report_file) as f:
+            report = json.load(f)
+        functions = report["functions"]
+        for function in ['open_file', 'rearrange_data', 'sanity_check', 'save_golden_data', 'load_golden_data']:
+            self.assertIn(function, functions)
+        # The customers and transactions tables are denormalized in a row per transaction
+        self.assertEqual(functions["rearrange_data"]["rows_in"], 9)
+        self.assertEqual(functions["rearrange_data"]["rows_out"], 6)
+        self.assertEqual(functions["create_bronze_layer"]["calls"], 1)
+        for metric in ['wall_s', 'cpu_s', 'max_rss_mb', 'peak_traced_mb']:
+            self.assertGreaterEqual(functions["create_silver_layer"][metric], 0)
+        # Nested calls are part of the calls of the function running them
+        call = next(call for call in report["calls"] if call["function"] == "rearrange_data")
+        self.assertEqual(call["depth"], 1)
+        self.assertFalse(os.path.exists(f'{report_file}.calls'))
+
+        # Without collection no call is recorded
+        self.assertNotIn(main.METRICS_FILE_VARIABLE, os.environ)
+
+        # Clean up the temporary files
+        os.remove(file_path)
+        os.remove(report_file)
 
 
 if __name__ == '__main__':